@@ -1,8 +1,11 @@
+import io
+import math
+
 from tangos import parallel_tasks as pt
 
-from . import core, query
+from . import core
 from .log import logger
-from .util import proxy_object, timestep_object_cache
+from .util import proxy_object
 
 
 def create_property(halo, name, prop, session):
@@ -24,48 +27,148 @@ def create_property(halo, name, prop, session):
     px.creator_id = core.creator.get_creator(session).id
     return px
 
-def _resolve_proxy(possibly_proxy, timestep_cache: timestep_object_cache.TimestepObjectCache):
-    if isinstance(possibly_proxy, proxy_object.ProxyObjectBase):
-        # TODO: possible optimization here using relative_to_timestep_cache
-        result = possibly_proxy.relative_to_timestep_cache(timestep_cache).resolve(core.get_default_session())
+_PROPERTY_DATA_COLUMNS = ('data_float', 'data_int', 'data_array')
+
+def _rows_for_property_list(resolved_list, session):
+    """Build plain rows for the haloproperties and halolink tables from a list of resolved (object, name, value)"""
+    name_ids = core.dictionary.get_or_create_dictionary_ids(session, [p[1] for p in resolved_list])
+    creator_id = core.creator.get_creator(session).id
+
+    property_rows = []
+    link_rows = []
+    for halo, name, value in resolved_list:
+        if isinstance(value, core.halo.Halo):
+            link_rows.append({'halo_from_id': halo.id, 'halo_to_id': value.id, 'relation_id': name_ids[name],
+                              'weight': 1.0, 'creator_id': creator_id})
+        else:
+            row = {'halo_id': halo.id, 'name_id': name_ids[name], 'creator_id': creator_id, 'deprecated': False}
+            row.update(core.data_attribute_mapper.pack_data_of_unknown_type(value, _PROPERTY_DATA_COLUMNS))
+            property_rows.append(row)
+
+    return property_rows, link_rows
+
+def _format_for_postgresql_copy(value):
+    if value is None:
+        return "\\N"
+    elif isinstance(value, bool):
+        return "t" if value else "f"
+    elif isinstance(value, bytes):
+        return "\\\\x" + value.hex()
+    elif isinstance(value, float):
+        if math.isnan(value):
+            return "NaN"
+        elif math.isinf(value):
+            return "Infinity" if value>0 else "-Infinity"
+        return repr(value)
     else:
-        result = possibly_proxy
-    return result
+        return str(value)
+
+def _copy_into_postgresql_table(connection, table, rows):
+    """Insert rows using COPY FROM STDIN. Returns False if the database driver does not support this."""
+    cursor = connection.connection.cursor()
+    try:
+        if not hasattr(cursor, 'copy_expert'):
+            return False
+
+        columns = list(rows[0].keys())
+        buffer = io.StringIO()
+        for row in rows:
+            buffer.write("\t".join(_format_for_postgresql_copy(row[c]) for c in columns))
+            buffer.write("\n")
+        buffer.seek(0)
+
+        cursor.copy_expert("COPY %s (%s) FROM STDIN"%(table.name, ", ".join(columns)), buffer)
+        return True
+    finally:
+        cursor.close()
+
+def _bulk_insert(session, table, rows):
+    """Insert rows (a list of dictionaries with identical keys) into table without going through the ORM
+
+    On PostgreSQL (with psycopg2), COPY FROM STDIN is used; otherwise a single executemany INSERT is issued."""
+    if len(rows)==0:
+        return
+    connection = session.connection()
+    dialect = connection.dialect.dialect_description.split("+")[0].lower()
+    if dialect == 'postgresql' and _copy_into_postgresql_table(connection, table, rows):
+        return
+    connection.execute(table.insert(), rows)
 
 def _insert_list_unlocked(property_list, timestep_id):
     session = core.get_default_session()
-    number = 0
-    timestep_cache = timestep_object_cache.TimestepObjectCache(query.get_timestep(timestep_id, session=session))
-    objects = []
+
+    # resolve the proxies in all rows at once, so that the database is queried once per kind of proxy rather than
+    # once per row
+    flattened = [pi for p in property_list for pi in p]
+    resolved = proxy_object.resolve_all(flattened, session, timestep_id)
+
+    resolved_list = []
+    offset = 0
     for p in property_list:
-        p = [_resolve_proxy(pi, timestep_cache) for pi in p]
+        p = resolved[offset:offset+len(p)]
+        offset += len(p)
         if p[2] is not None:
-            objects.append(create_property(*p, session))
-            number += 1
+            resolved_list.append(p)
 
-    session.bulk_save_objects(objects)
+    property_rows, link_rows = _rows_for_property_list(resolved_list, session)
+    _bulk_insert(session, core.halo_data.HaloProperty.__table__, property_rows)
+    _bulk_insert(session, core.halo_data.HaloLink.__table__, link_rows)
     session.commit()
-    return number
+    return len(resolved_list)
 
-def insert_list(property_list, timestep_id, commit_on_server):
+def insert_list(property_list, timestep_id, commit_on_server, wait=True):
+    """Write the (object, name, value) tuples in property_list to the database
+
+    If commit_on_server is True, the list is passed to the server process to write. In that case, if wait is False,
+    this function returns immediately and the server writes the properties as soon as it can obtain the insert_list
+    lock, in the order they were handed to it. If wait is True, it returns only once the write (and those of any
+    lists handed over previously) is complete."""
     if pt.backend!=None:
-        with pt.ExclusiveLock("insert_list"):
-            if commit_on_server:
-                # nb though it looks weird to have a lock when the commit will be
-                # processed on the server process, this is actually just easier than attaining
-                # the lock on the server
-                return PropertyListCommitMessage((property_list, timestep_id)).send_and_get_response(0)
+        if commit_on_server:
+            message = PropertyListCommitMessage((property_list, timestep_id, wait))
+            if wait:
+                return message.send_and_get_response(0)
             else:
+                message.send(0)
+        else:
+            with pt.ExclusiveLock("insert_list"):
                 return _insert_list_unlocked(property_list, timestep_id)
     else:
         if commit_on_server:
             raise ValueError("insert_list called with commit_on_server=True, but no parallel backend is initialised")
         return _insert_list_unlocked(property_list, timestep_id)
 
+_server_commit_queue = []
+
+def _insert_queued_lists_on_server():
+    # A failed insert must not prevent the other queued lists being written, nor leave any rank waiting forever.
+    # Ranks waiting for the result of a failed insert receive the exception; if nobody is waiting for it, it is raised
+    # here once the queue is drained.
+    unreported_error = None
+    while len(_server_commit_queue)>0:
+        property_list, timestep_id, awaiting_response = _server_commit_queue.pop(0)
+        try:
+            number = _insert_list_unlocked(property_list, timestep_id)
+        except Exception as e:
+            core.get_default_session().rollback()
+            if awaiting_response is not None:
+                pt.message.ExceptionMessage(e).send(awaiting_response.source)
+            elif unreported_error is None:
+                unreported_error = e
+            continue
+        if awaiting_response is not None:
+            awaiting_response.respond(number)
+
+    if unreported_error is not None:
+        raise unreported_error
+
 class PropertyListCommitMessage(pt.message.MessageWithResponse):
+    dispatch_lane = pt.dispatch.DATABASE
+
     def __init__(self, contents=None):
         super().__init__(contents)
 
     def process(self):
-        result = _insert_list_unlocked(*self.contents)
-        self.respond(result)
+        property_list, timestep_id, wait = self.contents
+        _server_commit_queue.append((property_list, timestep_id, self if wait else None))
+        pt.lock.run_on_server_with_lock("insert_list", _insert_queued_lists_on_server)
@@ -46,9 +46,45 @@ pynbody_build_kdtree_all_cpus = True
 # to be waiting on the server anyway. If set to False, pynbody determines the number of
 # CPUs for the KDTree build, which on a system well configured for tangos would be 1.
 
+memory_budget = None
+# If not None, the resident memory (in GB) that each tangos process aims to stay within. When it is exceeded, cached
+# data (recently loaded regions and the pynbody server's cached halo and region index lists) is discarded, least
+# recently used first, and the pynbody server does not prefetch further timesteps.
+
+pynbody_region_cache_size = 4
+# The number of recently loaded regions of each timestep that are kept, so that calculations on nearby objects
+# that request the same region (e.g. when objects are processed with --schedule spatial) do not need to extract
+# it again. The least recently used regions are discarded first. Set to 0 to disable the region cache.
+
+pynbody_server_region_prefetch_count = 0
+# In --load-mode server-shared-mem, tangos write can ask the server for the regions needed by this many upcoming
+# objects in a single request; the server locates them all (using its KD-tree, if built) and returns their index
+# lists. This is most useful when there are many small regions and the workers have not been sent the KD-tree.
+# Note that the workers then take objects from the distributed loop this many at a time. Set to 0 to disable.
+
+pynbody_server_prefetch_depth = 1
+# In server load modes, tangos write asks the server to start loading the next timestep in a background thread
+# while clients are still working on the current one. This sets the maximum number of timesteps that can be
+# prefetched in this way; set to 0 to disable prefetching.
+
+pynbody_server_prefetch_memory_limit = None
+# If not None, the server will not prefetch a timestep if it estimates this would take its memory usage above
+# this number of GB. The estimate assumes the next timestep is the same size as those already loaded.
+
+pynbody_server_subsnap_cache_limit = 1.0
+# The pynbody server keeps the index lists of recently requested halos and regions so that repeated requests
+# for the same object do not need to recompute them. This sets the maximum memory (in GB) that these cached index
+# lists can occupy; the least recently used are discarded first. Set to None for no limit.
+
 default_backend = 'null'
 # the default paralellism backend. Set e.g. to mpi4py to avoid having to pass --backend mpi4py to all parallel runs.
 
+max_jobs_per_request = 1
+# The maximum number of jobs from a distributed loop that the server hands to a worker in one go. Larger values
+# reduce the number of round trips to the server when there are many cheap jobs. The batch size shrinks as the
+# queue drains (guided self-scheduling) so that the final jobs remain well balanced. Note that a batch interrupted
+# part-way through is run again in its entirety when a loop is resumed.
+
 enable_async_message_processing = False
 # Async message processing was introduced in an effort to separate out long pynbody operations
 # on the server into a different thread. However, it can lead to subtle race conditions (e.g.
@@ -58,6 +94,12 @@ enable_async_message_processing = False
 # in a single queue, which should be more reliable. It may be that async processing should be
 # removed from the codebase entirely, but I am leaving it like this for now.
 
+server_concurrent_dispatch = False
+# If True, the server processes messages from different clients on different threads, so that (for example) a slow
+# request for a large array from one client does not hold up lock and job requests from the others. Messages from any
+# one client are still processed in the order they were sent, and messages that touch the same server state are
+# processed one at a time (see parallel_tasks/dispatch.py). If False, every message is processed in turn.
+
 
 
 # names of property modules to import; default is for backwards compatibility on systems with N-Body-Shop extensions
@@ -94,6 +136,11 @@ max_relative_time_difference = 1e-4     # the maximum fractional difference in t
 DEFAULT_SLEEP_BEFORE_ALLOWING_NEXT_LOCK = 1.0
 # number of seconds to sleep after a lock is released before reallocating it
 
+lock_handover_delays = {'insert_list': 0.0}
+# overrides DEFAULT_SLEEP_BEFORE_ALLOWING_NEXT_LOCK for the named locks. The insert_list lock is handed over many
+# times per timestep and each holder only inserts rows through the database engine, so by default it is handed over
+# without delay. If you see sqlite errors when committing properties on a network file system, remove it from here.
+
 # Default format to use in the webview. Can be either svg or png
 webview_default_image_format = 'svg'
 
@@ -119,6 +166,10 @@ PROPERTY_WRITER_MAXIMUM_TIME_BETWEEN_COMMITS = 600 # seconds
 # Property writer: don't bother committing even if a timestep is finished if this time hasn't elapsed:
 PROPERTY_WRITER_MINIMUM_TIME_BETWEEN_COMMITS = 300 # seconds
 
+# Resumable loops: longest time that a completed job can sit in the resume journal before being fsynced to disk.
+# (Completed jobs are always written out immediately, so this only matters if the whole node goes down.)
+RESUME_JOURNAL_FSYNC_INTERVAL = 5.0 # seconds
+
 # Minimum time between providing updates to the user during tangos write, when running in parallel
 # Note that this is a 'polling' interval, for checking whether to update the display. Internally, the
 # statistics are updated whenever a commit is made by any process (and the frequency of such commits
@@ -190,6 +190,7 @@ def close_session():
 from .dictionary import (
     _get_dict_cache_for_session,
     get_dict_id,
+    get_or_create_dictionary_ids,
     get_or_create_dictionary_item,
 )
 
@@ -29,6 +29,20 @@ def set_data_of_unknown_type(obj, data):
     mapper.set(obj,data)
 
 
+def pack_data_of_unknown_type(data, attribute_names):
+    """Return a dictionary mapping each of attribute_names to the value it should take in order to store data.
+
+    This is the equivalent of set_data_of_unknown_type for use when constructing rows without going through the ORM.
+    Attributes that are not needed to store the data map to None."""
+    mapper = DataAttributeMapper(data=data)
+    values = dict.fromkeys(attribute_names)
+    if mapper._attribute_name is not None:
+        if mapper._attribute_name not in values:
+            raise TypeError("No slot for %r when storing data of type %r"%(mapper._attribute_name, type(data)))
+        values[mapper._attribute_name] = mapper.pack(data)
+    return values
+
+
 class DataAttributeMapper:
     _order = 0
     # this can be used to force a subclass to be 'found' last
@@ -198,4 +212,4 @@ class NullAttributeMapper(DataAttributeMapper):
     def get(self, db_object):
         return None
 
-__all__ = ['get_data_of_unknown_type', 'set_data_of_unknown_type']
+__all__ = ['get_data_of_unknown_type', 'set_data_of_unknown_type', 'pack_data_of_unknown_type']
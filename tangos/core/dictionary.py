@@ -103,6 +103,29 @@ def get_or_create_dictionary_item(session, name):
     _dict_obj[session][name] = obj
     return obj
 
+def get_or_create_dictionary_ids(session, names):
+    """Return a dictionary mapping each of names to the id of its DictionaryItem, creating items where necessary.
+
+    Unlike get_or_create_dictionary_item, all names not already cached are looked up in a single query. As for that
+    function, this must be called while the database is locked under the specified session."""
+
+    if session not in _dict_obj:
+        _dict_obj[session] = {}
+    cache = _dict_obj[session]
+
+    missing = [name for name in set(names) if name not in cache]
+    if len(missing)>0:
+        for obj in session.query(DictionaryItem).filter(DictionaryItem.text.in_(missing)):
+            cache[obj.text] = obj
+
+    to_create = [name for name in missing if name not in cache]
+    if len(to_create)>0:
+        for name in to_create:
+            cache[name] = get_or_create_dictionary_item(session, name)
+        session.commit()
+
+    return {name: cache[name].id for name in names}
+
 def _get_dict_cache_for_session(session):
     session_dict = _dict_id.get(session, None)
     if session_dict is None:
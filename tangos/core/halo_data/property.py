@@ -15,7 +15,7 @@ class HaloProperty(Base):
     # n.b. backref defined below
     halo = relationship(SimulationObjectBase, cascade='',
                         backref=backref('all_properties',overlaps='properties,deprecated_properties',
-                                        cascade_backrefs=False, viewonly=True),
+                                        cascade_backrefs=False, viewonly=True, order_by='HaloProperty.id'),
                         overlaps='properties,deprecated_properties')
 
     data_float = Column(DOUBLE_PRECISION)
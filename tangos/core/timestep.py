@@ -1,6 +1,7 @@
 import os
 import os.path
 
+import numpy as np
 from sqlalchemy import Boolean, Column, ForeignKey, Integer, Text, and_
 from sqlalchemy.orm import Session, aliased, backref, relationship
 
@@ -45,6 +46,18 @@ class TimeStep(Base):
         handler = self.simulation.get_output_handler()
         return handler.load_timestep(self.extension, mode=mode)
 
+    def prefetch(self, mode=None, expected_number_of_queries=None):
+        handler = self.simulation.get_output_handler()
+        handler.prefetch_timestep(self.extension, mode=mode, expected_number_of_queries=expected_number_of_queries)
+
+    def cancel_prefetch(self, mode=None):
+        handler = self.simulation.get_output_handler()
+        handler.cancel_prefetch_timestep(self.extension, mode=mode)
+
+    def prefetch_regions(self, region_specifications, *args, **kwargs):
+        handler = self.simulation.get_output_handler()
+        handler.prefetch_regions(self.extension, region_specifications, *args, **kwargs)
+
     def load_region(self, region_specification, *args, **kwargs):
         handler = self.simulation.get_output_handler()
         return handler.load_region(self.extension, region_specification, *args, **kwargs)
@@ -167,6 +180,17 @@ class TimeStep(Base):
                 halo_alias = aliased(SimulationObjectBase, raw_query.limit(limit).subquery())
                 raw_query = session.query(halo_alias)
 
+            stored_columns = property_description.stored_columns()
+            if stored_columns is not None:
+                id_query = raw_query.with_entities(halo_alias.id).order_by(None)
+                if order_by_halo_number:
+                    id_query = id_query.order_by(halo_alias.halo_number)
+                id_query = id_query.order_by(halo_alias.id)
+                columnar_results = live_calculation.columnar.gather_stored_properties(id_query, stored_columns,
+                                                                                      self.simulation)
+                if columnar_results is not None:
+                    return self._columnar_results_to_calculation_results(*columnar_results, sanitize)
+
             query = property_description.supplement_halo_query(raw_query, halo_alias)
             sql_query_results = query.all()
             if sanitize:
@@ -178,6 +202,19 @@ class TimeStep(Base):
             session.close()
         return calculation_results
 
+    @staticmethod
+    def _columnar_results_to_calculation_results(values, found, sanitize):
+        """Convert the output of live_calculation.columnar into the form returned by calculate_all"""
+        if sanitize:
+            keep = np.all(found, axis=0)
+            if not np.any(keep):
+                return [np.empty(0, dtype=object) for _ in values]
+            return [v[keep] for v in values]
+        else:
+            results = np.array([v.astype(object) for v in values], dtype=object).reshape((len(values), -1))
+            results[~found] = None
+            return results
+
     def gather_property(self, *args, **kwargs):
         """The old alias for calculate_all, retained for compatibility"""
         return self.calculate_all(*args, **kwargs)
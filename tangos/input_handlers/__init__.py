@@ -127,6 +127,26 @@ class HandlerBase:
             _loaded_timesteps[ts_hash] = data
             return data
 
+    def prefetch_timestep(self, ts_extension, mode=None, expected_number_of_queries=None):
+        """Hint that the specified timestep will be loaded soon, so that loading can begin in the background.
+
+        The default implementation does nothing. The expected_number_of_queries parameter has the same meaning
+        as for load_region."""
+        pass
+
+    def cancel_prefetch_timestep(self, ts_extension, mode=None):
+        """Withdraw an earlier prefetch_timestep hint, because the timestep turned out not to be needed.
+
+        The default implementation does nothing."""
+        pass
+
+    def prefetch_regions(self, ts_extension, region_specifications, mode=None, expected_number_of_queries=None):
+        """Hint that the specified regions of a timestep will be loaded soon, so that they can be located together.
+
+        The default implementation does nothing. The expected_number_of_queries parameter has the same meaning
+        as for load_region."""
+        pass
+
     def load_region(self, ts_extension, region_specification, mode=None, expected_number_of_queries=None):
         """Returns an object that connects to the data for a timestep on disk, filtered using the
         specified region specification. Acceptable region specifications are output handler dependent.
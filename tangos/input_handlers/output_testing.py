@@ -67,6 +67,9 @@ class TestInputHandler(HandlerBase):
                                  float(self._get_ts_property(ts_extension, 'time')),
                                  int(self._get_ts_property(ts_extension, 'halos')))
 
+    def prefetch_regions(self, ts_extension, region_specifications, mode=None, expected_number_of_queries=None):
+        logger.info(f"prefetch_regions {len(region_specifications)} regions")
+
     def load_region(self, ts_extension, region_specification, mode=None, expected_number_of_queries=None):
         data = self.load_timestep(ts_extension)
         data.message = data.message[region_specification]
@@ -11,7 +11,7 @@ from collections import defaultdict
 import numpy as np
 from packaging.version import Version
 
-from ..util import proxy_object
+from ..util import cache_dict, memory, proxy_object
 
 pynbody = None # deferred import; occurs when a PynbodyInputHandler is constructed
 
@@ -97,17 +97,56 @@ class PynbodyInputHandler(finding.PatternBasedFileDiscovery, HandlerBase):
         else:
             raise NotImplementedError("Load mode %r is not implemented"%mode)
 
+    def prefetch_timestep(self, ts_extension, mode=None, expected_number_of_queries=None):
+        if mode in ('server', 'server-partial', 'server-shared-mem'):
+            from ..parallel_tasks import pynbody_server as ps
+            build_tree = expected_number_of_queries is not None and \
+                         expected_number_of_queries>config.pynbody_build_kdtree_threshold_count
+            ps.prefetch_remote_snapshot(self, ts_extension, shared_mem=(mode == 'server-shared-mem'),
+                                        build_tree=build_tree)
+
+    def cancel_prefetch_timestep(self, ts_extension, mode=None):
+        if mode in ('server', 'server-partial', 'server-shared-mem'):
+            from ..parallel_tasks import pynbody_server as ps
+            ps.cancel_remote_snapshot_prefetch(ts_extension)
+
     def _build_kdtree(self, timestep, mode):
         timestep.build_tree()
 
+    def prefetch_regions(self, ts_extension, region_specifications, mode=None, expected_number_of_queries=None):
+        if mode!='server-shared-mem':
+            return
+        timestep = self.load_timestep(ts_extension, mode)
+        if expected_number_of_queries is not None and expected_number_of_queries>config.pynbody_build_kdtree_threshold_count:
+            self._build_kdtree(timestep, mode)
+
+        # the index lists are kept in the timestep object, so that they are discarded when it is unloaded
+        if not hasattr(timestep, '_tangos_prefetched_region_indices'):
+            timestep._tangos_prefetched_region_indices = {}
+        prefetched = timestep._tangos_prefetched_region_indices
+        cached = getattr(timestep, '_tangos_cached_regions', {})
+
+        region_specifications = [r for r in dict.fromkeys(region_specifications)
+                                 if r not in prefetched and (r, mode) not in cached]
+        index_lists = timestep.get_region_index_lists(region_specifications)
+        prefetched.update(zip(region_specifications, index_lists))
+
     def load_region(self, ts_extension, region_specification, mode=None, expected_number_of_queries=None) -> pynbody.snapshot.simsnap.SimSnap:
         timestep = self.load_timestep(ts_extension, mode)
 
-        timestep._tangos_cached_regions = getattr(timestep, '_tangos_cached_regions', {})
+        if config.pynbody_region_cache_size == 0:
+            return self._load_region_uncached(timestep, ts_extension, region_specification, mode,
+                                              expected_number_of_queries)
+
+        if not hasattr(timestep, '_tangos_cached_regions'):
+            timestep._tangos_cached_regions = cache_dict.SizeBoundedCacheDict(
+                max_entries=config.pynbody_region_cache_size, sizeof=memory.estimate_pynbody_snapshot_size,
+                memory_governed=True, name="regions")
 
         key = (region_specification, mode)
 
         # we store a cache in the timestep object, so that it is automatically cleared when the timestep is
+        # unloaded
         if key in timestep._tangos_cached_regions:
             return timestep._tangos_cached_regions[key]
 
@@ -124,8 +163,10 @@ class PynbodyInputHandler(finding.PatternBasedFileDiscovery, HandlerBase):
         elif mode=='server':
             return timestep.get_view(region_specification)
         elif mode=='server-shared-mem':
-            from ..parallel_tasks import pynbody_server as ps
             simsnap = timestep.shared_mem_view
+            index_list = getattr(timestep, '_tangos_prefetched_region_indices', {}).pop(region_specification, None)
+            if index_list is not None:
+                return simsnap[index_list].get_copy_on_access_simsnap()
             return simsnap[region_specification].get_copy_on_access_simsnap()
         elif mode=='server-partial':
             load_index = timestep.get_index_list(region_specification)
@@ -5,14 +5,7 @@ For more overview information, see live_calculation.md. """
 import warnings
 
 import numpy as np
-from sqlalchemy.orm import (
-    Load,
-    aliased,
-    contains_eager,
-    defaultload,
-    joinedload,
-    undefer,
-)
+from sqlalchemy.orm import Load, joinedload, lazyload, selectinload, undefer
 
 import tangos.core.dictionary
 import tangos.core.halo
@@ -229,78 +222,69 @@ class Calculation:
         return 1
 
     def supplement_halo_query(self, halo_query, halo_alias=None):
-        """Return a sqlalchemy query with a supplemental join to allow this calculation to run efficiently
+        """Return a sqlalchemy query with supplemental loading options to allow this calculation to run efficiently
 
         halo_query: The query that returns the simulation objects on which calculations are going to be made
-        halo_alias: The alias for the simulation object class being referenced (or None to use SimulationObjectBase)"""
+        halo_alias: The alias for the simulation object class being referenced (or None to use SimulationObjectBase)
+
+        The properties and links of the simulation objects (and, for each join level, of the objects they link to) are
+        loaded by separate queries for each relationship and level. Loading them through joins would instead return
+        (number of properties) x (number of links) rows for each object at each level."""
         name_targets = self.retrieves_dict_ids()
         if halo_alias is None:
             halo_alias = tangos.core.halo.SimulationObjectBase
-        augmented_query = halo_query
-        order_bys = []
+        halo_class = halo_alias
         load_options = Load(halo_alias)
+        HaloProperty = tangos.core.halo_data.HaloProperty
+        HaloLink = tangos.core.halo_data.HaloLink
 
-        for i in range(self.n_join_levels()):
-            halo_property_alias = aliased(tangos.core.halo_data.HaloProperty)
-            halo_link_alias = aliased(tangos.core.halo_data.HaloLink)
-
-            if len(name_targets)>0:
-                property_name_condition = halo_property_alias.name_id.in_(name_targets)
-                link_name_condition = (halo_link_alias.relation_id.in_(name_targets))
-            else:
-                # We know we're joining to a null list of properties; however simply setting these conditions
-                # to False results in an apparently efficient SQL query (boils down to 0==1) which actually
-                # takes a very long time to execute if the link or propery tables are large. Thus, compare
-                # to an impossible value instead.
-                property_name_condition = halo_property_alias.name_id==-1
-                link_name_condition = halo_link_alias.relation_id==-1
-
-
-            augmented_query =augmented_query.outerjoin(halo_property_alias,
-                                                  (halo_alias.id==halo_property_alias.halo_id)
-                                                  & property_name_condition).\
-                                        outerjoin(halo_link_alias,
-                                                  (halo_alias.id==halo_link_alias.halo_from_id)
-                                                  & link_name_condition)
+        if len(name_targets)>0:
+            property_name_condition = HaloProperty.name_id.in_(name_targets)
+            link_name_condition = HaloLink.relation_id.in_(name_targets)
+        else:
+            # We know we're loading a null list of properties; however simply setting these conditions
+            # to False results in an apparently efficient SQL query (boils down to 0==1) which actually
+            # takes a very long time to execute if the link or propery tables are large. Thus, compare
+            # to an impossible value instead.
+            property_name_condition = HaloProperty.name_id==-1
+            link_name_condition = HaloLink.relation_id==-1
 
+        for i in range(self.n_join_levels()):
             # use the options to make sure all the halo property information is available
             load_options = load_options.options(
-                contains_eager(halo_alias.all_properties.of_type(halo_property_alias)).options(
-                    joinedload(halo_property_alias.name),
-                    contains_eager(halo_property_alias.halo.of_type(halo_alias)),
-                    undefer(halo_property_alias.data_array)
+                selectinload(halo_class.all_properties.and_(property_name_condition)).options(
+                    joinedload(HaloProperty.name),
+                    lazyload(HaloProperty.halo), # found in the identity map without a query, even under raiseload('*')
+                    undefer(HaloProperty.data_array)
                 )
             )
 
-            order_bys += [halo_link_alias.id, halo_property_alias.id]
-
-            # now set up the next level of halos
-            next_level_halo_alias = aliased(tangos.core.halo.SimulationObjectBase)
-            augmented_query = augmented_query.outerjoin(next_level_halo_alias,
-                                                        (halo_link_alias.halo_to_id==next_level_halo_alias.id))
-
             # prepare for next level by following the halo link into the new halo. Along the way make sure we
             # load the 'relation' property of the link, and the timestep of the new halo.
-            load_options = load_options.contains_eager(
-                halo_alias.all_links.of_type(halo_link_alias)
+            load_options = load_options.selectinload(
+                halo_class.all_links.and_(link_name_condition)
             ).options(
-                joinedload(halo_link_alias.relation)
-            ).contains_eager(
-                halo_link_alias.halo_to.of_type(next_level_halo_alias)
-            ).options(joinedload(next_level_halo_alias.timestep))
+                joinedload(HaloLink.relation)
+            ).joinedload(
+                HaloLink.halo_to
+            ).options(joinedload(tangos.core.halo.SimulationObjectBase.timestep))
 
             # ready to process the next level of halos!
-            halo_alias = next_level_halo_alias
-
+            halo_class = tangos.core.halo.SimulationObjectBase
 
-
-        augmented_query = augmented_query.order_by(*order_bys).options(load_options)
-        return augmented_query
+        return halo_query.options(load_options)
 
     def proxy_value(self):
         """Return a placeholder value for this calculation"""
         raise NotImplementedError
 
+    def stored_columns(self):
+        """Return a list of the StoredProperty that provides each column, or None if the columns are not all
+        single stored values.
+
+        If a list is returned, the values can be gathered directly from the property table (see columnar.py)"""
+        return None
+
     @staticmethod
     def _add_entries_for_duplicates(target_objs, target_ids):
         """Given a list of target_objs and their target_ids, the latter of which may contain duplicates, return the full list of objects
@@ -318,6 +302,7 @@ class MultiCalculation(Calculation):
     def __init__(self, *calculations):
         super().__init__()
         self.calculations = [c if isinstance(c, Calculation) else parser.parse_property_name(c) for c in calculations]
+        self._cse_cached = None
 
     def retrieves(self):
         x = set()
@@ -330,21 +315,84 @@ class MultiCalculation(Calculation):
 
     def values_and_description(self, halos):
         results = np.empty((self.n_columns(),len(halos)), dtype=object)
-        c_column = 0
         halos = np.asarray(halos, dtype=object)
         mask = QueryMask()
         mask.mark_nones_as_masked(halos)
-        for c in self.calculations:
-            values, description = c.values_and_description(mask.mask(halos))
-            results[c_column:c_column+c.n_columns()] = mask.unmask(values)
+
+        units, sources = self._common_subexpressions_eliminated()
+        unit_results = []
+        unit_descriptions = []
+        for unit in units:
+            values, description = unit.values_and_description(mask.mask(halos))
+            unit_values = np.empty((unit.n_columns(), len(halos)), dtype=object)
+            unit_values[:] = mask.unmask(values)
+            unit_results.append(unit_values)
+            unit_descriptions.append(description)
+
+        c_column = 0
+        for c, (unit_index, offset) in zip(self.calculations, sources):
+            results[c_column:c_column+c.n_columns()] = unit_results[unit_index][offset:offset+c.n_columns()]
             c_column+=c.n_columns()
 
         # TODO - problem: there is no good description of multiple properties
-        return results, description
+        return results, unit_descriptions[sources[-1][0]] if len(sources)>0 else None
+
+    def _common_subexpressions_eliminated(self):
+        """Return the calculations that must actually be evaluated to produce the results of this calculation.
+
+        Calculations that appear more than once (e.g. later(5).Mvir in both the first and third columns) are evaluated
+        only once, and links that follow the same locator (e.g. later(5).Mvir, later(5).Rvir) are combined into a single
+        link, so that the locator is evaluated, and the linked objects retrieved, only once.
+
+        Returns (units, sources) where units is the list of calculations to be evaluated and, for each calculation in
+        self.calculations, sources gives the index of the unit providing its results, and the first column of its
+        results within that unit."""
+        if self._cse_cached is not None:
+            return self._cse_cached
+
+        # ordered by last appearance, so that the final calculation is the last in its unit and the unit's
+        # description is therefore that of the final calculation, as it would be without elimination
+        distinct = {}
+        for c in self.calculations:
+            distinct.pop(str(c), None)
+            distinct[str(c)] = c
+
+        groups = {}
+        for key, c in distinct.items():
+            if type(c) is Link and c._is_plain_link():
+                group_key = ("link", str(c.locator))
+            else:
+                group_key = ("calculation", key)
+            groups.setdefault(group_key, []).append(c)
+
+        units = []
+        locations = {}
+        for members in groups.values():
+            if len(members)==1:
+                units.append(members[0])
+                locations[str(members[0])] = (len(units)-1, 0)
+            else:
+                units.append(Link(members[0].locator, MultiCalculation(*[m.property for m in members])))
+                offset = 0
+                for m in members:
+                    locations[str(m)] = (len(units)-1, offset)
+                    offset+=m.n_columns()
+
+        self._cse_cached = units, [locations[str(c)] for c in self.calculations]
+        return self._cse_cached
 
     def n_columns(self):
         return sum(c.n_columns() for c in self.calculations)
 
+    def stored_columns(self):
+        columns = []
+        for c in self.calculations:
+            c_columns = c.stored_columns()
+            if c_columns is None:
+                return None
+            columns+=c_columns
+        return columns
+
 
 class FixedInput(Calculation):
     """Represents a calculation that returns a fixed value"""
@@ -448,18 +496,44 @@ class LiveProperty(Calculation):
         calculator = properties.providing_class(self.name())(sim, *input_descriptions)
         timestep_ordering = np.argsort([h.timestep.id for h in halos])
         results = [None for i in range(len(halos))]
+        batch = calculator.supports_batch_live_calculation()
+        batch_indices = []
         current_ts = None
         for i in timestep_ordering:
             inputs = [input[i] for input in input_values]
             halo = halos[i]
             if self._has_required_properties(halo) and all([x is not None for x in inputs]):
                 if halo.timestep != current_ts:
+                    self._live_calculate_batch(calculator, halos, input_values, batch_indices, results)
+                    batch_indices = []
                     current_ts = halo.timestep
                     calculator.preloop(None, current_ts)
-                results[i] = calculator.live_calculate_named(self.name(), halo, *inputs)
+                if batch:
+                    batch_indices.append(i)
+                else:
+                    results[i] = calculator.live_calculate_named(self.name(), halo, *inputs)
+        self._live_calculate_batch(calculator, halos, input_values, batch_indices, results)
 
         return calculator, self._as_1xn_array(results)
 
+    def _live_calculate_batch(self, calculator, halos, input_values, indices, results):
+        """Fill in results[indices] (all in one timestep) using calculator.live_calculate_batch, or one object at a
+        time if the calculator cannot handle the batch"""
+        if len(indices)==0:
+            return
+        batch_halos = [halos[i] for i in indices]
+        try:
+            batch_results = calculator.live_calculate_batch(self.name(), batch_halos,
+                                                            *[self._make_numpy_array(np.asarray(input)[indices])
+                                                              for input in input_values])
+        except NotImplementedError:
+            batch_results = [calculator.live_calculate_named(self.name(), halos[i], *[input[i] for input in input_values])
+                             for i in indices]
+        if len(batch_results)!=len(indices):
+            raise ValueError("live_calculate_batch returned %d results for %d objects"%(len(batch_results), len(indices)))
+        for i, result in zip(indices, batch_results):
+            results[i] = result
+
     @classmethod
     def _as_1xn_array(cls, results):
         results_array = np.empty((1, len(results)), dtype=object)
@@ -613,6 +687,10 @@ class Link(Calculation):
     def set_constraints_columns(self, columns=[]):
         self._constraints_columns = columns
 
+    def _is_plain_link(self):
+        """Return True if this link takes the first target found, as for links generated by the parser"""
+        return self._multi_selection_basis=='first' and len(self._constraints_columns)==0
+
     def n_columns(self):
         return self.property.n_columns()
 
@@ -721,7 +799,6 @@ class StoredProperty(Calculation):
         return ret
 
     def values_and_description(self, halos):
-        from .. import properties
         values = self.values(halos)
         if len(halos)==0:
             # cannot build a meaningful property description as we don't have any halos, therefore don't know
@@ -729,23 +806,37 @@ class StoredProperty(Calculation):
             return values, None
 
         sim = consistent_collection.consistent_simulation_from_halos(halos)
-        description_class = properties.providing_class(self._name, sim.output_handler_class, silent_fail=True)
+        return values, self.description(sim)
+
+    def description_class(self, simulation):
+        """Return the class providing this property for the given simulation, or None if there is no such class"""
+        from .. import properties
+        return properties.providing_class(self._name, simulation.output_handler_class, silent_fail=True)
+
+    def description(self, simulation):
+        """Return an instance of the class providing this property for the given simulation, or None if unavailable"""
+        description_class = self.description_class(simulation)
         description = None
         if description_class is not None:
             try:
-                description = description_class(sim)
+                description = description_class(simulation)
             except Exception as e:
                 warnings.warn("%r occurred while trying to produce a property description from class %r"%
                               (e,description_class),
                               RuntimeWarning)
-        return values, description
+        return description
 
     def proxy_value(self):
         """Return a placeholder value for this calculation"""
         return UnknownValue(self._name)
 
+    def stored_columns(self):
+        if self._multivalued or type(self._extraction_pattern) is not extraction_patterns.HaloPropertyValueGetter:
+            return None
+        return [self]
+
 
 
 
 
-from . import builtin_functions, parser
+from . import builtin_functions, columnar, parser
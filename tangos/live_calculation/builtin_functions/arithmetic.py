@@ -85,6 +85,11 @@ def power(halos, vals1, vals2):
     return arithmetic_binary_op(vals1, vals2, np.power)
 
 def arithmetic_binary_op(vals1, vals2, op):
+    floats1, valid1 = _as_float_column(vals1)
+    floats2, valid2 = _as_float_column(vals2)
+    if floats1 is not None and floats2 is not None:
+        return _unmask_column(op(floats1, floats2), valid1 & valid2)
+
     results = []
     for v1,v2 in zip(vals1, vals2):
         if v1 is not None and v2 is not None:
@@ -97,6 +102,10 @@ def arithmetic_binary_op(vals1, vals2, op):
     return results
 
 def arithmetic_unary_op(vals1, op):
+    floats1, valid1 = _as_float_column(vals1)
+    if floats1 is not None:
+        return _unmask_column(op(floats1), valid1)
+
     results = []
     for v1 in vals1:
         if v1 is not None:
@@ -106,3 +115,23 @@ def arithmetic_unary_op(vals1, op):
             result = None
         results.append(result)
     return results
+
+_SCALAR_TYPES = (float, int, np.floating, np.integer, np.bool_, type(None))
+
+def _as_float_column(vals):
+    """If every value is a scalar number or None, return the values as a float array together with a mask that is
+    False where the value is None. Otherwise return None, None; the values must then be processed one by one."""
+    if not all(issubclass(t, _SCALAR_TYPES) for t in set(map(type, vals))):
+        return None, None
+    vals = np.asarray(vals, dtype=object)
+    with np.errstate(invalid='ignore'):
+        return vals.astype(float), vals!=None
+
+def _unmask_column(result, valid):
+    """Convert the result of an operation on float arrays back to a column of values, with None where invalid.
+
+    The values are numpy scalars, exactly as when the operation is applied to one value at a time."""
+    with_nones = np.empty(len(result), dtype=object)
+    with_nones[:] = list(result)
+    with_nones[~valid] = None
+    return with_nones
@@ -0,0 +1,92 @@
+"""Gathering of stored scalar properties for a whole set of objects without constructing ORM objects.
+
+TimeStep.calculate_all uses this when every column of the calculation is a single stored property (e.g.
+calculate_all("Mvir", "Rvir")). Rather than joining all the properties onto the objects and then scanning each
+object's property collection, the values are selected in one query and scattered into numpy arrays.
+"""
+
+import numpy as np
+from sqlalchemy import case, func
+
+from .. import core
+
+_MISSING, _FLOAT, _INT = 0, 1, 2
+
+def gather_stored_properties(object_id_query, stored_properties, simulation):
+    """Return the values of the stored properties for the objects returned by object_id_query
+
+    :param object_id_query: sqlalchemy query returning the ids of the objects, in the order required
+    :param stored_properties: list of StoredProperty calculations, one per column (see Calculation.stored_columns)
+    :param simulation: the simulation to which the objects belong
+
+    Returns (values, found) where values is a list with one numpy array per column and found is a boolean array of
+    shape len(stored_properties) x number of objects, indicating which entries in the values have been retrieved.
+    For consistency with the ORM route, the earliest value is taken where an object has more than one value stored
+    for the same property.
+
+    Returns None if any property cannot be gathered in this way, i.e. if some of its values are not scalars or if its
+    values would be transformed by a reassemble method; the caller should then fall back to the general route."""
+    for p in stored_properties:
+        if hasattr(p.description_class(simulation), 'reassemble'):
+            return None
+
+    session = object_id_query.session
+    object_ids = np.array([row[0] for row in object_id_query.all()], dtype=np.int64)
+
+    if len(object_ids)>0:
+        for p in stored_properties:
+            p.description(simulation) # for the same warnings about broken property classes as the ORM route
+
+    name_ids = [core.dictionary.get_dict_id(p.name(), default=None) for p in stored_properties]
+    known_name_ids = [n for n in name_ids if n is not None]
+
+    if len(object_ids)>0 and len(known_name_ids)>0:
+        rows = _query_scalar_rows(session, object_id_query.subquery(), known_name_ids)
+    else:
+        rows = []
+
+    columns = list(zip(*rows)) if len(rows)>0 else [()]*5
+    row_object_ids, row_name_ids, row_kinds, row_ints = (np.array(c, dtype=np.int64) for c in
+                                                         (columns[0], columns[1], columns[2], columns[4]))
+    row_floats = np.array(columns[3], dtype=np.float64) # non-float entries become NaN, and are never selected
+
+    order = np.argsort(object_ids, kind='stable')
+    sorted_object_ids = object_ids[order]
+
+    values = []
+    found = np.zeros((len(stored_properties), len(object_ids)), dtype=np.bool_)
+
+    for i, name_id in enumerate(name_ids):
+        selected = np.flatnonzero(row_name_ids==name_id)
+        # rows are in order of creation, so the first row for each object is the one the ORM route would return
+        _, first = np.unique(row_object_ids[selected], return_index=True)
+        selected = selected[first]
+        kinds = row_kinds[selected]
+
+        if np.all(kinds==_FLOAT):
+            column = np.zeros(len(object_ids), dtype=np.float64)
+            selected_values = row_floats[selected]
+        elif np.all(kinds==_INT):
+            column = np.zeros(len(object_ids), dtype=np.int64)
+            selected_values = row_ints[selected]
+        else:
+            # arrays, or a mixture of types that the ORM route would coerce according to the first object
+            return None
+
+        targets = order[np.searchsorted(sorted_object_ids, row_object_ids[selected])]
+        column[targets] = selected_values
+        found[i, targets] = True
+        values.append(column)
+
+    return values, found
+
+def _query_scalar_rows(session, object_ids, name_ids):
+    HaloProperty = core.halo_data.HaloProperty
+    kind = case((HaloProperty.data_float.isnot(None), _FLOAT),
+                (HaloProperty.data_int.isnot(None), _INT),
+                else_=_MISSING)
+    return session.query(HaloProperty.halo_id, HaloProperty.name_id, kind,
+                         HaloProperty.data_float, func.coalesce(HaloProperty.data_int, 0)).\
+        join(object_ids, HaloProperty.halo_id==object_ids.c.id).\
+        filter(HaloProperty.name_id.in_(name_ids)).\
+        order_by(HaloProperty.id).all()
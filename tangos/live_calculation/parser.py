@@ -16,9 +16,28 @@ from . import (
 )
 
 
+PLAN_CACHE_SIZE = 1024
+
+
+class CalculationPlan:
+    """Records how to construct a Calculation, as recognised by the parser.
+
+    Calculation objects cache state that depends on the database (e.g. dictionary ids), so they cannot be re-used
+    between calls. Instead the parser generates these immutable plans, which are cached by expression and built into
+    a fresh Calculation each time the expression is parsed."""
+    __slots__ = ("constructor", "args")
+
+    def __init__(self, constructor, args):
+        self.constructor = constructor
+        self.args = tuple(args)
+
+    def build(self):
+        return self.constructor(*[a.build() if isinstance(a, CalculationPlan) else a for a in self.args])
+
+
 def pack_args(for_function):
-    """Return a version of for_function that takes a single argument instead of multiple arguments"""
-    return lambda t: for_function(*t)
+    """Return a parse action that generates the plan for calling for_function with the parsed tokens"""
+    return lambda t: CalculationPlan(for_function, t)
 
 
 pp.ParserElement.enable_packrat()
@@ -46,7 +65,7 @@ IN_OPS_PYPARSING = []
 UNARY_OPS_PYPARSING = []
 
 def generate_property_from_inop(opFunctionName, tokens):
-    return LiveProperty(opFunctionName, *tokens[0])
+    return CalculationPlan(LiveProperty, (opFunctionName, *tokens[0]))
 
 for opSymbol, opFunctionName in IN_OPS:
     opGeneration = functools.partial(generate_property_from_inop, opFunctionName)
@@ -96,10 +115,14 @@ array_element << ((live_calculation_property | stored_property) + element_identi
 property_complete = pp.string_start()+value_or_property_name+pp.string_end()
 
 
-def parse_property_name( name):
+@functools.lru_cache(maxsize=PLAN_CACHE_SIZE)
+def _plan_for_property_name(name):
     with _parsing_lock:
         return property_complete.parse_string(name)[0]
 
+def parse_property_name( name):
+    return _plan_for_property_name(name).build()
+
 def parse_property_name_if_required(name):
     if isinstance(name, Calculation):
         return name
@@ -12,7 +12,7 @@ _num_procs = None # only for multiprocessing backend
 _on_exit = [] # list of functions to call when parallelism is shutting down
 
 from .. import log
-from . import accumulative_statistics, jobs, message
+from . import accumulative_statistics, groups, jobs, message
 
 
 def use(name):
@@ -43,6 +43,7 @@ def init_backend():
 def deinit_backend():
     global backend
     backend = None
+    groups.use_server_groups(None)
 
 def parallelism_is_active():
     global _backend_name
@@ -84,13 +85,19 @@ def launch(function, args=None, backend_kwargs=None):
 
     return result
 
-def distributed(items, allow_resume=False, resumption_id=None):
+def distributed(items, allow_resume=False, resumption_id=None, max_batch_size=None, within_group=False):
     """Return an iterator that consumes the items, distributed across all processors
     (i.e. each item is consumed by only one processor, in a dynamic way).
 
     Optionally, if allow_resume is True, then the iterator will resume from the last point it reached
     provided argv and the stack trace are unchanged. If resumption_id is not None, then
-    the stack trace is ignored and only resumption_id needs to match."""
+    the stack trace is ignored and only resumption_id needs to match.
+
+    Each processor fetches up to max_batch_size items per request to the server, defaulting to
+    config.max_jobs_per_request.
+
+    If within_group is True and server groups are in use (see groups.py), the items are distributed only across
+    the workers in this processor's group."""
 
     if type(items) == set:
         items = list(items)
@@ -99,7 +106,22 @@ def distributed(items, allow_resume=False, resumption_id=None):
         return items
     else:
         from . import jobs
-        return jobs.distributed_iterate(items, allow_resume, resumption_id)
+        return jobs.distributed_iterate(items, allow_resume, resumption_id, max_batch_size, within_group)
+
+def distributed_to_groups(items, allow_resume=False, resumption_id=None):
+    """Return an iterator that consumes the items, distributed across server groups (see groups.py)
+    so that each item is consumed by all the workers of one group.
+
+    If server groups are not in use, all workers form a single group and so consume all the items."""
+
+    if type(items) == set:
+        items = list(items)
+
+    if _backend_name=='null':
+        return items
+    else:
+        from . import jobs
+        return jobs.group_distributed_iterate(items, allow_resume, resumption_id)
 
 def synchronized(items, allow_resume=False, resumption_id=None):
     """Return an iterator that consumes all items on all processors.
@@ -127,8 +149,13 @@ def _exec_function_or_server(function, connection_info, args):
 
     if backend.rank()==0:
         _server_thread()
+        jobs.IterationState.compact_journal()
+    elif groups.is_group_server():
+        groups.run_group_server()
+        MessageExit().send(0)
     else:
         function(*args)
+        groups.release_group_server()
         MessageExit().send(0)
     core.close_db()
     _shutdown_parallelism()
@@ -143,6 +170,11 @@ def _server_thread():
     from .async_message import init_async_processing_thread
     init_async_processing_thread() # uses on_exit_parallelism to ensure thread is cleared up
 
+    if config.server_concurrent_dispatch:
+        from .dispatch import MessageDispatcher
+        MessageDispatcher(MessageExit).run()
+        return
+
     alive = [True for i in range(backend.size())]
 
     while any(alive[1:]):
@@ -173,5 +205,5 @@ def _shutdown_parallelism():
 
 
 from . import async_message, remote_import, shared_set
-from .barrier import barrier
+from .barrier import barrier, group_barrier
 from .lock import ExclusiveLock
@@ -3,12 +3,14 @@ from threading import Thread
 
 from .. import config
 from ..log import logger
-from . import on_exit_parallelism
+from . import dispatch, on_exit_parallelism
 from .message import Message
 
 
 class AsyncProcessedMessage(Message):
     _async_task_queue = queue.Queue()
+    dispatch_lane = dispatch.MAIN_THREAD
+
     def process_async(self):
         """Override to provide the processing/response mechanism, that will be performed in a separate thread"""
         raise NotImplementedError()
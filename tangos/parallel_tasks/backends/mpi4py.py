@@ -1,14 +1,42 @@
+import threading
 import warnings
 
 import numpy as np
 from mpi4py import MPI
 
-comm = MPI.COMM_WORLD
+try:
+    # pickle protocol 5, sending numpy arrays (including those inside messages) as out-of-band buffers
+    # rather than copying them into the pickle; available from mpi4py 3.1
+    from mpi4py.util import pkl5
+except ImportError:
+    pkl5 = None
+
+if pkl5 is None:
+    comm = MPI.COMM_WORLD
+else:
+    comm = pkl5.Intracomm(MPI.COMM_WORLD)
+
+_pending_sends = [] # requests for sends that may not yet have completed
+_pending_sends_lock = threading.Lock()
 
 def send(data, destination, tag=0):
-    comm.send(data, dest=destination, tag = tag)
+    # Sends do not block, so that e.g. the server can send a response and the arrays that follow it without
+    # waiting for each to be received. The request (which also keeps the data alive) is held until the send
+    # completes. Since numpy arrays are sent straight from their own memory, all sends are completed before this
+    # process receives anything (see receive_any and receive), after which the sent data may change again.
+    request = comm.isend(data, dest=destination, tag=tag)
+    with _pending_sends_lock:
+        _pending_sends.append(request)
+        _pending_sends[:] = [r for r in _pending_sends if not r.test()[0]]
+
+def _complete_pending_sends():
+    with _pending_sends_lock:
+        for r in _pending_sends:
+            r.wait()
+        _pending_sends.clear()
 
 def receive_any(source=None):
+    _complete_pending_sends()
     status = MPI.Status()
     if source is None:
         source = MPI.ANY_SOURCE
@@ -16,6 +44,7 @@ def receive_any(source=None):
     return data, status.source, status.tag
 
 def receive(source=None, tag=0):
+    _complete_pending_sends()
     if source is None:
         source = MPI.ANY_SOURCE
     return comm.recv(source=source,tag=tag)
@@ -25,6 +54,16 @@ def _get_dtype_code(numpy_dtype):
     return numpy_dtype.char
 
 def send_numpy_array(data, destination):
+    if pkl5 is not None:
+        # the array's memory is sent directly from its out-of-band buffer. An array that does not own its memory
+        # (e.g. a view into a snapshot, or into shared memory) could be changed by other code before the send
+        # completes, so it is copied first.
+        data = np.asarray(data)
+        if not data.flags.owndata:
+            data = data.copy()
+        send(data, destination, tag=1)
+        return
+
     comm.send((data.shape, data.dtype), dest=destination, tag=1)
     # made necessary by strange bug with hdf arrays, similar to: https://groups.google.com/forum/#!topic/mpi4py/8gOVvT4ObvU
     # when sending without an explicit dtype code, sometimes get a KeyError
@@ -32,6 +71,9 @@ def send_numpy_array(data, destination):
     comm.Send([data, dtype_code], dest=destination, tag=2)
 
 def receive_numpy_array(source):
+    if pkl5 is not None:
+        return receive(source, tag=1)
+
     shape,dtype = comm.recv(source=source, tag=1)
     ar = np.empty(shape,dtype=dtype)
     comm.Recv(ar,source=source,tag=2)
@@ -44,9 +86,11 @@ def size():
     return comm.Get_size()
 
 def barrier():
+    _complete_pending_sends()
     comm.Barrier()
 
 def finalize():
+    _complete_pending_sends()
     MPI.Finalize()
 
 
@@ -2,10 +2,19 @@
 
 This implements an MPI-like interface using a 'manager' process which relays messages between worker processes.
 Messages are thus sent and received using a star-like topology, but this should be transparent to the user.
+The exception is traffic to and from rank 0 (the tangos server), which is by far the busiest, and so has a direct
+pipe to every other rank.
+
+Each process runs a thread that reads incoming messages as soon as they arrive, so that pipes never fill up. Messages
+are held (still pickled) in a queue for each source and tag until they are asked for. Large numpy arrays are not
+pickled at all; they are copied into a shared memory block, and only a description of the block goes down the pipe.
 """
 
+import collections
 import multiprocessing
+import multiprocessing.connection
 import multiprocessing.resource_tracker
+import multiprocessing.shared_memory
 import os
 import pickle
 import select
@@ -16,6 +25,7 @@ import threading
 import time
 from typing import Optional
 
+import numpy as np
 import tblib.pickling_support
 
 from ...log import logger
@@ -23,14 +33,18 @@ from ...log import logger
 _slave = False
 _rank = None
 _size = None
-_pipe = None
-_recv_lock = None
-_recv_buffer = []
+_pipe = None # connection to the manager process
+_direct_pipes = {} # rank -> connection, for the ranks that can be reached without going through the manager
+_received = None # condition variable, notified whenever a message arrives
+_recv_queues = {} # (source, tag) -> deque of (arrival number, pickled message)
+_num_received = 0
 
 _print_exceptions = True
 
-send_lock = threading.Lock() # a lock to make sure if multiple threads are running, only one can send/receive at a time
-receive_lock = threading.Lock()
+send_lock = threading.Lock() # a lock to make sure if multiple threads are running, only one can send at a time
+
+# Arrays smaller than this are pickled like any other message, since setting up shared memory has its own overhead
+SHARED_MEMORY_MIN_BYTES = 65536
 
 # Compatibility fix for python >=3.8 on MacOS, where the default process start
 # method changed:
@@ -44,58 +58,117 @@ class NoMatchingItem(Exception):
 
 
 def send(data, destination, tag=0):
+    payload = pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL)
     with send_lock:
-        payload = pickle.dumps(data)
-        header = struct.pack("ii", destination, tag)
-        _pipe.send_bytes(header+payload)
+        if destination in _direct_pipes:
+            _direct_pipes[destination].send_bytes(struct.pack("ii", _rank, tag)+payload)
+        else:
+            _pipe.send_bytes(struct.pack("ii", destination, tag)+payload)
 
 def receive_any(source=None):
     return receive(source,None,True)
 
 
 def receive(source=None, tag=0, return_tag=False):
-    with receive_lock:
+    with _received:
         while True:
             try:
-                item = _pop_first_match_from_reception_buffer(source, tag)
-                if return_tag:
-                    return item
-                else:
-                    return item[0]
+                payload, source, tag = _pop_first_match_from_reception_buffer(source, tag)
+                break
             except NoMatchingItem:
-                _receive_item_into_buffer()
+                _received.wait()
+
+    # unpickle only now, so that classes (e.g. from a module imported in response to an earlier message) are
+    # looked up in the order the messages are processed, not the order they arrive
+    data = pickle.loads(payload)
+    if return_tag:
+        return data, source, tag
+    else:
+        return data
 
 
 NUMPY_SPECIAL_TAG = 1515
 
+class SharedMemoryArrayDescription(collections.namedtuple("SharedMemoryArrayDescription", ("name", "shape", "dtype"))):
+    """Describes a numpy array that has been placed in a shared memory block for collection by another process"""
+    pass
+
 def send_numpy_array(data, destination):
-    send(data,destination,tag=NUMPY_SPECIAL_TAG)
+    data = np.asarray(data)
+    if data.nbytes < SHARED_MEMORY_MIN_BYTES or data.dtype.hasobject:
+        send(data, destination, tag=NUMPY_SPECIAL_TAG)
+        return
+
+    block = multiprocessing.shared_memory.SharedMemory(create=True, size=data.nbytes)
+    try:
+        np.ndarray(data.shape, dtype=data.dtype, buffer=block.buf)[...] = data
+    finally:
+        block.close()
+    # the receiving process now becomes responsible for unlinking the block
+    send(SharedMemoryArrayDescription(block.name, data.shape, data.dtype), destination, tag=NUMPY_SPECIAL_TAG)
 
 def receive_numpy_array(source):
-    return receive(source,tag=NUMPY_SPECIAL_TAG)
+    data = receive(source,tag=NUMPY_SPECIAL_TAG)
+    if not isinstance(data, SharedMemoryArrayDescription):
+        return data
+
+    block = multiprocessing.shared_memory.SharedMemory(name=data.name)
+    try:
+        result = np.empty(data.shape, dtype=data.dtype)
+        result[...] = np.ndarray(data.shape, dtype=data.dtype, buffer=block.buf)
+    finally:
+        block.close()
+        block.unlink()
+    return result
 
 def _pop_first_match_from_reception_buffer(source, tag):
-    for item in _recv_buffer:
-        if ((item[2] == tag or tag is None) and (item[1] == source or source is None)):
-            # consume item
-            _recv_buffer.remove(item)
-            return item
-
-    raise NoMatchingItem()
-
-def _receive_item_into_buffer():
-    if _recv_lock.acquire(False):
-        try:
-            message = _pipe.recv_bytes()
-            source, tag = struct.unpack("ii", message[:8])
-            payload = pickle.loads(message[8:])
-            _recv_buffer.append((payload, source, tag))
-        finally:
-            _recv_lock.release()
+    """Remove and return the earliest received (payload, source, tag) matching source and tag (None matches any)
+
+    Must be called with _received held."""
+    if source is not None and tag is not None:
+        key = (source, tag)
     else:
-        # block until a data item has been received by another thread
-        _recv_lock.acquire()
-        _recv_lock.release()
+        key = _first_matching_key(source, tag)
+
+    queue = _recv_queues.get(key, None)
+    if not queue:
+        raise NoMatchingItem()
+
+    _, payload = queue.popleft()
+    if len(queue)==0:
+        del _recv_queues[key]
+    return payload, key[0], key[1]
+
+def _first_matching_key(source, tag):
+    # arrays are only ever collected by receive_numpy_array, so a receive for any tag must not pick one up (e.g. an
+    # array from another worker that arrives before the server's response that a process is waiting for)
+    candidates = [key for key in _recv_queues if (source is None or key[0]==source)
+                  and (key[1]==tag if tag is not None else key[1]!=NUMPY_SPECIAL_TAG)]
+    if len(candidates)==0:
+        return None
+    return min(candidates, key=lambda key: _recv_queues[key][0][0])
+
+def _store_received_item(source, tag, payload):
+    global _num_received
+    with _received:
+        key = (source, tag)
+        if key not in _recv_queues:
+            _recv_queues[key] = collections.deque()
+        _recv_queues[key].append((_num_received, payload))
+        _num_received += 1
+        _received.notify_all()
+
+def _reception_thread(connections):
+    connections = list(connections)
+    while len(connections)>0:
+        for connection in multiprocessing.connection.wait(connections):
+            try:
+                message = connection.recv_bytes()
+            except (EOFError, OSError):
+                connections.remove(connection)
+                continue
+            source, tag = struct.unpack("ii", message[:8])
+            _store_received_item(source, tag, memoryview(message)[8:])
 
 
 
@@ -111,14 +184,19 @@ def barrier():
 def finalize():
     pass
 
-def launch_wrapper(target_fn, rank_in, size_in, pipe_in, args_in, capture_log):
+def launch_wrapper(target_fn, rank_in, size_in, pipe_in, direct_pipes_in, args_in, capture_log):
     tblib.pickling_support.install()
 
-    global _slave, _rank, _size, _pipe, _recv_lock
+    global _slave, _rank, _size, _pipe, _direct_pipes, _received, _recv_queues, _num_received
     _rank = rank_in
     _size = size_in
     _pipe = pipe_in
-    _recv_lock = threading.Lock()
+    _direct_pipes = direct_pipes_in
+    _received = threading.Condition()
+    _recv_queues = {}
+    _num_received = 0
+
+    threading.Thread(target=_reception_thread, args=([_pipe]+list(_direct_pipes.values()),), daemon=True).start()
 
     result = None
 
@@ -168,13 +246,22 @@ def launch_functions(functions, args, capture_log=False):
 
 
     child_connections, parent_connections = list(zip(*[mp_context.Pipe() for rank in range(num_procs)]))
-    processes = [mp_context.Process(target=launch_wrapper, args=(function, rank, num_procs, pipe, args_i, capture_log))
-                 for rank, (pipe, function, args_i) in
-                 enumerate(zip(child_connections, functions, args))]
+
+    # direct connections between rank 0 and each other rank, bypassing the manager
+    server_ends, worker_ends = list(zip(*[mp_context.Pipe() for rank in range(1, num_procs)])) or ((), ())
+    direct_pipes = [dict(zip(range(1, num_procs), server_ends))] + [{0: pipe} for pipe in worker_ends]
+
+    processes = [mp_context.Process(target=launch_wrapper,
+                                    args=(function, rank, num_procs, pipe, direct_pipes_i, args_i, capture_log))
+                 for rank, (pipe, direct_pipes_i, function, args_i) in
+                 enumerate(zip(child_connections, direct_pipes, functions, args))]
 
     for proc_i in processes:
         proc_i.start()
 
+    for pipe_i in server_ends + worker_ends:
+        pipe_i.close()
+
     running = [True for rank in range(num_procs)]
     error: Optional[Exception] = None
 
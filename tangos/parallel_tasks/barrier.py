@@ -5,9 +5,20 @@ class SimpleBarrierMessage(message.BarrierMessageWithResponse):
     def process_global(self):
         self.respond(None)
 
+class SimpleGroupBarrierMessage(SimpleBarrierMessage):
+    within_group = True
+
 def barrier():
     from . import backend, parallelism_is_active
     if not parallelism_is_active():
         return
     assert backend.rank()!=0, "The server process cannot take part in a barrier"
     SimpleBarrierMessage().send_and_get_response(0) # awaits response which only comes when all processes reach barrier
+
+def group_barrier():
+    """Wait until all workers in this process's server group reach the barrier (all workers, if groups are not in use)"""
+    from . import backend, parallelism_is_active
+    if not parallelism_is_active():
+        return
+    assert backend.rank()!=0, "The server process cannot take part in a barrier"
+    SimpleGroupBarrierMessage().send_and_get_response(0)
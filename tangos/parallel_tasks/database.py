@@ -1,10 +1,12 @@
 import sys
 
 from .. import core
-from . import message, remote_import
+from . import dispatch, message, remote_import
 
 
 class MessageRequestCreatorId(message.MessageWithResponse):
+    dispatch_lane = dispatch.DATABASE
+
     def process(self):
         creator_id = core.creator.get_creator_id()
         self.respond(creator_id)
@@ -0,0 +1,181 @@
+"""Concurrent processing of the messages arriving at the server (see config.server_concurrent_dispatch).
+
+Messages from each client are processed strictly in the order they were sent, by a thread dedicated to that client.
+Messages from different clients can therefore be processed at the same time so that, for example, a slow request for
+a large array from one client does not hold up lock, job and commit messages from the others.
+
+Each message class declares a dispatch_lane, naming the server state its process() reads or changes. Messages in the
+same lane are processed one at a time, so that they see that state exactly as if every message were processed in
+turn; messages in different lanes are processed concurrently. The lanes are:
+
+  COORDINATION (the default): barriers, job queues, accumulated statistics, shared sets and the like;
+  DATABASE: locks, and database access (deferred lock operations on the server write to the database);
+  MAIN_THREAD: snapshot requests, which are handed to the main thread because pynbody expects to be used from it
+               (e.g. it installs signal handlers when creating shared memory).
+
+Messages are received by one further thread, and held in a queue for each source and tag until they are processed.
+If a message, while being deserialized or processed, receives further messages from its source (for instance the
+parts of a request that is split over several messages), they are taken from the same queues, so that they cannot be
+mistaken for new requests.
+"""
+
+import collections
+import threading
+
+COORDINATION = "coordination"
+DATABASE = "database"
+MAIN_THREAD = "main thread"
+
+_lane_locks = {COORDINATION: threading.RLock(), DATABASE: threading.RLock()}
+
+active_dispatcher = None # the dispatcher running in this process, if any
+
+
+def lane_lock(lane):
+    """Return the lock held while processing messages in the given lane.
+
+    Code outside the message handlers that changes the state belonging to a lane (e.g. the server acquiring a lock for
+    itself) must also hold this lock."""
+    return _lane_locks[lane]
+
+
+class _Stop:
+    """Placed in a source's queue to stop its thread once all earlier messages are processed"""
+    pass
+
+
+class MessageDispatcher:
+    def __init__(self, exit_message_class):
+        """Create a dispatcher that processes all incoming messages until every other rank has sent exit_message_class"""
+        self._exit_tag = exit_message_class._tag
+        self._received = threading.Condition()
+        self._queues = {} # (source, tag) -> deque of (arrival number, message)
+        self._num_received = 0
+        self._source_threads = {}
+        self._main_thread_queue = collections.deque()
+        self._main_thread_wakeup = threading.Condition()
+        self._num_running = 0
+        self._receiving = True
+        self._error = None
+
+    def run(self):
+        """Receive and process all messages, returning once all are processed"""
+        global active_dispatcher
+        assert active_dispatcher is None, "Only one dispatcher can run at once"
+        active_dispatcher = self
+        try:
+            threading.Thread(target=self._receive_messages, daemon=True).start()
+            self._run_main_thread_lane()
+        finally:
+            active_dispatcher = None
+
+        if self._error is not None:
+            raise self._error
+
+    def receive(self, source, message_class):
+        """Receive the next message of message_class (or an exception in its place) from source, on behalf of a message
+        being deserialized or processed. Returns (message, source, tag) like backend.receive_any."""
+        from .message import MessageMetaClass
+        tags = [tag for tag, cls in MessageMetaClass._message_classes.items()
+                if issubclass(cls, message_class) or hasattr(cls, "_is_exception")]
+        return self._pop(source, tags)
+
+    def _receive_messages(self):
+        from . import backend
+        try:
+            remaining = set(range(1, backend.size()))
+            while len(remaining)>0:
+                msg, source, tag = backend.receive_any(source=None)
+                if tag==self._exit_tag:
+                    remaining.discard(source)
+                if source not in self._source_threads:
+                    self._start_thread_for_source(source)
+                self._store(source, tag, msg)
+
+            # e.g. messages that the server has sent to itself
+            for source in self._source_threads:
+                self._store(source, None, _Stop)
+        except Exception as e:
+            self._fail(e)
+        finally:
+            with self._main_thread_wakeup:
+                self._receiving = False
+                self._main_thread_wakeup.notify_all()
+
+    def _start_thread_for_source(self, source):
+        with self._main_thread_wakeup:
+            self._num_running += 1
+        t = threading.Thread(target=self._process_messages_from_source, args=(source,), daemon=True)
+        self._source_threads[source] = t
+        t.start()
+
+    def _store(self, source, tag, msg):
+        with self._received:
+            self._queues.setdefault((source, tag), collections.deque()).append((self._num_received, msg))
+            self._num_received += 1
+            self._received.notify_all()
+
+    def _pop(self, source, tags=None):
+        """Remove and return the earliest (message, source, tag) received from source (any source if None) with one of
+        the given tags (any tag if None), waiting for one to arrive if necessary"""
+        with self._received:
+            while True:
+                candidates = [key for key, queue in self._queues.items()
+                              if (source is None or key[0]==source) and (tags is None or key[1] in tags)]
+                if len(candidates)>0:
+                    key = min(candidates, key=lambda k: self._queues[k][0][0])
+                    queue = self._queues[key]
+                    _, msg = queue.popleft()
+                    if len(queue)==0:
+                        del self._queues[key]
+                    return msg, key[0], key[1]
+                self._received.wait()
+
+    def _process_messages_from_source(self, source):
+        from .message import Message
+        try:
+            while self._error is None:
+                msg, source, tag = self._pop(source)
+                if msg is _Stop or tag==self._exit_tag:
+                    break
+                self._process(Message.interpret_and_deserialize(tag, source, msg))
+        except Exception as e:
+            self._fail(e)
+        finally:
+            with self._main_thread_wakeup:
+                self._num_running -= 1
+                self._main_thread_wakeup.notify_all()
+
+    def _process(self, obj):
+        lane = obj.dispatch_lane
+        if lane==MAIN_THREAD:
+            done = threading.Event()
+            with self._main_thread_wakeup:
+                self._main_thread_queue.append((obj, done))
+                self._main_thread_wakeup.notify_all()
+            done.wait() # so that the next message from this source is not processed before this one
+        else:
+            with lane_lock(lane):
+                obj.process()
+
+    def _run_main_thread_lane(self):
+        while True:
+            with self._main_thread_wakeup:
+                while len(self._main_thread_queue)==0 and self._error is None \
+                        and (self._receiving or self._num_running>0):
+                    self._main_thread_wakeup.wait()
+                if self._error is not None or len(self._main_thread_queue)==0:
+                    return
+                obj, done = self._main_thread_queue.popleft()
+            try:
+                obj.process()
+            except Exception as e:
+                self._fail(e)
+            finally:
+                done.set()
+
+    def _fail(self, error):
+        with self._main_thread_wakeup:
+            if self._error is None:
+                self._error = error
+            self._main_thread_wakeup.notify_all()
@@ -0,0 +1,113 @@
+"""Division of worker processes into groups, each with its own pynbody snapshot server.
+
+By default, rank 0 coordinates all the work (locks, job queues, barriers) and also serves snapshots, and all other
+ranks are workers. If use_server_groups(K) is called before parallelism is launched, the non-zero ranks are instead
+split into K contiguous groups. The first rank of each group serves snapshots to the remaining ranks of the group
+(its workers) in place of rank 0. Different groups can then work on different timesteps at the same time, while
+rank 0 continues to coordinate everything else.
+
+For example, with 7 processes and 2 groups, ranks 1 and 4 are snapshot servers, ranks 2-3 form the first group of
+workers and ranks 5-6 the second.
+"""
+
+import numpy as np
+
+from . import message
+
+_num_groups = None
+
+
+def use_server_groups(num_groups):
+    """Split the ranks into num_groups groups, each with its own snapshot server, or undo this if num_groups is None
+
+    Must be called before parallelism is launched, consistently on all processes"""
+    global _num_groups
+    if num_groups is not None and num_groups<1:
+        raise ValueError("The number of server groups must be at least 1")
+    _num_groups = num_groups
+
+def server_groups_active():
+    return _num_groups is not None
+
+def _group_ranks():
+    """Return a list with the ranks belonging to each group, the first of which is the group's server"""
+    from . import backend
+    ranks = list(range(1, backend.size()))
+    if len(ranks) < 2*_num_groups:
+        raise ValueError("%d server groups need at least %d processes (one for each server and one worker in each "
+                         "group, plus rank 0)" % (_num_groups, 2*_num_groups+1))
+    return [[int(r) for r in group] for group in np.array_split(ranks, _num_groups)]
+
+def group_of_rank(rank):
+    """Return the index of the group rank belongs to, or None if groups are not in use or for rank 0"""
+    if not server_groups_active():
+        return None
+    for i, group in enumerate(_group_ranks()):
+        if rank in group:
+            return i
+    return None
+
+def worker_ranks():
+    """Return all the ranks that perform calculations, i.e. are not acting as a server"""
+    from . import backend
+    if not server_groups_active():
+        return list(range(1, backend.size()))
+    return [r for group in _group_ranks() for r in group[1:]]
+
+def workers_in_group_of(rank):
+    """Return the worker ranks in the same group as rank (all worker ranks if groups are not in use)"""
+    group = group_of_rank(rank)
+    if group is None:
+        return worker_ranks()
+    return _group_ranks()[group][1:]
+
+def group_leads():
+    """Return the first worker rank of each group (or just rank 1, if groups are not in use)"""
+    if not server_groups_active():
+        return [1]
+    return [group[1] for group in _group_ranks()]
+
+def is_group_server(rank=None):
+    from . import backend
+    if not server_groups_active():
+        return False
+    if rank is None:
+        rank = backend.rank()
+    return rank in [group[0] for group in _group_ranks()]
+
+def snapshot_server_rank():
+    """Return the rank that serves snapshots to this process"""
+    from . import backend
+    group = group_of_rank(backend.rank())
+    if group is None:
+        return 0
+    return _group_ranks()[group][0]
+
+def my_group_workers():
+    from . import backend
+    return workers_in_group_of(backend.rank())
+
+def my_group_lead():
+    return my_group_workers()[0]
+
+
+class MessageGroupWorkerFinished(message.Message):
+    pass
+
+def run_group_server():
+    """Process messages (in practice, snapshot requests) from this group's workers until they have all finished"""
+    from .async_message import init_async_processing_thread
+    init_async_processing_thread()
+
+    remaining = set(my_group_workers())
+    while len(remaining)>0:
+        obj = message.Message.receive()
+        if isinstance(obj, MessageGroupWorkerFinished):
+            remaining.discard(obj.source)
+        else:
+            obj.process()
+
+def release_group_server():
+    """Tell this process's group server that it will make no further requests"""
+    if server_groups_active():
+        MessageGroupWorkerFinished().send(snapshot_server_rank())
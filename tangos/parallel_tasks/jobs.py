@@ -1,13 +1,17 @@
 import base64
+import collections
 import hashlib
+import math
+import os
 import pathlib
 import pickle
 import shlex
 import sys
+import threading
 import traceback
 import zlib
 
-from .. import log
+from .. import config, log
 from . import message
 
 
@@ -17,47 +21,159 @@ class InconsistentJobList(RuntimeError):
 class InconsistentContext(RuntimeError):
     pass
 
+def _encode_completion_map(jobs_complete):
+    return base64.a85encode(
+        zlib.compress(
+            pickle.dumps(jobs_complete)
+        )
+    ).decode('ascii')
+
+def _decode_completion_map(string):
+    return pickle.loads(
+        zlib.decompress(
+            base64.a85decode(string.encode('ascii'))
+        )
+    )
+
+def _context_hash(context):
+    return hashlib.md5(repr(context).encode('utf-8')).hexdigest()
+
+class ResumeJournal:
+    """An append-only record of completed jobs, from which distributed loops can be resumed.
+
+    The first record for an iteration holds its full completion map; after that, records list only the newly
+    completed job indices, so that the cost of recording progress does not grow with the number of jobs.
+    Records are handed to the operating system as soon as they are written (so they survive the process being
+    killed), but are only fsynced at most every config.RESUME_JOURNAL_FSYNC_INTERVAL seconds. On clean exit, the
+    journal is compacted down to a single record per iteration."""
+
+    def __init__(self, path):
+        self._path = path
+        self._file = None
+        self._iterations = {} # context -> (key, jobs_complete)
+        self._num_keys = 0
+        self._lock = threading.Lock()
+        self._fsync_timer = None
+
+    @property
+    def path(self):
+        return self._path
+
+    def record_completion(self, context, jobs_complete, jobs):
+        with self._lock:
+            key, journaled_jobs_complete = self._iterations.get(context, (None, None))
+            if journaled_jobs_complete is jobs_complete:
+                self._append((key, jobs))
+            else:
+                # new iteration (or a new attempt at the same iteration): start from its full map, under a key
+                # that no earlier record in this journal can share
+                key = (self._num_keys, _context_hash(context))
+                self._num_keys += 1
+                self._iterations[context] = (key, jobs_complete)
+                self._append((key, context, _encode_completion_map(jobs_complete)))
+            self._schedule_fsync()
+
+    def _append(self, record):
+        if self._file is None:
+            self._file = open(self._path, "ab")
+        pickle.dump(record, self._file)
+        self._file.flush()
+
+    def _schedule_fsync(self):
+        if self._fsync_timer is None:
+            self._fsync_timer = threading.Timer(config.RESUME_JOURNAL_FSYNC_INTERVAL, self._fsync)
+            self._fsync_timer.daemon = True
+            self._fsync_timer.start()
+
+    def _fsync(self):
+        with self._lock:
+            self._fsync_timer = None
+            if self._file is not None:
+                os.fsync(self._file.fileno())
+
+    def compact(self):
+        """Rewrite the journal as one record per iteration, and close it"""
+        with self._lock:
+            if self._fsync_timer is not None:
+                self._fsync_timer.cancel()
+                self._fsync_timer = None
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            if len(self._iterations)==0:
+                return
+
+            temp_path = self._path.with_name(self._path.name + ".tmp")
+            with open(temp_path, "wb") as f:
+                for context, (key, jobs_complete) in self._iterations.items():
+                    pickle.dump((key, context, _encode_completion_map(jobs_complete)), f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, self._path)
+
+    @staticmethod
+    def replay(path):
+        """Return a dictionary mapping each context in the journal at path to its list of completed jobs"""
+        iterations = {}
+        with open(path, "rb") as f:
+            while True:
+                try:
+                    record = pickle.load(f)
+                except EOFError:
+                    break
+                except pickle.UnpicklingError:
+                    log.logger.warning(f"Resume journal {str(path):s} is truncated; ignoring its final record")
+                    break
+
+                if len(record)==3:
+                    key, context, string = record
+                    iterations[key] = (context, _decode_completion_map(string))
+                else:
+                    key, jobs = record
+                    jobs_complete = iterations[key][1]
+                    for job in jobs:
+                        jobs_complete[job] = True
+
+        return {context: jobs_complete for context, jobs_complete in iterations.values()}
+
+
 class IterationState:
-    _this_run_iteration_states = {}
-    def __init__(self, context, jobs_complete, /, backend_size=None):
-        from . import backend
+    _journal_this_run = None
+
+    def __init__(self, context, jobs_complete, /, backend_size=None, ranks=None):
+        from . import groups
         self._context = context
         self._jobs_complete = jobs_complete
-        self._rank_running_job = {i: None for i in range(1,backend_size or backend.size())}
+        if ranks is None:
+            ranks = range(1, backend_size) if backend_size else groups.worker_ranks()
+        self._rank_running_job = {i: None for i in ranks}
+        self._num_workers = max(len(self._rank_running_job), 1)
+        self._free_jobs = collections.deque(i for i, complete in enumerate(jobs_complete) if not complete)
 
     def __len__(self):
         return len(self._jobs_complete)
 
     def to_string(self):
-        return base64.a85encode(
-            zlib.compress(
-                pickle.dumps(self._jobs_complete)
-            )
-        ).decode('ascii')
+        return _encode_completion_map(self._jobs_complete)
 
     @classmethod
-    def from_string(cls, string, context=None, backend_size=None):
-        jobs_complete = pickle.loads(
-            zlib.decompress(
-                base64.a85decode(string.encode('ascii'))
-            )
-        )
-        return cls(context, jobs_complete, backend_size=backend_size)
+    def from_string(cls, string, context=None, backend_size=None, ranks=None):
+        return cls(context, _decode_completion_map(string), backend_size=backend_size, ranks=ranks)
 
     @classmethod
-    def from_context(cls, num_jobs, argv=None, stack_hash=None, allow_resume=None, backend_size=None):
+    def from_context(cls, num_jobs, argv=None, stack_hash=None, allow_resume=None, backend_size=None, ranks=None):
         context = (argv, stack_hash, num_jobs)
         if allow_resume:
             cmap = cls._get_stored_completion_map_from_context(context)
             if cmap is not None:
-                r = cls.from_string(cmap, context)
+                r = cls(context, cmap, backend_size=backend_size, ranks=ranks)
                 log.logger.info(
                     f"Resuming from previous run. {r.count_complete()} of {len(r)} jobs are already complete.")
                 log.logger.info(
                     f"To prevent tangos from doing this, you can delete the folder {str(cls._resume_state_folder_path()):s}")
                 return r
 
-        return cls(context, [False]*num_jobs, backend_size=backend_size)
+        return cls(context, [False]*num_jobs, backend_size=backend_size, ranks=ranks)
 
     @classmethod
     def _resume_state_folder_path(cls):
@@ -67,17 +183,28 @@ class IterationState:
 
     @staticmethod
     def _resume_state_path():
-        if not hasattr(IterationState, "_resume_state_path_this_run"):
-            path = IterationState._resume_state_folder_path()
-            all_state_files = sorted(list(path.iterdir()))
-            if len(all_state_files)==0:
-                i = 0
-            else:
-                i = int(all_state_files[-1].name.split("_")[-1].split(".")[0])+1
-            candidate = path / f"tangos_resume_state_{i:06d}.pickle"
-            assert not candidate.exists()
-            IterationState._resume_state_path_this_run = candidate
-        return IterationState._resume_state_path_this_run
+        path = IterationState._resume_state_folder_path()
+        all_state_files = sorted(list(path.iterdir()))
+        if len(all_state_files)==0:
+            i = 0
+        else:
+            i = int(all_state_files[-1].name.split("_")[-1].split(".")[0])+1
+        candidate = path / f"tangos_resume_state_{i:06d}.journal"
+        assert not candidate.exists()
+        return candidate
+
+    @staticmethod
+    def _journal():
+        if IterationState._journal_this_run is None:
+            IterationState._journal_this_run = ResumeJournal(IterationState._resume_state_path())
+        return IterationState._journal_this_run
+
+    @staticmethod
+    def compact_journal():
+        """Compact the resume journal written by this run. Subsequent progress goes to a fresh journal."""
+        if IterationState._journal_this_run is not None:
+            IterationState._journal_this_run.compact()
+            IterationState._journal_this_run = None
 
     @classmethod
     def _get_stored_completion_maps(cls):
@@ -86,13 +213,18 @@ class IterationState:
         resume_path = cls._resume_state_folder_path()
 
         for filename in sorted(list(resume_path.iterdir())):
-            if str(filename).endswith(".pickle"):
-                try:
+            try:
+                if filename.suffix == ".journal":
+                    maps.update(ResumeJournal.replay(filename))
+                elif filename.suffix == ".pickle":
+                    # resume state written by older versions of tangos
                     with filename.open('rb') as f:
-                        maps.update(pickle.load(f))
-                except (OSError, EOFError):
-                    log.logger.warn(f"Error reading resume state from {str(filename):s}. Skipped.")
-                    pass
+                        maps.update({context: _decode_completion_map(string)
+                                     for context, string in pickle.load(f).items()})
+            except (OSError, EOFError, KeyError, ValueError, pickle.UnpicklingError, zlib.error):
+                # e.g. a partially-written journal; treat it as though there were no resume state
+                log.logger.warn(f"Error reading resume state from {str(filename):s}. Skipped.")
+                pass
 
         return maps
     @classmethod
@@ -105,27 +237,38 @@ class IterationState:
         for f in cls._resume_state_folder_path().iterdir():
             f.unlink()
 
-    def _store_completion_map(self):
-        self._this_run_iteration_states[self._context] = self.to_string()
-        with open(self._resume_state_path(), "wb") as f:
-            pickle.dump(self._this_run_iteration_states, f)
-
-    def mark_complete(self, job):
-        if job is None:
+    def mark_complete(self, *jobs):
+        jobs = [j for j in jobs if j is not None]
+        if len(jobs)==0:
             return
-        self._jobs_complete[job] = True
-        self._store_completion_map()
+        for job in jobs:
+            self._jobs_complete[job] = True
+        self._journal().record_completion(self._context, self._jobs_complete, jobs)
 
-    def next_job(self, for_rank):
+    def _batch_size(self, max_batch_size):
+        # guided self-scheduling: hand out a fraction of the remaining work, shrinking towards single jobs
+        # as the queue drains so that the tail of the loop stays balanced between ranks
+        guided_size = math.ceil(len(self._free_jobs) / (2 * self._num_workers))
+        return max(1, min(max_batch_size, guided_size))
+
+    def next_jobs(self, for_rank, max_batch_size=1):
+        """Mark the jobs previously allocated to for_rank as complete, and return a list of new jobs for it.
+
+        At most max_batch_size jobs are returned. An empty list indicates there is no more work for this rank."""
         if for_rank in self._rank_running_job:
-            self.mark_complete(self._rank_running_job[for_rank])
-            del self._rank_running_job[for_rank]
+            self.mark_complete(*(self._rank_running_job.pop(for_rank) or ()))
 
-        for i in range(len(self._jobs_complete)):
-            if not self._jobs_complete[i] and i not in self._rank_running_job.values():
-                self._rank_running_job[for_rank] = i
-                return i
-        return None
+        batch = [self._free_jobs.popleft() for _ in range(min(self._batch_size(max_batch_size), len(self._free_jobs)))]
+        if len(batch)>0:
+            self._rank_running_job[for_rank] = batch
+        return batch
+
+    def next_job(self, for_rank):
+        batch = self.next_jobs(for_rank, 1)
+        if len(batch)==0:
+            return None
+        else:
+            return batch[0]
 
     def finished(self):
         # not enough for all jobs to be complete, must also have notified all ranks (this matters
@@ -154,6 +297,14 @@ class SynchronizedIterationState(IterationState):
                 return True
         return False
 
+    def next_jobs(self, for_rank, max_batch_size=1):
+        # all ranks must see every job in lockstep, so batching is not possible
+        job = self.next_job(for_rank)
+        if job is None:
+            return []
+        else:
+            return [job]
+
     def next_job(self, for_rank):
         previous_job = self._rank_running_job[for_rank]
         my_next_job = self._first_incomplete_job_after(previous_job)
@@ -177,7 +328,7 @@ _iteration_states = {}
 class MessageStartIteration(message.BarrierMessageWithResponse):
     def process_global(self):
         global _next_iteration_state_id, _iteration_states
-        req_jobs, req_hash, allow_resume, synchronized = self.contents
+        req_jobs, req_hash, allow_resume, synchronized, requesting_ranks = self.contents
 
         argv_string = shlex.join(sys.argv)
 
@@ -186,7 +337,8 @@ class MessageStartIteration(message.BarrierMessageWithResponse):
         my_id = _next_iteration_state_id
         _iteration_states[my_id] = IteratorClass.from_context(req_jobs, argv=argv_string,
                                                               stack_hash=req_hash,
-                                                              allow_resume=allow_resume)
+                                                              allow_resume=allow_resume,
+                                                              ranks=requesting_ranks or self._participants())
         _next_iteration_state_id += 1
 
         self.respond(my_id)
@@ -200,58 +352,102 @@ class MessageStartIteration(message.BarrierMessageWithResponse):
         if self.contents != other.contents:
             raise InconsistentContext("Inconsistency in requested loops between different processes")
 
+class MessageStartGroupIteration(MessageStartIteration):
+    within_group = True
+
+class MessageGroupJobs(message.Message):
+    """Passes the jobs obtained by the lead worker of a server group on to the other workers in the group"""
+    pass
 
 
 class MessageDistributeJobList(message.Message):
     def process(self):
-        # server should send this back out to all the other ranks
-        from . import backend
-        for rank in range(1, backend.size()):
+        # server should send this back out to all the other worker ranks (not to any group servers)
+        from . import groups
+        for rank in groups.worker_ranks():
             if rank != self.source:
                 MessageDistributeJobList(self.contents).send(rank)
 
 class MessageRequestJob(message.MessageWithResponse):
     def process(self):
-        iterator_id = self.contents
+        iterator_id, max_batch_size = self.contents
         current_iteration_state = _iteration_states.get(iterator_id, None)
         source = self.source
 
         assert current_iteration_state is not None # should not be requesting jobs if we are not in a loop
 
-        job = current_iteration_state.next_job(source)
+        jobs = current_iteration_state.next_jobs(source, max_batch_size)
 
-        if job is not None:
-            log.logger.debug("Send job %d of %d to node %d", job, len(current_iteration_state), source)
+        if len(jobs)>0:
+            log.logger.debug("Send jobs %r of %d to node %d", jobs, len(current_iteration_state), source)
         else:
             log.logger.debug("Finished jobs; notify node %d", source)
 
         if current_iteration_state.finished():
             del _iteration_states[iterator_id]
 
-        self.respond(job)
+        self.respond(jobs)
 
-def distributed_iterate(task_list, allow_resume=False, resumption_id=None):
+def distributed_iterate(task_list, allow_resume=False, resumption_id=None, max_batch_size=None, within_group=False):
     """Sets up an iterator returning items of task_list.
 
     If allow_resume is True, then the iterator will resume from the last point it reached
     provided argv and the stack trace are unchanged. If resumption_id is not None, then
     the stack trace is ignored and only resumption_id needs to match.
+
+    Up to max_batch_size jobs are requested from the server at a time (default: config.max_jobs_per_request).
+
+    If within_group is True, the tasks are distributed only between the workers of this process's server group (see
+    groups.py), which may be running a different loop from the other groups.
     """
-    from . import backend, barrier
+    from . import backend
+    from .barrier import barrier, group_barrier
 
     resumption_id = resumption_id or _autogenerate_resume_id()
+    max_batch_size = max_batch_size or config.max_jobs_per_request
+
+    StartMessage, sync = (MessageStartGroupIteration, group_barrier) if within_group else (MessageStartIteration, barrier)
 
     assert backend is not None, "Parallelism is not initialised"
-    iteration_id = MessageStartIteration((len(task_list), resumption_id, allow_resume, False)).send_and_get_response(0)
+    iteration_id = StartMessage((len(task_list), resumption_id, allow_resume, False, None)).send_and_get_response(0)
+    sync()
+
+    while True:
+        jobs = MessageRequestJob((iteration_id, max_batch_size)).send_and_get_response(0)
+        if len(jobs)==0:
+            sync()
+            return
+        for job in jobs:
+            yield task_list[job]
+
+def group_distributed_iterate(task_list, allow_resume=False, resumption_id=None):
+    """Sets up an iterator where each item of task_list is returned to all the workers of one server group.
+
+    The first worker in each group requests items from the server and passes them on to the rest of its group.
+    Resumption works as for distributed_iterate."""
+    from . import backend, barrier, groups
+
+    resumption_id = resumption_id or _autogenerate_resume_id()
+
+    assert backend is not None, "Parallelism is not initialised"
+    iteration_id = MessageStartIteration((len(task_list), resumption_id, allow_resume, False,
+                                          groups.group_leads())).send_and_get_response(0)
     barrier()
 
+    lead = groups.my_group_lead()
     while True:
-        job = MessageRequestJob(iteration_id).send_and_get_response(0)
-        if job is None:
+        if backend.rank()==lead:
+            jobs = MessageRequestJob((iteration_id, 1)).send_and_get_response(0)
+            for rank in groups.my_group_workers():
+                if rank!=lead:
+                    MessageGroupJobs(jobs).send(rank)
+        else:
+            jobs = MessageGroupJobs.receive(lead).contents
+
+        if len(jobs)==0:
             barrier()
             return
-        else:
-            yield task_list[job]
+        yield task_list[jobs[0]]
 
 
 def _autogenerate_resume_id():
@@ -271,16 +467,16 @@ def synchronized_iterate(task_list, allow_resume=False, resumption_id=None):
 
     assert backend is not None, "Parallelism is not initialised"
 
-    iteration_id = MessageStartIteration((len(task_list), resumption_id, allow_resume, True)).send_and_get_response(0)
+    iteration_id = MessageStartIteration((len(task_list), resumption_id, allow_resume, True, None)).send_and_get_response(0)
     barrier()
 
     while True:
-        job = MessageRequestJob(iteration_id).send_and_get_response(0)
+        jobs = MessageRequestJob((iteration_id, 1)).send_and_get_response(0)
         barrier() # this is crucial to keep things in sync (see comment in SynchronizedIterationState.next_job)
-        if job is None:
+        if len(jobs)==0:
             return
 
-        yield task_list[job]
+        yield task_list[jobs[0]]
 
 
 
@@ -289,16 +485,17 @@ def synchronized_iterate(task_list, allow_resume=False, resumption_id=None):
 
 def generate_task_list_and_parallel_iterate(task_list_function, allow_resume=False):
     """Call task_list_function on only one rank, and then parallel iterate with all ranks"""
-    from . import backend
+    from . import backend, groups
 
     assert backend is not None, "Parallelism is not initialised"
 
-    if backend.rank()==1:
+    generating_rank = groups.worker_ranks()[0]
+    if backend.rank()==generating_rank:
         task_list = task_list_function()
         MessageDistributeJobList(task_list).send(0)
         log.logger.debug("generated task list = %r",task_list)
     else:
-        log.logger.debug("awaiting rank 1 generating task list")
+        log.logger.debug("awaiting rank %d generating task list", generating_rank)
         task_list = MessageDistributeJobList.receive(0).contents
         log.logger.debug("task_list = %r",task_list)
     return distributed_iterate(task_list, allow_resume=allow_resume)
@@ -1,10 +1,15 @@
+import threading
 import time
 
-from ..config import DEFAULT_SLEEP_BEFORE_ALLOWING_NEXT_LOCK
-from . import log, message, parallelism_is_active
+import numpy as np
+
+from .. import config
+from . import accumulative_statistics, dispatch, log, message, on_exit_parallelism, parallelism_is_active
 
 
 class MessageRequestLock(message.Message):
+    dispatch_lane = dispatch.DATABASE
+
     def __init__(self, name, shared=False):
         self.name = name
         self.shared = shared
@@ -23,14 +28,18 @@ class MessageRequestLock(message.Message):
         log.logger.debug("Received request for lock %r for proc %d, shared=%r", lock_id, self.source, self.shared)
         queue = _get_lock_queue(lock_id)
         queue.append((self.source, self.shared))
+        _get_lock_statistics().requested(lock_id, self.source)
         if len(queue) == 1:
             _issue_next_lock(lock_id)
         elif _lock_in_shared_mode(lock_id) and self.shared:
             log.logger.debug("Issue shared lock %r to proc %d", lock_id, self.source)
             MessageGrantLock((lock_id, False)).send(self.source)
+            _get_lock_statistics().granted(lock_id, self.source)
             _increment_lock_num_shared(lock_id,1)
 
 class MessageRelinquishLock(message.Message):
+    dispatch_lane = dispatch.DATABASE
+
     def process(self):
         lock_id = self.contents
         proc = self.source
@@ -49,6 +58,9 @@ class MessageGrantLock(message.Message):
 _lock_queues = {}
 _lock_num_sharers = {}
 
+# Notified whenever the server reaches the front of a lock queue, so that server threads waiting for a lock wake up
+_server_lock_available = threading.Condition(dispatch.lane_lock(dispatch.DATABASE))
+
 def _get_lock_queue(lock_id):
     lock_queue = _lock_queues.get(lock_id,[])
     _lock_queues[lock_id] = lock_queue
@@ -73,11 +85,17 @@ def _issue_next_lock(lock_id, impose_filesystem_delay=False):
         shared = queue[0][1]
         if shared:
             _issue_shared_locks(lock_id, impose_filesystem_delay)
-        elif proc!=0:
+            return
+        _get_lock_statistics().granted(lock_id, proc)
+        if proc!=0:
             log.logger.debug("Issue lock %r to proc %d", lock_id, proc)
             MessageGrantLock((lock_id, impose_filesystem_delay)).send(proc)
+        elif lock_id in _server_lock_callbacks:
+            _run_server_lock_callbacks(lock_id)
         else:
-            pass # the server has to handle being at the top of the queue directly
+            # a server thread is waiting in ExclusiveLock._acquire_on_server
+            with _server_lock_available:
+                _server_lock_available.notify_all()
 
 def _issue_shared_locks(lock_id, impose_filesystem_delay=False):
     queue = _get_lock_queue(lock_id)
@@ -86,6 +104,7 @@ def _issue_shared_locks(lock_id, impose_filesystem_delay=False):
         if shared:
             log.logger.debug("Issue shared lock %r to proc %d",lock_id, proc)
             MessageGrantLock((lock_id, impose_filesystem_delay)).send(proc)
+            _get_lock_statistics().granted(lock_id, proc)
             sharers_notified += 1
     _increment_lock_num_shared(lock_id,sharers_notified)
     log.logger.debug("Lock %r is currently in shared mode, with %d process(es) sharing it",
@@ -95,6 +114,7 @@ def _release_lock_exclusive(lock_id, proc):
     queue = _get_lock_queue(lock_id)
     assert queue[0] == (proc, False)
     queue.pop(0)
+    _get_lock_statistics().released(lock_id, proc)
     log.logger.debug("Finished with lock %r for proc %d", lock_id, proc)
     if len(queue) > 0:
         _issue_next_lock(lock_id, True)
@@ -104,6 +124,7 @@ def _release_lock_shared(lock_id, proc):
     assert (proc,True) in queue, "Conistency error in locking: can't find a record of the shared lock being released"
     index = queue.index((proc, True))
     del queue[index]
+    _get_lock_statistics().released(lock_id, proc)
     _increment_lock_num_shared(lock_id, -1)
     log.logger.debug("Finished with shared lock %r for proc %d", lock_id, proc)
     if not _lock_in_shared_mode(lock_id):
@@ -111,6 +132,116 @@ def _release_lock_shared(lock_id, proc):
         _issue_next_lock(lock_id)
 
 
+_server_lock_callbacks = {}
+
+def run_on_server_with_lock(lock_id, callback):
+    """On the server, call callback while holding the exclusive lock lock_id.
+
+    If the lock is free, callback is called immediately. Otherwise the server joins the queue for the lock and carries
+    on processing messages; callback is then called as soon as the lock is released to it."""
+    with dispatch.lane_lock(dispatch.DATABASE):
+        callbacks = _server_lock_callbacks.get(lock_id, None)
+        if callbacks is not None:
+            # the server is already queueing for this lock
+            callbacks.append(callback)
+            return
+
+        _server_lock_callbacks[lock_id] = [callback]
+        queue = _get_lock_queue(lock_id)
+        queue.append((0, False))
+        _get_lock_statistics().requested(lock_id, 0)
+        if len(queue) == 1:
+            _get_lock_statistics().granted(lock_id, 0)
+            _run_server_lock_callbacks(lock_id)
+        else:
+            log.logger.debug("Server queueing for lock %r", lock_id)
+
+def _run_server_lock_callbacks(lock_id):
+    callbacks = _server_lock_callbacks.pop(lock_id)
+    log.logger.debug("Server acquired lock %r for %d deferred operation(s)", lock_id, len(callbacks))
+    try:
+        for callback in callbacks:
+            callback()
+    finally:
+        _release_lock_exclusive(lock_id, 0)
+
+class LockStatistics(accumulative_statistics.StatisticsAccumulatorBase):
+    """Histograms, for each lock name, of how long processes waited for the lock and how long they then held it.
+
+    Kept by the server, which sees every request, grant and release."""
+    BIN_EDGES = np.array([0.0, 1e-3, 1e-2, 1e-1, 1.0, 10.0, 100.0, np.inf])
+    BIN_LABELS = ["<1ms", "<10ms", "<0.1s", "<1s", "<10s", "<100s", ">100s"]
+
+    def __init__(self):
+        self.reset()
+        self._requested_at = {}
+        self._granted_at = {}
+        super().__init__()
+
+    def reset(self):
+        self.wait_histograms = {}
+        self.hold_histograms = {}
+
+    def requested(self, lock_id, proc):
+        self._requested_at[(lock_id, proc)] = time.time()
+
+    def granted(self, lock_id, proc):
+        now = time.time()
+        self._granted_at[(lock_id, proc)] = now
+        self._add_to_histogram(self.wait_histograms, lock_id, now - self._requested_at.pop((lock_id, proc), now))
+
+    def released(self, lock_id, proc):
+        now = time.time()
+        self._add_to_histogram(self.hold_histograms, lock_id, now - self._granted_at.pop((lock_id, proc), now))
+
+    def _add_to_histogram(self, histograms, lock_id, duration):
+        histogram = histograms.setdefault(lock_id, np.zeros(len(self.BIN_LABELS), dtype=int))
+        histogram[np.searchsorted(self.BIN_EDGES, duration, side='right')-1] += 1
+
+    def add(self, other):
+        for mine, theirs in ((self.wait_histograms, other.wait_histograms),
+                             (self.hold_histograms, other.hold_histograms)):
+            for lock_id, histogram in theirs.items():
+                mine[lock_id] = mine.get(lock_id, 0) + histogram
+
+    def report_to_log(self, logger):
+        if len(self.wait_histograms) == 0:
+            return
+        logger.info("")
+        logger.info("LOCK WAIT AND HOLD TIMES, number of acquisitions by duration")
+        logger.info("%25s " + " ".join(["%7s"]*len(self.BIN_LABELS)), "", *self.BIN_LABELS)
+        for lock_id in sorted(self.wait_histograms.keys()):
+            for label, histograms in (("wait", self.wait_histograms), ("hold", self.hold_histograms)):
+                histogram = histograms.get(lock_id, np.zeros(len(self.BIN_LABELS), dtype=int))
+                logger.info("%25s " + " ".join(["%7d"]*len(histogram)), f"{lock_id[-20:]} {label}", *histogram)
+        logger.info("")
+
+    def __eq__(self, other):
+        if type(other) != type(self):
+            return False
+        for mine, theirs in ((self.wait_histograms, other.wait_histograms),
+                             (self.hold_histograms, other.hold_histograms)):
+            if mine.keys() != theirs.keys():
+                return False
+            if not all(np.all(mine[k] == theirs[k]) for k in mine.keys()):
+                return False
+        return True
+
+_lock_statistics = None
+
+def _get_lock_statistics():
+    """Return the server's LockStatistics for this run, which are written to the log when the run ends"""
+    global _lock_statistics
+    if _lock_statistics is None:
+        _lock_statistics = LockStatistics()
+        on_exit_parallelism(_report_lock_statistics)
+    return _lock_statistics
+
+def _report_lock_statistics():
+    global _lock_statistics
+    _lock_statistics.report_to_log(log.logger)
+    _lock_statistics = None
+
 def _any_locks_alive():
     return any([len(v)>0 for v in _lock_queues.values()])
 
@@ -119,8 +250,14 @@ class ExclusiveLock:
     """Named, exclusive, re-entrant lock - only one MPI process can hold a lock of a given name at once"""
     _shared=False
 
-    def __init__(self, name, delay_before_release=DEFAULT_SLEEP_BEFORE_ALLOWING_NEXT_LOCK):
+    def __init__(self, name, delay_before_release=None):
+        """Create a lock with the given name.
+
+        delay_before_release is the time (in seconds) to wait when the lock is handed over from another process; if
+        None, it is taken from config.lock_handover_delays or config.DEFAULT_SLEEP_BEFORE_ALLOWING_NEXT_LOCK."""
         self.name = name
+        if delay_before_release is None:
+            delay_before_release = config.lock_handover_delays.get(name, config.DEFAULT_SLEEP_BEFORE_ALLOWING_NEXT_LOCK)
         self._delay = delay_before_release
         self._count = 0
 
@@ -170,38 +307,36 @@ class ExclusiveLock:
         start = time.time()
         lock_id = self.name
         log.logger.debug("Server requesting lock %r", lock_id)
-        queue = _get_lock_queue(lock_id)
-        
-        # Add server (rank 0) to the queue
-        queue.append((0, self._shared))
-        
-        # If we're the only one in queue, we can proceed immediately
-        if len(queue) == 1:
-            if self._shared:
-                _increment_lock_num_shared(lock_id, 1)
-            log.logger.debug("Server acquired lock %r immediately in %.1fs", self.name, time.time()-start)
-            return
+        with _server_lock_available:
+            queue = _get_lock_queue(lock_id)
+
+            # Add server (rank 0) to the queue
+            queue.append((0, self._shared))
+            _get_lock_statistics().requested(lock_id, 0)
+
+            # If we're the only one in queue, we can proceed immediately
+            if len(queue) == 1:
+                if self._shared:
+                    _increment_lock_num_shared(lock_id, 1)
+                _get_lock_statistics().granted(lock_id, 0)
+                log.logger.debug("Server acquired lock %r immediately in %.1fs", self.name, time.time()-start)
+                return
+
+            # Otherwise, wait until we're at the front of the queue (see _issue_next_lock). Waiting releases the
+            # lane lock, so that lock messages from the clients can be processed meanwhile
+            _server_lock_available.wait_for(lambda: queue[0] == (0, self._shared))
 
-        # Otherwise, we need to wait for our turn
-        # Poll until we're at the front of the queue and can be granted the lock
-        while True:
-            # Check if we're at the front of the queue
-            if len(queue) > 0 and queue[0] == (0, self._shared):
-                break
-            
-            # Wait a short time before polling again
-            time.sleep(0.001)
-            
         log.logger.debug("Server acquired lock %r in %.1fs", self.name, time.time()-start)
 
     def _release_on_server(self):
         """Directly release lock on server without messaging"""
         lock_id = self.name
         log.logger.debug("Server releasing lock %r", lock_id)
-        if self._shared:
-            _release_lock_shared(lock_id, 0)  # rank 0 = server
-        else:
-            _release_lock_exclusive(lock_id, 0)  # rank 0 = server
+        with dispatch.lane_lock(dispatch.DATABASE):
+            if self._shared:
+                _release_lock_shared(lock_id, 0)  # rank 0 = server
+            else:
+                _release_lock_exclusive(lock_id, 0)  # rank 0 = server
 
 
 class SharedLock(ExclusiveLock):
@@ -1,12 +1,14 @@
+from . import dispatch
+
 reception_timing_monitor = None
 
 def _setup_message_reception_timing_monitor():
     global reception_timing_monitor
 
     from ..util import timing_monitor
-    from . import backend
-    if backend is None or backend.rank() == 0:
-        # server can't gather its own timing information
+    from . import backend, groups
+    if backend is None or backend.rank() == 0 or groups.is_group_server():
+        # servers can't gather their own timing information
         reception_timing_monitor = timing_monitor.TimingMonitor(allow_parallel=False, label='idle')
     else:
         reception_timing_monitor = timing_monitor.TimingMonitor(allow_parallel=True, label='response wait',
@@ -62,6 +64,7 @@ class MessageWithResponseMetaClass(MessageMetaClass):
 
 class Message(metaclass=MessageMetaClass):
     _handler = None
+    dispatch_lane = dispatch.COORDINATION # the server state that process() reads or changes; see dispatch.py
 
     def __init__(self, contents=None):
         self.contents = contents
@@ -95,7 +98,11 @@ class Message(metaclass=MessageMetaClass):
         from . import backend
         global reception_timing_monitor
 
-        if reception_timing_monitor is not None:
+        if dispatch.active_dispatcher is not None:
+            # the dispatcher is receiving all messages on the server, possibly for several threads at once; take the
+            # next one intended for this receiver
+            msg, source, tag = dispatch.active_dispatcher.receive(source, cls)
+        elif reception_timing_monitor is not None:
             with reception_timing_monitor(cls):
                 msg, source, tag = backend.receive_any(source=None)
         else:
@@ -129,20 +136,37 @@ class MessageWithResponse(Message, metaclass=MessageWithResponseMetaClass):
         return self._response_class.receive(receiving_from).contents
 
 class BarrierMessageWithResponse(MessageWithResponse):
-    """An extension of the message class where the client blocks until all processes have made the request, and then the server responds"""
-    _current_barrier_message = None
+    """An extension of the message class where the client blocks until all processes have made the request, and then the server responds
+
+    All worker processes take part, unless within_group is True, in which case only the workers in the sender's server
+    group take part (see groups.py)."""
+    _current_barrier_messages = {}
+    within_group = False
+
+    def _participants(self):
+        from . import groups
+        if self.within_group:
+            return groups.workers_in_group_of(self.source)
+        else:
+            return groups.worker_ranks()
+
+    def _barrier_key(self):
+        from . import groups
+        return groups.group_of_rank(self.source) if self.within_group else None
+
     def process(self):
-        from . import backend
-        if BarrierMessageWithResponse._current_barrier_message is None:
-            BarrierMessageWithResponse._current_barrier_message = self
-            BarrierMessageWithResponse._current_barrier_message._all_sources = [self.source]
+        key = self._barrier_key()
+        current = BarrierMessageWithResponse._current_barrier_messages.get(key, None)
+        if current is None:
+            current = BarrierMessageWithResponse._current_barrier_messages[key] = self
+            current._all_sources = [self.source]
         else:
-            self.assert_consistent(BarrierMessageWithResponse._current_barrier_message)
-            assert self.source not in BarrierMessageWithResponse._current_barrier_message._all_sources
-            BarrierMessageWithResponse._current_barrier_message._all_sources.append(self.source)
+            self.assert_consistent(current)
+            assert self.source not in current._all_sources
+            current._all_sources.append(self.source)
 
-        if len(BarrierMessageWithResponse._current_barrier_message._all_sources) == backend.size()-1:
-            BarrierMessageWithResponse._current_barrier_message = None
+        if len(current._all_sources) == len(self._participants()):
+            del BarrierMessageWithResponse._current_barrier_messages[key]
             self.process_global()
 
     def process_global(self):
@@ -153,9 +177,8 @@ class BarrierMessageWithResponse(MessageWithResponse):
         assert self.contents == original_message.contents
 
     def respond(self, response):
-        from . import backend
         response = self._response_class(response)
-        for i in range(1, backend.size()):
+        for i in self._participants():
             response.send(i)
 
 
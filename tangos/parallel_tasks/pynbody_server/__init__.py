@@ -4,11 +4,12 @@ import time
 
 import numpy as np
 import pynbody
+import pynbody.halo.details.particle_indices
 import pynbody.snapshot.copy_on_access
 
 import tangos.parallel_tasks.pynbody_server.snapshot_queue
 
-from .. import log, remote_import
+from .. import groups, log, remote_import
 from ..async_message import AsyncProcessedMessage
 from ..message import ExceptionMessage, Message
 from . import shared_object_catalogue, snapshot_queue, transfer_array
@@ -16,6 +17,8 @@ from .snapshot_queue import (
     ConfirmLoadPynbodySnapshot,
     ReleasePynbodySnapshot,
     RequestLoadPynbodySnapshot,
+    RequestCancelPrefetchPynbodySnapshot,
+    RequestPrefetchPynbodySnapshot,
     _server_queue,
 )
 
@@ -59,6 +62,48 @@ class ReturnPynbodyArray(Message):
         # send contents
         transfer_array.send_array(self.contents, destination, use_shared_memory=self.shared_mem)
 
+class ReturnPynbodyArrays(Message):
+    """Return several arrays at once, in response to a RequestPynbodyArrays message.
+
+    Each entry in contents is either an array or, if that array could not be retrieved, the exception raised."""
+
+    def __init__(self, contents, shared_mem = False):
+        self.shared_mem = shared_mem
+        super().__init__(contents)
+
+    @classmethod
+    def deserialize(cls, source, message):
+        units_or_exceptions, shared_mem = pickle.loads(message)
+
+        contents = []
+        for units_or_exception in units_or_exceptions:
+            if isinstance(units_or_exception, Exception):
+                contents.append(units_or_exception)
+                continue
+            array = transfer_array.receive_array(source, use_shared_memory=shared_mem)
+            if units_or_exception is not None:
+                if not isinstance(array, pynbody.array.SimArray):
+                    array = array.view(pynbody.array.SimArray)
+                array.units = units_or_exception
+            contents.append(array)
+
+        obj = cls(contents, shared_mem=shared_mem)
+        obj.source = source
+        return obj
+
+    def serialize(self):
+        units_or_exceptions = [c if isinstance(c, Exception) else getattr(c, 'units', None) for c in self.contents]
+        return pickle.dumps((units_or_exceptions, self.shared_mem))
+
+    def send(self, destination):
+        # send envelope
+        super().send(destination)
+
+        # send contents
+        for c in self.contents:
+            if not isinstance(c, Exception):
+                transfer_array.send_array(c, destination, use_shared_memory=self.shared_mem)
+
 class BuildRemoteTree(AsyncProcessedMessage):
     def process_async(self):
         log.logger.debug("Processing tree build request from %d", self.source)
@@ -174,6 +219,41 @@ class RequestPynbodyArray(AsyncProcessedMessage):
         gc.collect()
         log.logger.debug("Array sent after %.2fs"%(time.time()-start_time))
 
+class RequestPynbodyArrays(RequestPynbodyArray):
+    """Request several arrays from the same subsnap (and family) in a single round trip"""
+    def __init__(self, filter_or_object_spec, arrays, fam=None, request_sent_time=None):
+        super().__init__(filter_or_object_spec, arrays, fam, request_sent_time)
+
+    def process_async(self):
+        start_time = time.time()
+        self._time_to_start_processing.append(start_time - self.request_sent_time)
+
+        try:
+            log.logger.debug("Receive request for arrays %r from %d", self.array, self.source)
+            subsnap = _server_queue.get_subsnap(self.filter_or_object_spec, self.fam)
+            transfer_via_shared_mem = _server_queue.current_shared_mem_flag
+
+            subarrays = []
+            with subsnap.immediate_mode, subsnap.lazy_derive_off:
+                for array_name in self.array:
+                    try:
+                        if subsnap._array_name_implies_ND_slice(array_name):
+                            raise KeyError("Not transferring a single slice %r of a ND array" % array_name)
+                        subarray = subsnap[array_name]
+                        assert isinstance(subarray, pynbody.array.SimArray)
+                        subarrays.append(subarray)
+                    except Exception as e:
+                        subarrays.append(e)
+            arrays_result = ReturnPynbodyArrays(subarrays, transfer_via_shared_mem)
+
+        except Exception as e:
+            arrays_result = ExceptionMessage(e)
+
+        arrays_result.send(self.source)
+        del arrays_result
+        gc.collect()
+        log.logger.debug("Arrays sent after %.2fs"%(time.time()-start_time))
+
 class RequestIndexList(RequestPynbodyArray):
     def __init__(self, filter_or_object_spec, request_sent_time=None):
         super().__init__(filter_or_object_spec, 'remote-index-list', None, request_sent_time)
@@ -202,6 +282,50 @@ class RequestIndexList(RequestPynbodyArray):
         log.logger.debug("Array sent after %.2fs"%(time.time()-start_time))
 
 
+class ReturnRegionIndexLists(Message):
+    """Return the index lists of several regions, in response to a RequestRegionIndexLists message.
+
+    The index lists are concatenated into one array, with a second array giving the start and stop of each region,
+    so that only two arrays are transferred however many regions were requested."""
+
+    def serialize(self):
+        return None
+
+    @classmethod
+    def deserialize(cls, source, message):
+        index_list = transfer_array.receive_array(source)
+        boundaries = transfer_array.receive_array(source)
+        obj = cls(pynbody.halo.details.particle_indices.HaloParticleIndices(index_list, boundaries))
+        obj.source = source
+        return obj
+
+    def send(self, destination):
+        # send envelope
+        super().send(destination)
+
+        # send contents
+        transfer_array.send_array(self.contents.particle_index_list, destination)
+        transfer_array.send_array(self.contents.particle_index_list_boundaries, destination)
+
+class RequestRegionIndexLists(AsyncProcessedMessage):
+    """Request the index lists of several regions (pynbody filters) of the whole snapshot in a single round trip"""
+    def process_async(self):
+        start_time = time.time()
+        try:
+            log.logger.debug("Receive request for %d region index lists from %d", len(self.contents), self.source)
+            snapshot = _server_queue.current_snapshot
+            index_lists = [snapshot[filt].get_index_list(snapshot) for filt in self.contents]
+            lengths = np.array([len(index_list) for index_list in index_lists])
+            boundaries = np.stack((np.cumsum(lengths) - lengths, np.cumsum(lengths)), axis=1)
+            result = ReturnRegionIndexLists(pynbody.halo.details.particle_indices.HaloParticleIndices(
+                np.concatenate(index_lists), boundaries))
+        except Exception as e:
+            result = ExceptionMessage(e)
+
+        result.send(self.source)
+        log.logger.debug("Region index lists sent after %.2fs", time.time()-start_time)
+
+
 class ReturnPynbodySubsnapInfo(Message):
     def __init__(self, families, sizes, properties, loadable_keys, fam_loadable_keys):
         super().__init__()
@@ -305,6 +429,35 @@ class RemoteSnap(pynbody.snapshot.copy_on_access.UnderlyingClassMixin, pynbody.s
         except KeyError:
             self._unavailable_arrays.append((array_name, fam))
             raise OSError("No such array %r available from the remote"%array_name)
+        self._create_array_from_remote(array_name, fam, data)
+
+    def preload_arrays(self, array_names, fam=None):
+        """Fetch all the named arrays that are not yet present in a single round trip to the server.
+
+        Arrays that are not available from the remote are skipped silently (an error will be raised if they are
+        subsequently accessed and cannot be derived)."""
+        present = self.keys() + self.family_keys(fam)
+        loadable = self.loadable_keys(fam)
+        array_names = [a for a in dict.fromkeys(array_names)
+                       if a in loadable and a not in present and (a, fam) not in self._unavailable_arrays]
+        if len(array_names)==0:
+            return
+
+        RequestPynbodyArrays(self._filter_or_object_spec, array_names, fam).send(self._server_id)
+        start_time = time.time()
+        log.logger.debug("Send request for %d arrays", len(array_names))
+        results = ReturnPynbodyArrays.receive(self._server_id).contents
+        log.logger.debug("Arrays received; waited %.2fs", time.time() - start_time)
+
+        for array_name, data in zip(array_names, results):
+            if isinstance(data, KeyError):
+                self._unavailable_arrays.append((array_name, fam))
+            elif isinstance(data, Exception):
+                raise data
+            else:
+                self._create_array_from_remote(array_name, fam, data)
+
+    def _create_array_from_remote(self, array_name, fam, data):
         with self.auto_propagate_off:
             if len(data.shape)==1:
                 ndim = 1
@@ -339,8 +492,23 @@ class RemoteSnap(pynbody.snapshot.copy_on_access.UnderlyingClassMixin, pynbody.s
 
 
 
+def prefetch_remote_snapshot(input_handler, ts_extension, server_id=None, shared_mem=False, build_tree=False):
+    """Ask the server to start loading a snapshot in the background, ready for a later RemoteSnapshotConnection"""
+    if server_id is None:
+        server_id = groups.snapshot_server_rank()
+    remote_import.ImportRequestMessage(__name__).send(server_id)
+    RequestPrefetchPynbodySnapshot((input_handler, ts_extension, shared_mem, build_tree)).send(server_id)
+
+def cancel_remote_snapshot_prefetch(ts_extension, server_id=None):
+    """Tell the server that a snapshot previously passed to prefetch_remote_snapshot will not be needed after all"""
+    if server_id is None:
+        server_id = groups.snapshot_server_rank()
+    remote_import.ImportRequestMessage(__name__).send(server_id)
+    RequestCancelPrefetchPynbodySnapshot(ts_extension).send(server_id)
+
+
 class RemoteSnapshotConnection:
-    def __init__(self, input_handler, ts_extension, server_id=0, shared_mem=False):
+    def __init__(self, input_handler, ts_extension, server_id=None, shared_mem=False):
 
         from ...input_handlers import pynbody
         assert isinstance(input_handler, pynbody.PynbodyInputHandler)
@@ -352,6 +520,9 @@ class RemoteSnapshotConnection:
 
         super().__init__()
 
+        if server_id is None:
+            server_id = groups.snapshot_server_rank()
+
         self._server_id = server_id
         self._input_handler = input_handler
         self._has_tree = False
@@ -411,6 +582,16 @@ class RemoteSnapshotConnection:
         RequestIndexList(filter_or_object_spec).send(self._server_id)
         return ReturnPynbodyArray.receive(self._server_id).contents
 
+    def get_region_index_lists(self, filters):
+        """Return the index lists of the regions selected by each of the given pynbody filters, which the server
+        resolves (using its KD-tree, if it has built one) in a single round trip"""
+        filters = list(filters)
+        if len(filters)==0:
+            return []
+        RequestRegionIndexLists(filters).send(self._server_id)
+        indices = ReturnRegionIndexLists.receive(self._server_id).contents
+        return [indices.particle_index_list[start:stop] for start, stop in indices.particle_index_list_boundaries]
+
     def disconnect(self):
 
         if not self.connected:
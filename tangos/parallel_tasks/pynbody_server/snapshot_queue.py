@@ -1,9 +1,12 @@
 import multiprocessing
+import threading
 
 import pynbody
 
 from ...parallel_tasks.async_message import AsyncProcessedMessage
 from ...parallel_tasks.message import Message
+from ...util import memory
+from ...util.cache_dict import SizeBoundedCacheDict
 from ...util.check_deleted import check_deleted
 from .. import config, log
 
@@ -12,6 +15,62 @@ class ConfirmLoadPynbodySnapshot(Message):
     pass
 
 
+def _load_snapshot(handler, filename, shared_mem):
+    snapshot = handler.load_timestep(filename)
+    if shared_mem:
+        snapshot._shared_arrays = True
+    snapshot.physical_units()
+    return snapshot
+
+def _build_tree(snapshot, shared_mem):
+    if not hasattr(snapshot, "kdtree"):
+        log.logger.info("Building KDTree")
+        if config.pynbody_build_kdtree_all_cpus:
+            # get number of processors on this system using python multiprocessing module
+            num_threads = multiprocessing.cpu_count()
+        else:
+            num_threads = None
+        snapshot.wrap() # Because we have converted pos to kpc, FP roundoff may place particles at the boundaries outside the period of the box.
+        snapshot.build_tree(num_threads=num_threads, shared_mem=shared_mem)
+
+def _new_subsnap_cache():
+    if config.pynbody_server_subsnap_cache_limit is None:
+        max_size = None
+    else:
+        max_size = config.pynbody_server_subsnap_cache_limit * 1024**3
+    return SizeBoundedCacheDict(max_size, memory.estimate_pynbody_snapshot_size, memory_governed=True,
+                                name="pynbody server subsnaps")
+
+
+class PrefetchedSnapshot:
+    """A snapshot being loaded (and optionally having its KDTree built) in a background thread"""
+    def __init__(self, handler, filename, shared_mem, build_tree):
+        self.handler = handler
+        self.filename = filename
+        self.shared_mem = shared_mem
+        self.build_tree = build_tree
+        self._snapshot = None
+        self._error = None
+        self._thread = threading.Thread(target=self._load)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _load(self):
+        try:
+            self._snapshot = _load_snapshot(self.handler, self.filename, self.shared_mem)
+            if self.build_tree:
+                _build_tree(self._snapshot, self.shared_mem)
+        except Exception as e:
+            self._error = e
+
+    def result(self):
+        """Wait for the background load to complete, then return the snapshot (or raise the error that occurred)"""
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+        return self._snapshot
+
+
 
 class PynbodySnapshotQueue:
     def __init__(self):
@@ -21,10 +80,12 @@ class PynbodySnapshotQueue:
         self.load_requester_queue = []
         self.current_timestep = None
         self.current_snapshot = None
-        self.current_subsnap_cache = {}
+        self.current_subsnap_cache = _new_subsnap_cache()
+        self.current_family_subsnaps = {}
         self.current_handler = None
         self.current_portable_catalogues = {}
         self.in_use_by = []
+        self.prefetched = {}
 
 
     def add(self, requester, handler, filename, shared_mem=False):
@@ -46,6 +107,48 @@ class PynbodySnapshotQueue:
             self.shared_mem_queue.append(shared_mem)
         self._load_next_if_free()
 
+    def prefetch(self, handler, filename, shared_mem=False, build_tree=False):
+        """Start loading filename in the background, so that it is ready by the time clients request it.
+
+        At most config.pynbody_server_prefetch_depth snapshots are prefetched at once, and none are prefetched if
+        doing so is estimated to take the server beyond config.pynbody_server_prefetch_memory_limit"""
+        if filename==self.current_timestep or filename in self.prefetched:
+            return
+        if len(self.prefetched)>=config.pynbody_server_prefetch_depth:
+            log.logger.debug("Pynbody server: not prefetching %r; prefetch depth reached", filename)
+            return
+        if not self._memory_allows_prefetch():
+            log.logger.info("Pynbody server: not prefetching %r; memory limit would be exceeded", filename)
+            return
+
+        log.logger.info("Pynbody server: prefetching %r in the background", filename)
+        self.prefetched[filename] = PrefetchedSnapshot(handler, filename, shared_mem, build_tree)
+
+    def cancel_prefetch(self, filename):
+        """Discard any prefetch of filename, since no client is going to request it"""
+        if self.prefetched.pop(filename, None) is not None:
+            log.logger.info("Pynbody server: discarding prefetched %r which is not needed", filename)
+
+    def _memory_allows_prefetch(self):
+        limits = [l for l in (config.pynbody_server_prefetch_memory_limit, config.memory_budget) if l is not None]
+        if len(limits)==0:
+            return True
+        num_resident = len(self.prefetched) + (self.current_snapshot is not None)
+        if num_resident==0:
+            return True
+        rss = memory.get_resident_set_size()
+        if rss is None:
+            return True
+        # assume the next snapshot will take up as much memory as the ones already resident
+        estimated_rss = rss * (num_resident+1) / num_resident
+        return estimated_rss <= min(limits) * 1024**3
+
+    def _discard_stale_prefetches(self):
+        for filename in list(self.prefetched.keys()):
+            if filename not in self.timestep_queue:
+                log.logger.info("Pynbody server: discarding prefetched %r which was never requested", filename)
+                del self.prefetched[filename]
+
     def free(self, requester):
         self.in_use_by.remove(requester)
         log.logger.debug("Pynbody server: client %d is now finished with %r", requester, self.current_timestep)
@@ -57,18 +160,18 @@ class PynbodySnapshotQueue:
             if fam is None:
                 return self.current_snapshot
             else:
-                if fam not in self.current_subsnap_cache.keys():
-                    self.current_subsnap_cache[fam] = self.current_snapshot[fam]
-                return self.current_subsnap_cache[fam]
+                if fam not in self.current_family_subsnaps.keys():
+                    self.current_family_subsnaps[fam] = self.current_snapshot[fam]
+                return self.current_family_subsnaps[fam]
 
-        elif (filter_or_object_spec, fam) in self.current_subsnap_cache:
+        subsnap = self.current_subsnap_cache.get((filter_or_object_spec, fam))
+        if subsnap is not None:
             log.logger.debug("Pynbody server: cache hit for %r (fam %r)",filter_or_object_spec, fam)
-            return self.current_subsnap_cache[(filter_or_object_spec, fam)]
         else:
             log.logger.debug("Pynbody server: cache miss for %r (fam %r)",filter_or_object_spec, fam)
             subsnap = self.get_subsnap_uncached(filter_or_object_spec, fam)
             self.current_subsnap_cache[(filter_or_object_spec, fam)] = subsnap
-            return subsnap
+        return subsnap
 
     def get_subsnap_uncached(self, filter_or_object_spec, fam):
 
@@ -103,16 +206,7 @@ class PynbodySnapshotQueue:
             return self.current_portable_catalogues[type_tag]
 
     def build_tree(self):
-        if not hasattr(self.current_snapshot, "kdtree"):
-            log.logger.info("Building KDTree")
-            if config.pynbody_build_kdtree_all_cpus:
-                # get number of processors on this system using python multiprocessing module
-                num_threads = multiprocessing.cpu_count()
-            else:
-                num_threads = None
-            self.current_snapshot.wrap() # Because we have converted pos to kpc, FP roundoff may place particles at the boundaries outside the period of the box.
-            self.current_snapshot.build_tree(num_threads=num_threads,
-                                             shared_mem=self.current_shared_mem_flag)
+        _build_tree(self.current_snapshot, self.current_shared_mem_flag)
 
     def _free_if_unused(self):
         if len(self.in_use_by)==0:
@@ -124,13 +218,22 @@ class PynbodySnapshotQueue:
                 log.logger.info("    Summed process waiting time: %.1fs", RequestPynbodyArray.get_total_wait_time())
                 RequestPynbodyArray.reset_performance_stats()
 
+            self._log_subsnap_cache_stats()
+
             with check_deleted(self.current_snapshot):
                 self.current_snapshot = None
                 self.current_timestep = None
-                self.current_subsnap_cache = {}
+                self.current_subsnap_cache = _new_subsnap_cache()
+                self.current_family_subsnaps = {}
                 self.current_portable_catalogues = {}
                 self.current_handler = None
 
+    def _log_subsnap_cache_stats(self):
+        cache = self.current_subsnap_cache
+        if cache.hits + cache.misses > 0:
+            log.logger.info("    Subsnap cache: %d hits, %d misses, %d evictions; peak size %.1f MB",
+                            cache.hits, cache.misses, cache.evictions, cache.peak_size / 1024**2)
+
     def _notify_available(self, node):
         log.logger.debug("Pynbody server: notify %d that snapshot is now available", node)
         ConfirmLoadPynbodySnapshot(type(self.current_snapshot)).send(node)
@@ -150,13 +253,30 @@ class PynbodySnapshotQueue:
             self.current_shared_mem_flag = self.shared_mem_queue.pop(0)
             notify = self.load_requester_queue.pop(0)
 
+            prefetched = self.prefetched.pop(self.current_timestep, None)
+            if prefetched is not None and prefetched.shared_mem != self.current_shared_mem_flag:
+                prefetched = None
+            self._discard_stale_prefetches()
+            self.current_subsnap_cache = _new_subsnap_cache()
+
+            self.current_snapshot = None
+            if prefetched is not None:
+                try:
+                    self.current_snapshot = prefetched.result()
+                    log.logger.info("Pynbody server: using prefetched %r", self.current_timestep)
+                except Exception as e:
+                    # prefetching is only an optimisation; load again below, so that any error is raised as it
+                    # would have been without the prefetch
+                    log.logger.warning("Pynbody server: prefetch of %r failed (%r); loading it again",
+                                       self.current_timestep, e)
+
             try:
-                self.current_snapshot = self.current_handler.load_timestep(self.current_timestep)
-                log.logger.info("Pynbody server: loaded %r", self.current_timestep)
+                if self.current_snapshot is None:
+                    self.current_snapshot = _load_snapshot(self.current_handler, self.current_timestep,
+                                                           self.current_shared_mem_flag)
+                    log.logger.info("Pynbody server: loaded %r", self.current_timestep)
                 if self.current_shared_mem_flag:
                     log.logger.info("                (shared memory mode)")
-                    self.current_snapshot._shared_arrays = True
-                self.current_snapshot.physical_units()
                 success = True
             except OSError:
                 success = False
@@ -187,6 +307,16 @@ class RequestLoadPynbodySnapshot(AsyncProcessedMessage):
         _server_queue.add(self.source, *self.contents)
 
 
+class RequestPrefetchPynbodySnapshot(AsyncProcessedMessage):
+    def process(self):
+        _server_queue.prefetch(*self.contents)
+
+
+class RequestCancelPrefetchPynbodySnapshot(AsyncProcessedMessage):
+    def process(self):
+        _server_queue.cancel_prefetch(self.contents)
+
+
 class ReleasePynbodySnapshot(AsyncProcessedMessage):
     def process(self):
         _server_queue.free(self.source)
@@ -4,9 +4,12 @@
 
 import importlib
 
+from . import dispatch
 from .message import Message
 
 
 class ImportRequestMessage(Message):
+    dispatch_lane = dispatch.MAIN_THREAD
+
     def process(self):
         importlib.import_module(self.contents)
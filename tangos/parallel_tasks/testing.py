@@ -1,3 +1,5 @@
+import threading
+
 from .message import Message
 
 FILENAME = "parallel_tasks_test_log.txt"
@@ -16,9 +18,21 @@ def get_log(remove_process_ids=False):
         return [processor(s) for s in f.readlines()]
 
 def log(message):
-    ServerLogMessage(message).send(0)
+    from . import backend
+    if backend.rank()==0:
+        # written immediately, so that it is ordered correctly relative to the log messages of clients even when
+        # server messages are processed concurrently (see config.server_concurrent_dispatch)
+        _write_log(0, message)
+    else:
+        ServerLogMessage(message).send(0)
+
+def _write_log(source, message):
+    with _log_lock:
+        with open(FILENAME, "a") as f:
+            f.write(f"[{source:d}] {message:s}\r\n")
+
+_log_lock = threading.Lock()
 
 class ServerLogMessage(Message):
     def process(self):
-        with open(FILENAME, "a") as f:
-            f.write(f"[{self.source:d}] {self.contents:s}\r\n")
+        _write_log(self.source, self.contents)
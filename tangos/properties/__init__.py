@@ -48,6 +48,10 @@ class PropertyCalculation(metaclass=PropertyCalculationMetaClass):
     # (avoids re-querying the database for missing objects)
     __no_result = object()
 
+    # Dictionary of intermediate results shared between calculators working on the same object; set by
+    # tangos write (see get_scratch_value)
+    scratch = None
+
     @classmethod
     def all_classes(cls):
         return cls._all_classes
@@ -98,6 +102,12 @@ class PropertyCalculation(metaclass=PropertyCalculationMetaClass):
         required to calculate this property"""
         return []
 
+    def requires_particle_arrays(self):
+        """Returns a list of names of particle arrays that calculate() will access.
+
+        This is optional, but allows the data to be fetched in bulk when it is being provided by a remote server"""
+        return []
+
     def preloop(self, sim, db_timestep):
         """Perform one-per-snapshot calculations, given the loaded simulation data and TimeStep object"""
         pass
@@ -115,6 +125,23 @@ class PropertyCalculation(metaclass=PropertyCalculationMetaClass):
         """Called by subfunctions to mark a time"""
         self.timing_monitor.mark(label)
 
+    def get_scratch_value(self, key, generate):
+        """Return an intermediate result that can be shared between all calculations on the current object
+
+        The first time a given key is requested for an object, generate() is called and its result is stored; later
+        requests for the same key, including from other property calculators, return the stored value. The store is
+        emptied by tangos write each time it moves on to a new object. Outside tangos write (e.g. in live
+        calculations), nothing is stored and generate() is called every time.
+
+        Keys should be declared as constants alongside the code that generates them, so that different calculators
+        agree on their meaning; see for example properties.pynbody.centring. Stored values must not be modified.
+        """
+        if self.scratch is None:
+            return generate()
+        if key not in self.scratch:
+            self.scratch[key] = generate()
+        return self.scratch[key]
+
 
     def accept(self, db_entry):
         for x in self.requires_property():
@@ -134,6 +161,27 @@ class PropertyCalculation(metaclass=PropertyCalculationMetaClass):
         """
         raise NotImplementedError
 
+    def calculate_batch(self, timestep_data, halo_entries):
+        """Calculate the properties for many objects in a timestep at once
+
+        Implementing this is optional. If it is overridden, tangos write calls it once per timestep (when
+        each process loads entire timesteps) instead of calling calculate() for each object. This is useful where
+        a quantity is much cheaper to compute for all objects together, e.g. with a single np.bincount over
+        particle group labels. calculate() should still be implemented, since it is used in other load modes.
+        If the batch cannot be handled for these objects (e.g. there is no group catalogue for their type), raise
+        NotImplementedError and tangos write will call calculate() for each object instead.
+
+        :param timestep_data: The raw particle data for the entire timestep, if available
+        :param halo_entries: The existing properties of each object for which a result is required
+        :return: A list with one entry per object, each in the format returned by calculate()
+        """
+        raise NotImplementedError
+
+    @classmethod
+    def supports_batch_calculation(cls):
+        """Returns True if this class overrides calculate_batch"""
+        return cls.calculate_batch is not PropertyCalculation.calculate_batch
+
     def live_calculate(self, halo_entry, *input_values):
         """Calculate the result of a function, using the existing data in the database alone
 
@@ -164,6 +212,28 @@ class PropertyCalculation(metaclass=PropertyCalculationMetaClass):
         else:
             return values[self.names.index(name)]
 
+    def live_calculate_batch(self, name, halo_entries, *input_columns):
+        """Calculate the result of a function for many objects at once, using the existing data in the database alone
+
+        Implementing this is optional. If it is overridden, the live calculation system calls it with whole columns of
+        inputs (e.g. for every object in a timestep) instead of calling live_calculate_named for each object. This is
+        useful where the calculation only combines its inputs, and can therefore be done with a few numpy operations.
+        If the batch cannot be handled (e.g. the input arrays have different lengths), raise NotImplementedError and
+        live_calculate_named will be called for each object instead.
+
+        :param name: The name of the one property to return (which must be one of the values specified by self.names)
+        :param halo_entries: The database objects, all in the same timestep, for which a result is required
+        :param input_columns: For each input to the function, a numpy array of its value for each object. None never
+                              appears in these arrays; objects with missing inputs are not calculated.
+        :return: A list or array with one entry per object, each in the format returned by live_calculate_named
+        """
+        raise NotImplementedError
+
+    @classmethod
+    def supports_batch_live_calculation(cls):
+        """Returns True if this class overrides live_calculate_batch"""
+        return cls.live_calculate_batch is not PropertyCalculation.live_calculate_batch
+
     def calculate_from_db(self, db):
         if self.requires_particle_data:
             region_spec =  self.region_specification(db)
@@ -2,7 +2,7 @@
 
 import numpy as np
 
-from . import LivePropertyCalculation
+from . import LivePropertyCalculation, PropertyCalculation
 
 
 class AtPosition(LivePropertyCalculation):
@@ -15,6 +15,26 @@ class AtPosition(LivePropertyCalculation):
     def live_calculate(self, halo, pos, ar):
         return self._array_info.get_interpolated_value(pos, ar)
 
+    def live_calculate_batch(self, name, halos, pos, ar):
+        if ar.ndim!=2 or type(self._array_info).get_interpolated_value is not \
+                PropertyCalculation.get_interpolated_value:
+            # profiles of different lengths, or a custom interpolation
+            raise NotImplementedError
+        x0 = self._array_info.plot_x0()
+        delta_x = self._array_info.plot_xdelta()
+
+        # as get_interpolated_value, for all positions at once
+        i0 = np.trunc((pos - x0) / delta_x).astype(int)
+        i1 = i0 + 1
+        i1_weight = (pos - (i0 * delta_x + x0)) / delta_x
+        i0_weight = 1.0 - i1_weight
+
+        valid = (i1 < ar.shape[1]) & (i0 >= 0)
+        rows = np.arange(len(ar))
+        results = np.empty(len(ar), dtype=object)
+        results[valid] = list(ar[rows[valid], i0[valid]] * i0_weight[valid] + ar[rows[valid], i1[valid]] * i1_weight[valid])
+        return results
+
 
 
 class MaxMinProperty(LivePropertyCalculation):
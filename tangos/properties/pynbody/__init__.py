@@ -6,6 +6,40 @@ class PynbodyPropertyCalculation(PropertyCalculation):
     works_with_handler = pynbody_handler_module.PynbodyInputHandler
     requires_particle_data = True
 
+    @staticmethod
+    def get_group_labels(timestep_data, halo_entries):
+        """For use in calculate_batch: return an array giving the index in halo_entries of the halo that each particle
+        in timestep_data belongs to, or -1 if it belongs to none of them.
+
+        Each particle is assigned to at most one halo, following pynbody's get_group_array; so for halo finders where
+        halos overlap, results will differ from those calculated halo-by-halo.
+
+        The labels are taken from the catalogue for the entries' own object type. NotImplementedError is raised if
+        the entries are of mixed types or the input handler has no catalogue for their type (e.g. trackers), in which
+        case tangos write falls back to calculating the objects one by one."""
+        import numpy as np
+
+        from ...core.halo import SimulationObjectBase
+
+        typecodes = {entry.object_typecode for entry in halo_entries}
+        if len(typecodes) != 1:
+            raise NotImplementedError("Group labels can only be generated for objects of a single type")
+        object_typetag = SimulationObjectBase.object_typetag_from_code(typecodes.pop())
+
+        timestep = halo_entries[0].timestep
+        try:
+            catalogue = timestep.simulation.get_output_handler().get_catalogue(timestep.extension, object_typetag)
+        except ValueError as e:
+            raise NotImplementedError(f"No catalogue is available for objects of type {object_typetag!r}") from e
+        group_array = np.asarray(catalogue.get_group_array())
+
+        finder_ids = np.array([entry.finder_id for entry in halo_entries])
+        order = np.argsort(finder_ids)
+        position = np.clip(np.searchsorted(finder_ids, group_array, sorter=order), 0, len(finder_ids)-1)
+        labels = order[position]
+        labels[(finder_ids[labels] != group_array) | (group_array < 0)] = -1
+        return labels
+
 PynbodyHaloProperties = PynbodyPropertyCalculation # old name, to be deprecated
 
 from . import BH, SF, centring, eagle, gas, images, mass, profile, radius, zoom
@@ -11,6 +11,9 @@ from .spherical_region import SphericalRegionPropertyCalculation
 class CentreAndRadius(PynbodyPropertyCalculation):
     names = "shrink_center", "max_radius"
 
+    def requires_particle_arrays(self):
+        return ['pos', 'mass']
+
     def calculate(self, halo, existing_properties):
         dm_center, dm_max_radius = self._get_centre_and_max_radius(halo.dm)
         return dm_center, dm_max_radius
@@ -78,13 +81,58 @@ class CentreAndRadiusComoving(LivePropertyCalculation):
         return halo['shrink_center']/scalefactor, halo['max_radius']/scalefactor
 
 
+# Scratch keys (see PropertyCalculation.get_scratch_value) for the recentred positions of a snapshot, and for the
+# sorted radii and enclosed masses of particles once recentred
+RECENTRED_POSITIONS = "centring.recentred_positions"
+SORTED_RADII = "centring.sorted_radii"
+
 @contextlib.contextmanager
-def _recenter(halo, centre):
+def _recenter(halo, centre, calculator=None):
+    """Recentre and wrap halo on centre, restoring the original positions on exit.
+
+    If calculator is given, the recentred positions are kept in its scratch store, so that subsequent calculations
+    on the same object with the same centre only need to copy them into place."""
     original_positions = np.array(halo['pos'])  # take a copy so we can put everything back at the end
-    halo['pos'] -= centre
-    halo.wrap()
-    yield
-    halo['pos'] = original_positions
+
+    generated = []
+    def generate():
+        generated.append(True)
+        halo['pos'] -= centre
+        halo.wrap()
+        return np.array(halo['pos'])
+
+    if calculator is None:
+        generate()
+    else:
+        recentred_positions = calculator.get_scratch_value(_scratch_key(RECENTRED_POSITIONS, halo, centre), generate)
+        if not generated:
+            halo['pos'] = recentred_positions
+    try:
+        yield
+    finally:
+        halo['pos'] = original_positions
+
+def centred_sorted_radii(calculator, particle_data, centre, family=None):
+    """Return the sorted radii of particles in particle_data (optionally only the given family), and the mass
+    enclosed within each radius, with an extra leading zero so that enclosed_mass[i] is the mass of the i closest
+    particles.
+
+    particle_data must already be recentred on centre, e.g. inside a centred_calculation. Both arrays are plain
+    numpy arrays in the simulation units, and are shared through the scratch store of calculator."""
+    def generate():
+        data = particle_data if family is None else particle_data[family]
+        pos = data['pos'].view(np.ndarray)
+        radii = np.sqrt((pos ** 2).sum(axis=1))
+        order = np.argsort(radii)
+        enclosed_mass = np.concatenate(([0.0], np.cumsum(data['mass'].view(np.ndarray)[order], dtype=np.float64)))
+        return radii[order], enclosed_mass
+
+    key = _scratch_key(SORTED_RADII, particle_data, centre) + (str(family),)
+    return calculator.get_scratch_value(key, generate)
+
+def _scratch_key(name, particle_data, centre):
+    # the scratch store is emptied between objects, during which the snapshot stays alive, so its id is unique
+    return name, id(particle_data), np.asarray(centre).tobytes()
 
 
 def centred_calculation(fn):
@@ -93,7 +141,7 @@ def centred_calculation(fn):
     def new_fn(self, halo, existing_properties):
         # Note that we recenter halo.ancestor i.e. the whole snapshot, if it is loaded into memory, so that there
         # is no confusion when performing whole-snapshot operations such as smoothing/density calculations.
-        with _recenter(halo.ancestor, existing_properties['shrink_center']):
+        with _recenter(halo.ancestor, existing_properties['shrink_center'], self):
             return fn(self, halo, existing_properties)
 
     return new_fn
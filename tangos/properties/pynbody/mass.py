@@ -4,6 +4,9 @@ from . import PynbodyPropertyCalculation
 class Masses(PynbodyPropertyCalculation):
     names = "finder_mass"
 
+    def requires_particle_arrays(self):
+        return ['mass']
+
     def calculate(self, halo, existing_properties):
         return halo['mass'].sum()
 
@@ -11,5 +14,8 @@ class Masses(PynbodyPropertyCalculation):
 class MassBreakdown(PynbodyPropertyCalculation):
     names = "finder_dm_mass", "finder_star_mass", "finder_gas_mass"
 
+    def requires_particle_arrays(self):
+        return ['mass']
+
     def calculate(self, halo, existing_properties):
         return halo.dm['mass'].sum(), halo.star['mass'].sum(), halo.gas['mass'].sum()
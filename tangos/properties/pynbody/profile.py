@@ -1,6 +1,6 @@
 import numpy as np
 
-from .centring import centred_calculation
+from .centring import centred_calculation, centred_sorted_radii
 from .spherical_region import SphericalRegionPropertyCalculation
 
 
@@ -25,28 +25,26 @@ class HaloDensityProfile(SphericalRegionPropertyCalculation):
     def plot_ylabel(self):
         return r"$\rho/M_{\odot}\,kpc^{-3}$", r"$M/M_{\odot}$"
 
-    def _get_profile(self, halo, maxrad):
-        import pynbody
+    def _get_profile(self, data, family, existing_properties):
+        # equivalent to the density and mass_enc of a linear pynbody Profile starting from r=0, but using the sorted
+        # radii shared with other calculators on this object
+        radii, enclosed_mass = centred_sorted_radii(self, data, existing_properties['shrink_center'], family)
 
         delta = self.plot_xdelta()
-        nbins = int(maxrad / delta)
+        nbins = int(existing_properties["max_radius"] / delta)
         maxrad = delta * nbins
 
-        pro = pynbody.analysis.profile.Profile(halo, type='lin', ndim=3,
-                                               min=0, max=maxrad, nbins=nbins)
-
-        rho_a = pro['density']
-        mass_a = pro['mass_enc']
-
-        rho_a = rho_a.view(np.ndarray)
-        mass_a = mass_a.view(np.ndarray)
+        bin_edges = np.linspace(0, maxrad, nbins + 1)
+        mass_enc = enclosed_mass[np.searchsorted(radii, bin_edges)]
+        rho_a = np.diff(mass_enc) / (4. / 3. * np.pi * (bin_edges[1:] ** 3 - bin_edges[:-1] ** 3))
 
-        return rho_a, mass_a
+        return rho_a, mass_enc[1:]
 
     @centred_calculation
     def calculate(self, data, existing_properties):
+        import pynbody
 
-        dm_a, dm_b = self._get_profile(data.dm, existing_properties["max_radius"])
+        dm_a, dm_b = self._get_profile(data, pynbody.family.dm, existing_properties)
 
         return dm_a, dm_b
 
@@ -56,6 +54,8 @@ class BaryonicHaloDensityProfile(HaloDensityProfile):
 
     @centred_calculation
     def calculate(self, data, existing_properties):
-        gas_a, gas_b = self._get_profile(data.gas, existing_properties["max_radius"])
-        star_a, star_b = self._get_profile(data.star, existing_properties["max_radius"])
+        import pynbody
+
+        gas_a, gas_b = self._get_profile(data, pynbody.family.gas, existing_properties)
+        star_a, star_b = self._get_profile(data, pynbody.family.star, existing_properties)
         return gas_a, gas_b, star_a, star_b
@@ -1,5 +1,7 @@
+import numpy as np
+
 from . import PynbodyHaloProperties
-from .centring import centred_calculation
+from .centring import centred_calculation, centred_sorted_radii
 
 
 class Radius(PynbodyHaloProperties):
@@ -22,11 +24,26 @@ class Radius(PynbodyHaloProperties):
 
     @centred_calculation
     def calculate(self, particle_data, existing_properties):
-        import pynbody.analysis as analysis
+        import pynbody
         self._ensure_pynbody_mass_array_loaded_family_level(particle_data)
 
-        # Virial radius is calculated using density contributions form all families
-        return analysis.halo.virial_radius(particle_data, overden=self.get_contrast(), rho_def=self.get_rhodef())
+        # Virial radius is calculated using density contributions form all families. This follows
+        # pynbody.analysis.halo.virial_radius, but finds the enclosed mass at each step of the bisection from the
+        # sorted radii (shared with other calculators on this object) rather than by summing over all particles.
+        radii, enclosed_mass = centred_sorted_radii(self, particle_data, existing_properties['shrink_center'])
+
+        if self.get_rhodef() == 'matter':
+            ref_density = particle_data.properties["omegaM0"] * pynbody.analysis.cosmology.rho_crit(particle_data, z=0) \
+                          * (1.0 + particle_data.properties["z"]) ** 3
+        else:
+            ref_density = pynbody.analysis.cosmology.rho_crit(particle_data, z=particle_data.properties["z"])
+        target_rho = self.get_contrast() * ref_density
+
+        def rho(r):
+            return enclosed_mass[np.searchsorted(radii, r)] / (4. * np.pi * (r ** 3) / 3)
+
+        r_max = np.ptp(particle_data['pos'].view(np.ndarray), axis=0).max()
+        return pynbody.util.bisect(0.0, r_max, lambda r: target_rho - rho(r), epsilon=0, eta=1.e-3 * target_rho)
 
     def region_specification(self, existing_properties):
         import pynbody
@@ -36,6 +53,9 @@ class Radius(PynbodyHaloProperties):
     def requires_property(self):
         return ["shrink_center", "max_radius"]
 
+    def requires_particle_arrays(self):
+        return ['pos', 'mass']
+
     @staticmethod
     def _ensure_pynbody_mass_array_loaded_family_level(particle_data):
         # Make sure the mass array is loaded at family level
@@ -1,5 +1,6 @@
 import argparse
 import copy
+import itertools
 import pdb
 import random
 import sys
@@ -16,7 +17,7 @@ from ..cached_writer import insert_list
 from ..log import logger
 from ..parallel_tasks import accumulative_statistics
 from ..parallel_tasks.message import Message
-from ..util import proxy_object, terminalcontroller, timing_monitor
+from ..util import proxy_object, spatial_ordering, terminalcontroller, timing_monitor
 from ..util.check_deleted import check_deleted
 from . import GenericTangosTool
 
@@ -43,6 +44,8 @@ class PropertyWriter(GenericTangosTool):
         self._current_timestep_particle_data = None
         self._current_object_id = None
         self._current_object = None
+        self._batch_calculator_instances = []
+        self._object_scratch = {}
 
     @classmethod
     def add_parser_arguments(self, parser):
@@ -77,6 +80,18 @@ class PropertyWriter(GenericTangosTool):
                                  "  --load-mode server-partial:    a server process figures out the indices to load, which are then passed to the partial loader" \
                                  "  --load-mode all:               each processor loads all the data (default, and often fine for zoom simulations)." \
                                  "  --load-mode server-shared-mem: a server process manages the data, passing to other processes via shared memory")
+        parser.add_argument('--schedule', action='store', choices=['database', 'largest-first', 'spatial'], default='database',
+                            help="Select the order in which objects within a timestep are processed: " \
+                                 "  --schedule database:      in database order, i.e. by halo number (default); " \
+                                 "  --schedule largest-first: in decreasing order of particle count, so that the most expensive " \
+                                 "calculations start first. This reduces the time spent waiting for the last objects in server load modes; " \
+                                 "  --schedule spatial:       in Morton order of the existing shrink_center property, so that consecutive " \
+                                 "objects are close together in the snapshot. Objects without a centre are processed last.")
+        parser.add_argument('--server-groups', action='store', type=int, default=None, metavar='K',
+                            help="In server load modes, split the processes into K groups, each with its own snapshot " \
+                                 "server, so that K timesteps are processed at once (objects within a timestep are " \
+                                 "distributed between the workers in the group). The first process in each group serves " \
+                                 "the snapshot, so at least 2K+1 processes are required.")
         parser.add_argument('--type', action='store', type=str, dest='htype',
                             help="Secify the object type to run on by tag name (or integer). Can be halo, group, or BH.")
         parser.add_argument('--hmin', action='store', type=int, default=0,
@@ -158,6 +173,12 @@ class PropertyWriter(GenericTangosTool):
         if parallel_tasks.backend is None:
             # Go sequentially
             ma_files = self.timesteps_to_process
+        elif self.options.server_groups is not None:
+            # Each group of nodes works on the same timestep, loaded by the group's own server; different groups
+            # work on different timesteps
+            ma_files = parallel_tasks.distributed_to_groups(self.timesteps_to_process,
+                                                            allow_resume=not self.options.no_resume,
+                                                            resumption_id='parallel-timestep-iterator')
         elif self.options.load_mode is not None and self.options.load_mode.startswith('server'):
             # In the case of loading from a centralised server, each node works on the _same_ timestep --
             # parallelism is then implemented at the halo level
@@ -178,6 +199,10 @@ class PropertyWriter(GenericTangosTool):
 
             # First, we need to make a barrier because we can't start writing to the database
             # before all nodes have generated their local work lists
+            if self.options.server_groups is not None:
+                parallel_tasks.group_barrier()
+                return parallel_tasks.distributed(items, allow_resume=False, within_group=True)
+
             parallel_tasks.barrier()
 
             return parallel_tasks.distributed(items, allow_resume=False)
@@ -196,6 +221,11 @@ class PropertyWriter(GenericTangosTool):
         if self.options.load_mode=='all':
             self.options.load_mode=None
 
+        if self.options.server_groups is not None:
+            if not (self.options.load_mode and self.options.load_mode.startswith('server')):
+                raise ValueError("--server-groups can only be used with a server load mode")
+            parallel_tasks.groups.use_server_groups(self.options.server_groups)
+
         if self.options.verbose:
             self.redirect.enabled = False
 
@@ -210,7 +240,8 @@ class PropertyWriter(GenericTangosTool):
             self._include = None
 
     def _is_lead_rank(self):
-        return parallel_tasks.backend is None or parallel_tasks.backend.rank()==1 or self.options.load_mode is None
+        return parallel_tasks.backend is None or self.options.load_mode is None or \
+            parallel_tasks.backend.rank()==parallel_tasks.groups.my_group_lead()
 
     def _log_once_per_timestep(self, *args):
         if self._is_lead_rank():
@@ -360,7 +391,7 @@ class PropertyWriter(GenericTangosTool):
         need_to_commit = self._is_commit_needed(end_of_timestep)
 
         if need_to_commit:
-            self._commit_results()
+            self._commit_results(wait=end_of_timestep)
 
         if need_to_commit or end_of_timestep:
             self.tracker.report_to_log_or_server(logger)
@@ -369,9 +400,11 @@ class PropertyWriter(GenericTangosTool):
             from ..parallel_tasks import message
             message.update_performance_stats()
 
-    def _commit_results(self):
-        commit_on_server = self.options.load_mode and self.options.load_mode.startswith('server')
-        insert_list(self._pending_properties, self._current_timestep_id, commit_on_server)
+    def _commit_results(self, wait=True):
+        # In parallel runs, results are handed to the server to write. Unless wait is True, this rank then carries on
+        # calculating while the server waits for the database lock and writes the results.
+        commit_on_server = parallel_tasks.backend is not None
+        insert_list(self._pending_properties, self._current_timestep_id, commit_on_server, wait=wait)
         self._pending_properties = []
         self._last_commit_time = time.time()
 
@@ -396,6 +429,9 @@ class PropertyWriter(GenericTangosTool):
         if self._include:
             needed.append(self._include)
 
+        if self.options.schedule == 'spatial':
+            needed.append(self._spatial_schedule_property)
+
         return (["NDM()", "NStar()", "NGas()", "halo_number()", "finder_id()", "finder_offset()",
                  "dbid()", "type()"] + [str(s) for s in np.unique(needed)])
 
@@ -424,6 +460,8 @@ class PropertyWriter(GenericTangosTool):
 
             if self._must_load_timestep_particles():
                 self._current_timestep_particle_data = db_timestep.load(mode=self.options.load_mode)
+                if self.options.load_mode == 'server-shared-mem':
+                    self._preload_required_particle_arrays(self._current_timestep_particle_data.shared_mem_view)
 
             elif self._should_load_particles():
                 # Keep a snapshot alive for this timestep, even if should_load_timestep_particles is False,
@@ -443,19 +481,29 @@ class PropertyWriter(GenericTangosTool):
             self._current_timestep_id = db_timestep.id
             self._current_timestep = db_timestep
 
-    def _clear_timestep_region_cache(self):
-        if self._current_timestep_particle_data is None:
-            return
+        self._prefetch_next_timestep(db_timestep)
 
-        if hasattr(self._current_timestep_particle_data, '_tangos_cached_regions'):
-            self._current_timestep_particle_data._tangos_cached_regions.clear()
+    def _prefetch_next_timestep(self, db_timestep):
+        """In server modes, ask the server to start loading the timestep that will be processed after db_timestep"""
+        if not (self.options.load_mode and self.options.load_mode.startswith('server')):
+            return
+        if not (self._is_lead_rank() and self._should_load_particles()):
+            return
+        if self.options.server_groups is not None:
+            # the next timestep in the list will be processed by a different group
+            return
 
+        timestep_ids = [ts.id for ts in self.timesteps_to_process]
+        if db_timestep.id not in timestep_ids:
+            return
+        next_index = timestep_ids.index(db_timestep.id) + 1
+        if next_index < len(self.timesteps_to_process):
+            self.timesteps_to_process[next_index].prefetch(self.options.load_mode,
+                                                           self._estimate_num_region_calculations_this_timestep())
 
     def _set_current_object(self, db_object):
-        # in shared-mem mode, region cache can end up unexpectedly using lots of mem per process since it's stored
-        # in a per-process cache. Let's assume there is not much performance penalty to just clearing it after each
-        # halo is procssed:
-        self._clear_timestep_region_cache()
+        # NB the region cache is not cleared here; it holds only a few recently used regions
+        # (config.pynbody_region_cache_size), which may be reused by neighbouring objects
 
         if self._current_object_id==db_object.id:
             return
@@ -465,6 +513,8 @@ class PropertyWriter(GenericTangosTool):
 
         if self._should_load_particles():
             self._current_object  = db_object.load(mode=self.options.load_mode)
+            if self.options.load_mode == 'server':
+                self._preload_required_particle_arrays(self._current_object)
 
         if self.options.load_mode is not None:
             self._run_preloop(self._current_object, db_object.timestep,
@@ -472,8 +522,26 @@ class PropertyWriter(GenericTangosTool):
 
 
     def _get_current_object_specified_region_particles(self, db_halo, region_spec):
-        return db_halo.timestep.load_region(region_spec, self.options.load_mode,
-                                            self._estimate_num_region_calculations_this_timestep())
+        region = db_halo.timestep.load_region(region_spec, self.options.load_mode,
+                                              self._estimate_num_region_calculations_this_timestep())
+        if self.options.load_mode == 'server':
+            self._preload_required_particle_arrays(region)
+        return region
+
+    def _required_particle_arrays(self):
+        arrays = []
+        for calculator in self._property_calculator_instances:
+            arrays.extend(calculator.requires_particle_arrays())
+        return list(dict.fromkeys(arrays))
+
+    def _preload_required_particle_arrays(self, particle_data):
+        """Fetch the arrays declared by the calculations in a single round trip, if the data is served remotely"""
+        preload = getattr(particle_data, 'preload_arrays', None)
+        if preload is None:
+            return
+        arrays = self._required_particle_arrays()
+        if len(arrays)>0:
+            preload(arrays)
 
     def _get_object_snapshot_data_if_appropriate(self, db_halo, db_data, property_calculator):
 
@@ -567,16 +635,119 @@ class PropertyWriter(GenericTangosTool):
 
         self._queue_results_for_later_commit(db_object, names, results, existing_properties)
 
+    def _calculator_output_names(self, calculator):
+        return [calculator.names] if isinstance(calculator.names, str) else list(calculator.names)
+
+    def _get_batch_calculator_instances(self):
+        """Return the calculators that will be run through calculate_batch this timestep.
+
+        Batches are only used when each process loads entire timesteps, and only for calculators whose prerequisites
+        are not produced by per-object calculations in the same run (since those run afterwards)."""
+        if self.options.load_mode is not None:
+            return []
+        per_object_names = set()
+        for calculator in self._property_calculator_instances:
+            if not calculator.supports_batch_calculation():
+                per_object_names.update(self._calculator_output_names(calculator))
+        return [calculator for calculator in self._property_calculator_instances
+                if calculator.supports_batch_calculation()
+                and not any(r in per_object_names for r in calculator.requires_property())]
+
+    def run_batch_calculation(self, property_calculator):
+        names = self._calculator_output_names(property_calculator)
+        listize = isinstance(property_calculator.names, str)
+
+        indices = []
+        for idx, existing_properties in enumerate(self._existing_properties_this_timestep):
+            if all([existing_properties[name] is not None for name in names]) and not self.options.force:
+                self.tracker.register_already_exists()
+            elif not property_calculator.accept(existing_properties):
+                self.tracker.register_missing_prerequisite()
+            else:
+                indices.append(idx)
+
+        if len(indices)==0:
+            return
+
+        entries = [self._existing_properties_this_timestep[idx] for idx in indices]
+
+        with self.timing_monitor(property_calculator):
+            try:
+                with self.redirect:
+                    all_results = property_calculator.calculate_batch(self._current_timestep_particle_data, entries)
+                if len(all_results) != len(entries):
+                    raise ValueError("calculate_batch returned %d results for %d objects"%(len(all_results), len(entries)))
+            except NotImplementedError as e:
+                self._log_once_per_timestep("    %r cannot be batched (%s); calculating object by object",
+                                            property_calculator, e)
+                self._batch_calculator_instances.remove(property_calculator)
+                return
+            except Exception as e:
+                for _ in indices:
+                    self.tracker.register_error()
+
+                if self.tracker.should_log_error(e):
+                    logger.info(f"Uncaught exception {e!r} during batch property calculation {property_calculator!r} applied to {self._current_timestep!r}")
+                    self._log_traceback()
+                    logger.info("If this error arises again, it will be counted but not individually reported.")
+
+                if self.options.catch:
+                    tbtype, value, tb = sys.exc_info()
+                    pdb.post_mortem(tb)
+                return
+
+        for idx, results in zip(indices, all_results):
+            self.tracker.register_success()
+            if listize:
+                results = [results]
+            self._queue_results_for_later_commit(self._objects_this_timestep[idx], names, results,
+                                                 self._existing_properties_this_timestep[idx])
+
+        self._commit_results_if_needed()
+
     def run_object_calculation(self, db_object, existing_properties):
+        # intermediate results shared between calculators are only valid for one object
+        self._object_scratch.clear()
         for calculator in self._property_calculator_instances:
+            if calculator in self._batch_calculator_instances:
+                continue
             # the separation of db_object and existing_properties is a historical anomaly, but
             # we keep it for now, to avoid breaking existing code. Originally existing_properties
             # was a 'stand-in' dictionary of properties, but now db_object is transient while holding
             # the cache of properties itself, so we could just pass it in alone.
             self.run_property_calculation(db_object, calculator, existing_properties)
+        self._object_scratch.clear()
 
         self._commit_results_if_needed()
 
+    @staticmethod
+    def _estimate_object_cost(existing_properties):
+        return sum(n or 0 for n in (existing_properties.NDM, existing_properties.NStar, existing_properties.NGas))
+
+    _spatial_schedule_property = "shrink_center"
+
+    def _get_spatial_processing_order(self):
+        centres = [p[self._spatial_schedule_property] for p in self._existing_properties_this_timestep]
+        with_centre = [i for i, c in enumerate(centres) if c is not None]
+        without_centre = [i for i, c in enumerate(centres) if c is None]
+        if len(without_centre)>0:
+            self._log_once_per_timestep("  %d objects have no %s; these will be processed last",
+                                        len(without_centre), self._spatial_schedule_property)
+        if len(with_centre)==0:
+            return without_centre
+        order = spatial_ordering.morton_order([centres[i] for i in with_centre])
+        return [with_centre[i] for i in order] + without_centre
+
+    def _get_object_processing_order(self):
+        """Return the indices of objects this timestep, in the order in which they should be processed"""
+        if self.options.schedule == 'largest-first':
+            cost = np.array([self._estimate_object_cost(p) for p in self._existing_properties_this_timestep])
+            return [int(i) for i in np.argsort(-cost, kind='stable')]
+        elif self.options.schedule == 'spatial':
+            return self._get_spatial_processing_order()
+        else:
+            return list(range(len(self._objects_this_timestep)))
+
     def _estimate_num_region_calculations_this_timestep(self):
         num_region_props = 0
         for prop in self._property_calculator_instances:
@@ -591,7 +762,7 @@ class PropertyWriter(GenericTangosTool):
             return
         assert self._is_lead_rank()
         message = ObjectsListMessage((self._existing_properties_this_timestep, self._objects_this_timestep))
-        for i in range(2, parallel_tasks.backend.size()):
+        for i in parallel_tasks.groups.my_group_workers()[1:]:
             message.send(i)
 
     def _transmit_file_list(self):
@@ -599,12 +770,12 @@ class PropertyWriter(GenericTangosTool):
             return
         assert self._is_lead_rank()
         message = FileListMessage(self.timesteps_to_process)
-        for i in range(2, parallel_tasks.backend.size()):
+        for i in parallel_tasks.groups.my_group_workers()[1:]:
             message.send(i)
 
     def _receive_file_list(self):
         assert self._should_share_query_results() and not self._is_lead_rank()
-        result = FileListMessage.receive(1).contents
+        result = FileListMessage.receive(parallel_tasks.groups.my_group_lead()).contents
         return result
 
     def _should_share_query_results(self):
@@ -613,7 +784,7 @@ class PropertyWriter(GenericTangosTool):
     def _receive_objects_list(self):
         assert parallel_tasks.backend is not None and self.options.load_mode is not None
         assert not self._is_lead_rank()
-        self._existing_properties_this_timestep, self._objects_this_timestep = ObjectsListMessage.receive(1).contents
+        self._existing_properties_this_timestep, self._objects_this_timestep = ObjectsListMessage.receive(parallel_tasks.groups.my_group_lead()).contents
 
 
     def run_timestep_calculation(self, db_timestep):
@@ -637,6 +808,9 @@ class PropertyWriter(GenericTangosTool):
         if self.options.with_prerequisites:
             self._add_prerequisites_to_calculator_instances(db_timestep)
 
+        for x in self._property_calculator_instances:
+            x.scratch = self._object_scratch
+
         if self._is_lead_rank():
             with parallel_tasks.lock.SharedLock("insert_list"):
                 logger.debug("Start object list query")
@@ -666,9 +840,21 @@ class PropertyWriter(GenericTangosTool):
             x_type = type(x)
             self._log_once_per_timestep(f"    {x_type.__module__}.{x_type.__qualname__}")
 
+        num_outstanding, num_existing = self._count_outstanding_calculations()
+        if num_outstanding==0:
+            self._skip_timestep_calculation(db_timestep, num_existing)
+            return
+
         self._set_current_timestep(db_timestep)
 
-        for idx in self._get_parallel_object_iterator(range(len(self._objects_this_timestep))):
+        self._batch_calculator_instances = self._get_batch_calculator_instances()
+        for existing_properties in self._existing_properties_this_timestep:
+            existing_properties.timestep = db_timestep
+        for calculator in list(self._batch_calculator_instances):
+            self.run_batch_calculation(calculator)
+
+        for idx in self._prefetch_regions_ahead(self._get_parallel_object_iterator(self._get_object_processing_order()),
+                                                db_timestep):
             db_halo = self._objects_this_timestep[idx]
             existing_properties = self._existing_properties_this_timestep[idx]
 
@@ -685,6 +871,76 @@ class PropertyWriter(GenericTangosTool):
 
         self._unload_timestep()
 
+    def _prefetch_regions_ahead(self, object_indices, db_timestep):
+        """Yield object_indices, reading up to config.pynbody_server_region_prefetch_count of them ahead so that the
+        regions their calculations need can be located by the server in a single round trip"""
+        num_ahead = config.pynbody_server_region_prefetch_count
+        if self.options.load_mode != 'server-shared-mem' or num_ahead == 0:
+            yield from object_indices
+            return
+
+        object_indices = iter(object_indices)
+        while True:
+            batch = list(itertools.islice(object_indices, num_ahead))
+            if len(batch) == 0:
+                return
+            region_specs = [spec for idx in batch
+                            for spec in self._outstanding_region_specifications(self._existing_properties_this_timestep[idx])]
+            if len(region_specs) > 0:
+                db_timestep.prefetch_regions(region_specs, self.options.load_mode,
+                                             self._estimate_num_region_calculations_this_timestep())
+            yield from batch
+
+    def _outstanding_region_specifications(self, existing_properties):
+        """Return the regions that will be requested by the calculations still to be run on an object"""
+        specs = []
+        for calculator in self._property_calculator_instances:
+            if type(calculator).region_specification is properties.PropertyCalculation.region_specification:
+                continue
+            names = self._calculator_output_names(calculator)
+            if all([existing_properties[name] is not None for name in names]) and not self.options.force:
+                continue
+            if not calculator.accept(existing_properties):
+                continue
+            try:
+                spec = calculator.region_specification(existing_properties)
+            except Exception:
+                # any problem will be reported when the calculation itself is run
+                continue
+            if spec is not None:
+                specs.append(spec)
+        return specs
+
+    def _count_outstanding_calculations(self):
+        """Return the number of (object, calculation) pairs this timestep that still need to be run, and the number
+        that will be skipped because their results already exist"""
+        if self.options.force:
+            return len(self._objects_this_timestep)*len(self._property_calculator_instances), 0
+
+        num_outstanding = 0
+        num_existing = 0
+        for calculator in self._property_calculator_instances:
+            names = [calculator.names] if isinstance(calculator.names, str) else calculator.names
+            for idx in range(len(self._objects_this_timestep)):
+                existing_properties = self._existing_properties_this_timestep[idx]
+                if all([existing_properties[name] is not None for name in names]):
+                    num_existing += 1
+                else:
+                    num_outstanding += 1
+        return num_outstanding, num_existing
+
+    def _skip_timestep_calculation(self, db_timestep, num_existing):
+        """Skip a timestep that has no outstanding calculations, without loading its particle data"""
+        self._log_once_per_timestep("All requested properties already exist for %r; not loading it", db_timestep)
+        if self._is_lead_rank():
+            self.tracker.register_already_exists(num_existing)
+            if self.options.load_mode and self.options.load_mode.startswith('server') and self._should_load_particles():
+                # the server may already be loading this timestep after a hint from the previous one
+                db_timestep.cancel_prefetch(self.options.load_mode)
+
+        self._commit_results_if_needed(end_of_timestep=True)
+        self._objects_this_timestep = None
+
     def _add_prerequisites_to_calculator_instances(self, db_timestep):
         will_calculate = []
         requirements = []
@@ -771,8 +1027,8 @@ class CalculationSuccessTracker(accumulative_statistics.StatisticsAccumulatorBas
     def register_missing_prerequisite(self):
         self._skipped_missing_prerequisite+=1
 
-    def register_already_exists(self):
-        self._skipped_existing+=1
+    def register_already_exists(self, count=1):
+        self._skipped_existing+=count
 
     def reset(self):
         self._succeeded = 0
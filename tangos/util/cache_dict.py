@@ -20,6 +20,8 @@ CacheDict([(2, 2), (4, 4)])
 
 from collections import OrderedDict
 
+from . import memory
+
 
 class CacheDict(OrderedDict):
     """Dict with a limited length, ejecting LRUs as needed."""
@@ -43,3 +45,110 @@ class CacheDict(OrderedDict):
         super().move_to_end(key)
 
         return val
+
+
+class SizeBoundedCacheDict:
+    """Least-recently-used dictionary bounded by the total size of its values, rather than their number.
+
+    The size of each value is estimated by calling sizeof(value) when it is inserted. If max_size is None, nothing is
+    evicted on account of size. If max_entries is not None, at most that many values are kept. The most recently
+    inserted value is always retained, even if it alone exceeds max_size.
+
+    If memory_governed is True, the cache is registered with tangos.util.memory.governor, which may evict entries
+    when the process exceeds config.memory_budget; name then describes the cache in log messages.
+
+    Hits, misses and evictions are counted so that the size limit can be tuned.
+
+    >>> c = SizeBoundedCacheDict(max_size=10, sizeof=len)
+    >>> c['a'] = 'xxxx'
+    >>> c['b'] = 'yyyy'
+    >>> c['a']
+    'xxxx'
+    >>> c['c'] = 'zzzz'
+    >>> 'b' in c
+    False
+    >>> c.evictions
+    1
+    """
+
+    def __init__(self, max_size=None, sizeof=None, max_entries=None, memory_governed=False, name="cache"):
+        self.max_size = max_size
+        self.max_entries = max_entries
+        self.name = name
+        self._sizeof = sizeof or (lambda value: 0)
+        self._contents = OrderedDict()
+        self.total_size = 0
+        self.reset_stats()
+        self._memory_governed = memory_governed
+        if memory_governed:
+            memory.governor.register(self)
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.peak_size = self.total_size
+
+    def __contains__(self, key):
+        return key in self._contents
+
+    def __len__(self):
+        return len(self._contents)
+
+    def __getitem__(self, key):
+        try:
+            value, size, _ = self._contents[key]
+        except KeyError:
+            self.misses += 1
+            raise
+        self._contents[key] = (value, size, memory.governor.tick())
+        self._contents.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __setitem__(self, key, value):
+        if key in self._contents:
+            self._remove(key)
+        size = self._sizeof(value)
+        self._contents[key] = (value, size, memory.governor.tick())
+        self.total_size += size
+        self.peak_size = max(self.peak_size, self.total_size)
+
+        while self._over_limit() and len(self._contents) > 1:
+            self.evict_least_recently_used()
+
+        if self._memory_governed:
+            memory.governor.enforce()
+
+    def _over_limit(self):
+        return (self.max_size is not None and self.total_size > self.max_size) or \
+               (self.max_entries is not None and len(self._contents) > self.max_entries)
+
+    def least_recent_use(self):
+        """Return the governor tick at which the least recently used value was last used, or None if empty"""
+        if len(self._contents)==0:
+            return None
+        return self._contents[next(iter(self._contents))][2]
+
+    def evict_least_recently_used(self):
+        """Discard the least recently used value, returning its size as currently estimated by sizeof"""
+        key = next(iter(self._contents))
+        value = self._contents[key][0]
+        size = self._sizeof(value)
+        self._remove(key)
+        self.evictions += 1
+        return size
+
+    def _remove(self, key):
+        _, size, _ = self._contents.pop(key)
+        self.total_size -= size
+
+    def clear(self):
+        self._contents.clear()
+        self.total_size = 0
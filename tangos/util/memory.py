@@ -0,0 +1,122 @@
+import itertools
+import os
+import sys
+import weakref
+
+from .. import config
+from ..log import logger
+
+
+def get_resident_set_size():
+    """Return the resident set size of the current process in bytes, or None if it cannot be determined.
+
+    On platforms without /proc, the peak resident set size is returned instead."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        pass
+
+    try:
+        import resource
+    except ImportError:
+        return None
+
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return maxrss # bytes on macOS
+    else:
+        return maxrss * 1024 # kilobytes elsewhere
+
+def estimate_pynbody_snapshot_size(snapshot):
+    """Estimate the memory (in bytes) held by a pynbody snapshot or view, excluding what it shares with its base.
+
+    This counts the arrays the object holds itself, and the index arrays defining it (and any views it is built on).
+    The estimate is made duck-typed so that this module does not import pynbody."""
+    nbytes = 0
+    own_arrays = list(getattr(snapshot, '_arrays', {}).values())
+    for family_arrays in getattr(snapshot, '_family_arrays', {}).values():
+        own_arrays += list(family_arrays.values())
+    own_buffers = {}
+    for array in own_arrays:
+        # arrays such as 'x' are views of others such as 'pos'; count only the underlying buffers, once each
+        while hasattr(getattr(array, 'base', None), 'nbytes'):
+            array = array.base
+        own_buffers[id(array)] = getattr(array, 'nbytes', 0)
+    nbytes += sum(own_buffers.values())
+
+    while hasattr(snapshot, '_subsnap_base'):
+        index_arrays = [getattr(snapshot, '_slice', None)] + list(getattr(snapshot, '_family_indices', {}).values())
+        for index_array in index_arrays:
+            nbytes += getattr(index_array, 'nbytes', 0)
+        snapshot = snapshot._subsnap_base
+    return nbytes
+
+
+class MemoryGovernor:
+    """Keeps the memory used by this process within config.memory_budget by evicting entries from registered caches
+
+    Caches register themselves with register(). They must provide:
+
+    * name, a description for log messages;
+    * total_size, the number of bytes the cache currently holds;
+    * least_recent_use(), returning when the least-recently-used entry was last used (as a value of tick()), or None
+      if the cache is empty;
+    * evict_least_recently_used(), discarding that entry and returning the number of bytes it held.
+
+    When the resident set size exceeds the budget, entries are evicted in order of least recent use across all
+    caches, until the bytes evicted account for the excess or there is nothing left to evict."""
+
+    def __init__(self):
+        self._caches = weakref.WeakSet()
+        self._tick = itertools.count()
+        self.evictions = 0
+        self.evicted_bytes = 0
+        self._budget_warning_issued = False
+
+    def tick(self):
+        """Return a number which increases each time it is called, for caches to record when entries were used"""
+        return next(self._tick)
+
+    def register(self, cache):
+        self._caches.add(cache)
+
+    def cached_bytes(self):
+        """Return a dictionary mapping the name of each registered cache type to the total bytes held in them"""
+        result = {}
+        for cache in list(self._caches):
+            result[cache.name] = result.get(cache.name, 0) + cache.total_size
+        return result
+
+    def _least_recently_used_cache(self):
+        candidates = [(cache.least_recent_use(), cache) for cache in list(self._caches)]
+        candidates = [c for c in candidates if c[0] is not None]
+        if len(candidates)==0:
+            return None
+        return min(candidates, key=lambda c: c[0])[1]
+
+    def enforce(self):
+        """If the process is over budget, evict cached entries, least recently used first"""
+        if config.memory_budget is None:
+            return
+        budget = config.memory_budget * 1024**3
+        rss = get_resident_set_size()
+        if rss is None or rss <= budget:
+            return
+
+        excess = rss - budget
+        while excess > 0:
+            cache = self._least_recently_used_cache()
+            if cache is None:
+                if not self._budget_warning_issued:
+                    logger.warning("Memory use (%.1f GB) exceeds the budget of %.1f GB, but there is no cached data "
+                                   "left to discard", rss / 1024**3, config.memory_budget)
+                    self._budget_warning_issued = True
+                return
+            freed = cache.evict_least_recently_used()
+            logger.debug("Memory governor: evicted %d bytes from %s", freed, cache.name)
+            self.evictions += 1
+            self.evicted_bytes += freed
+            excess -= freed
+
+governor = MemoryGovernor()
@@ -4,9 +4,12 @@ This is used during property calculations to minimise the number of queries made
 point to objects that have not yet been created in the database at the time they are referred to."""
 
 import abc
+from collections import defaultdict
 
 from .. import core
 
+_MAX_IDS_PER_QUERY = 500 # keep well within the maximum number of bound parameters supported by sqlite
+
 
 class ProxyResolutionException(Exception):
     """Unified exception raised when a proxy cannot be translated into an actual database object"""
@@ -93,3 +96,59 @@ class IncompleteProxyObjectFromFinderId(ProxyObjectBase):
 
     def relative_to_timestep_cache(self, timestep_cache):
         return ProxyObjectFromFinderIdAndTimestepCache(self._finder_id, self._typetag, timestep_cache)
+
+
+def _query_in_chunks(query, column, values):
+    values = list(values)
+    results = []
+    for start in range(0, len(values), _MAX_IDS_PER_QUERY):
+        results += query.filter(column.in_(values[start:start+_MAX_IDS_PER_QUERY])).all()
+    return results
+
+def resolve_all(possibly_proxies, session, timestep_id=None):
+    """Resolve a list of proxy objects, using a single query for each group of similar proxies
+
+    Database ID proxies are fetched together, as are finder ID proxies that share a timestep and object type.
+    Incomplete proxies are first made relative to timestep_id. Entries in the list that are not proxies are returned
+    unchanged, and proxies that do not correspond to anything in the database resolve to None.
+
+    :type session: sqlalchemy.orm.Session
+    :returns: a list of the same length as possibly_proxies"""
+
+    if timestep_id is not None:
+        possibly_proxies = [p.relative_to_timestep_id(timestep_id) if isinstance(p, ProxyObjectBase) else p
+                            for p in possibly_proxies]
+
+    database_ids = set()
+    finder_ids = defaultdict(set)
+    for p in possibly_proxies:
+        if isinstance(p, ProxyObjectFromDatabaseId):
+            database_ids.add(p._dbid)
+        elif isinstance(p, ProxyObjectFromFinderIdAndTimestep):
+            typecode = core.SimulationObjectBase.object_typecode_from_tag(p._typetag)
+            finder_ids[(p._timestep_id, typecode)].add(p._finder_id)
+
+    base_query = session.query(core.SimulationObjectBase)
+
+    objects_by_database_id = {}
+    for obj in _query_in_chunks(base_query, core.SimulationObjectBase.id, database_ids):
+        objects_by_database_id[obj.id] = obj
+
+    objects_by_finder_id = {}
+    for (ts_id, typecode), ids in finder_ids.items():
+        query = base_query.filter_by(timestep_id=ts_id, object_typecode=typecode)
+        for obj in _query_in_chunks(query, core.SimulationObjectBase.finder_id, ids):
+            objects_by_finder_id[(ts_id, typecode, obj.finder_id)] = obj
+
+    results = []
+    for p in possibly_proxies:
+        if isinstance(p, ProxyObjectFromDatabaseId):
+            results.append(objects_by_database_id.get(p._dbid, None))
+        elif isinstance(p, ProxyObjectFromFinderIdAndTimestep):
+            typecode = core.SimulationObjectBase.object_typecode_from_tag(p._typetag)
+            results.append(objects_by_finder_id.get((p._timestep_id, typecode, p._finder_id), None))
+        elif isinstance(p, ProxyObjectBase):
+            results.append(p.resolve(session))
+        else:
+            results.append(p)
+    return results
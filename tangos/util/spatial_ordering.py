@@ -0,0 +1,45 @@
+"""Orderings of points in space that keep nearby points close together in sequence.
+
+These are used to schedule calculations on objects so that consecutive calculations touch neighbouring parts of a
+snapshot."""
+
+import numpy as np
+
+_BITS_PER_DIMENSION = 21 # so that three interleaved coordinates fit in a 64-bit key
+
+
+def _spread_bits(x):
+    """Insert two zero bits between each of the lowest 21 bits of the unsigned integers in x"""
+    x = x.astype(np.uint64) & np.uint64(0x1fffff)
+    x = (x | (x << np.uint64(32))) & np.uint64(0x1f00000000ffff)
+    x = (x | (x << np.uint64(16))) & np.uint64(0x1f0000ff0000ff)
+    x = (x | (x << np.uint64(8))) & np.uint64(0x100f00f00f00f00f)
+    x = (x | (x << np.uint64(4))) & np.uint64(0x10c30c30c30c30c3)
+    x = (x | (x << np.uint64(2))) & np.uint64(0x1249249249249249)
+    return x
+
+def morton_keys(positions):
+    """Return the Morton (Z-order) key of each of the 3D positions, within their bounding box
+
+    :param positions: an (N,3) array
+    :returns: an array of N uint64 keys"""
+    positions = np.asarray(positions, dtype=np.float64).reshape(-1, 3)
+    if len(positions)==0:
+        return np.zeros(0, dtype=np.uint64)
+    lower = positions.min(axis=0)
+    extent = (positions.max(axis=0) - lower).max()
+    if extent == 0:
+        extent = 1.0
+    max_integer = 2**_BITS_PER_DIMENSION - 1
+    integer_positions = ((positions - lower) * (max_integer/extent)).astype(np.uint64)
+    return (_spread_bits(integer_positions[:,0]) |
+            (_spread_bits(integer_positions[:,1]) << np.uint64(1)) |
+            (_spread_bits(integer_positions[:,2]) << np.uint64(2)))
+
+def morton_order(positions):
+    """Return the indices that sort the 3D positions into Morton (Z-order)
+
+    >>> morton_order([[1.0, 1.0, 1.0], [0.0, 0.0, 0.0], [0.9, 1.0, 1.0], [0.1, 0.0, 0.0]]).tolist()
+    [1, 3, 2, 0]
+    """
+    return np.argsort(morton_keys(positions), kind='stable')
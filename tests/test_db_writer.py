@@ -1,4 +1,5 @@
 import os
+import re
 import time
 
 import pytest
@@ -58,6 +59,13 @@ class DummyProperty2(properties.PropertyCalculation):
     def calculate(self, data, entry):
         return data.time*data.halo+1,
 
+class DummyPropertyCountingPreloops(DummyProperty):
+    names = "dummy_property_counting_preloops",
+    num_preloops = 0
+
+    def preloop(self, particle_data, timestep_object):
+        DummyPropertyCountingPreloops.num_preloops += 1
+
 class DummyPropertyCausingException(properties.PropertyCalculation):
     names = "dummy_property_with_exception",
     requires_particle_data = True
@@ -135,6 +143,24 @@ def test_parallel_writing(fresh_database, load_mode):
 
     _assert_properties_as_expected()
 
+@pytest.mark.parametrize('load_mode', [None, 'server'])
+def test_parallel_writing_background_commits(fresh_database, load_mode, monkeypatch):
+    # with no time allowed between commits, every object's results are handed to the server without waiting
+    monkeypatch.setattr(tangos.config, 'PROPERTY_WRITER_MAXIMUM_TIME_BETWEEN_COMMITS', 0)
+    parallel_tasks.use('multiprocessing-3')
+    args = ("dummy_property",) if load_mode is None else ("dummy_property", "--load-mode="+load_mode)
+    run_writer_with_args(*args, parallel=True)
+    _assert_properties_as_expected()
+
+def test_parallel_writing_server_groups(fresh_database):
+    parallel_tasks.use('multiprocessing-5')
+    run_writer_with_args("dummy_property", "--load-mode=server", "--server-groups", "2", parallel=True)
+    _assert_properties_as_expected()
+
+def test_server_groups_need_server_load_mode(fresh_database):
+    with pytest.raises(ValueError):
+        run_writer_with_args("dummy_property", "--server-groups", "2")
+
 def test_property_gathering_across_processes(fresh_database):
     parallel_tasks.use('multiprocessing-5')
     results = run_writer_with_args('dummy_property',  parallel=True)
@@ -407,6 +433,17 @@ def test_writer_num_regions_optimization(fresh_database):
     # does not request a region. So the expected number of region queries is 10.
     assert "load_region expected_number_of_queries=10" in log
 
+def test_writer_prefetches_regions(fresh_database, monkeypatch):
+    monkeypatch.setattr(tangos.config, "pynbody_server_region_prefetch_count", 4)
+    run_writer_with_args("dummy_property")
+    parallel_tasks.use('multiprocessing-3')
+    log = run_writer_with_args("dummy_region_property", "--load-mode=server-shared-mem", parallel=True)
+
+    # each of the 15 objects needs one region, requested at most 4 objects at a time
+    counts = [int(n) for n in re.findall(r"prefetch_regions (\d+) regions", log)]
+    assert sum(counts) == 15 and max(counts) <= 4
+    assert db.get_halo("dummy_sim_1/step.2/1")['dummy_region_property']==100.0
+
 @pytest.fixture
 def db_with_trackers():
     import numpy as np
@@ -503,3 +540,250 @@ def test_writer_cannot_see_links(fresh_database):
     assert "Cannot pass database objects" in output
     assert "Missing pre-requisite: 15" in output
     assert "Succeeded: 0" in output
+
+
+class DummyPropertyRecordingOrder(properties.PropertyCalculation):
+    names = "dummy_property_recording_order",
+    order = []
+
+    def calculate(self, data, entry):
+        self.order.append(entry.halo_number)
+        return 1.0,
+
+@fixture
+def database_with_reverse_ndm():
+    parallel_tasks.use('null')
+
+    testing.init_blank_db_for_testing()
+    db.config.base = os.path.join(os.path.dirname(__file__), "test_simulations")
+    manager = add_simulation.SimulationAdderUpdater(output_testing.TestInputHandlerReverseHaloNDM("dummy_sim_1"),
+                                                    renumber=False)
+    with log.LogCapturer():
+        manager.scan_simulation_and_add_all_descendants()
+    yield
+    teardown_func()
+
+@pytest.mark.parametrize('schedule', ['database', 'largest-first', 'spatial'])
+def test_writer_schedule(database_with_reverse_ndm, schedule):
+    import numpy as np
+    halos = db.get_timestep("dummy_sim_1/step.1").halos.all()
+    for halo in halos[1:]:
+        # place halos along a line, in the opposite order to their halo numbers; halo 1 is given no centre
+        halo['shrink_center'] = np.array([100.0-halo.halo_number, 0.0, 0.0])
+    db.core.get_default_session().commit()
+
+    DummyPropertyRecordingOrder.order = []
+    run_writer_with_args("dummy_property_recording_order", "--timesteps-matching", "step.1",
+                         "--schedule", schedule)
+    if schedule == 'database':
+        assert DummyPropertyRecordingOrder.order == list(range(1, 11))
+    elif schedule == 'largest-first':
+        assert DummyPropertyRecordingOrder.order == list(range(10, 0, -1))
+    else:
+        assert DummyPropertyRecordingOrder.order == list(range(10, 1, -1)) + [1]
+
+def test_insert_list_uses_bulk_insert(fresh_database):
+    from tangos import cached_writer
+    ts = db.get_timestep("dummy_sim_1/step.1")
+    halo_1, halo_2 = ts.halos[0], ts.halos[1]
+    property_list = [(proxy_object.ProxyObjectFromDatabaseId(halo_1.id), 'bulk_float', 1.5),
+                     (proxy_object.ProxyObjectFromDatabaseId(halo_2.id), 'bulk_float', 2.5),
+                     (proxy_object.IncompleteProxyObjectFromFinderId(1, 'halo'), 'bulk_int', 3),
+                     (proxy_object.IncompleteProxyObjectFromFinderId(1, 'halo'), 'bulk_array', [1.0, 2.0]),
+                     (proxy_object.IncompleteProxyObjectFromFinderId(1, 'halo'), 'bulk_none', None),
+                     (proxy_object.IncompleteProxyObjectFromFinderId(1, 'halo'), 'bulk_link',
+                      proxy_object.IncompleteProxyObjectFromFinderId(2, 'halo'))]
+
+    with testing.SqlExecutionTracker() as ctr:
+        assert cached_writer.insert_list(property_list, ts.id, False) == 5
+
+    assert ctr.count_statements_containing("INSERT INTO haloproperties")==1
+    assert ctr.count_statements_containing("INSERT INTO halolink")==1
+
+    assert halo_1['bulk_float'] == 1.5
+    assert halo_2['bulk_float'] == 2.5
+    assert halo_1['bulk_int'] == 3
+    npt.assert_equal(halo_1['bulk_array'], [1.0, 2.0])
+    assert 'bulk_none' not in halo_1.keys()
+    assert halo_1['bulk_link'] == halo_2
+
+def test_writer_skips_complete_timesteps(fresh_database):
+    DummyPropertyCountingPreloops.num_preloops = 0
+    run_writer_with_args("dummy_property_counting_preloops")
+    num_preloops_first_run = DummyPropertyCountingPreloops.num_preloops
+    assert num_preloops_first_run > 0
+
+    res = run_writer_with_args("dummy_property_counting_preloops")
+    assert "Already exists: 15" in res
+    assert "not loading it" in res
+    assert DummyPropertyCountingPreloops.num_preloops == num_preloops_first_run
+
+    run_writer_with_args("dummy_property_counting_preloops", "--force")
+    assert DummyPropertyCountingPreloops.num_preloops > num_preloops_first_run
+
+class DummyBatchProperty(properties.PropertyCalculation):
+    names = "dummy_batch_property",
+    requires_particle_data = True
+    num_batches = 0
+
+    def calculate(self, data, entry):
+        raise RuntimeError("calculate should not be called when calculate_batch is available")
+
+    def calculate_batch(self, timestep_data, halo_entries):
+        DummyBatchProperty.num_batches += 1
+        return [(timestep_data.time*entry.finder_id,) for entry in halo_entries]
+
+def test_batch_calculation(fresh_database):
+    DummyBatchProperty.num_batches = 0
+    res = run_writer_with_args("dummy_batch_property", "dummy_property")
+    assert "Succeeded: 30" in res
+    assert DummyBatchProperty.num_batches == 2 # one per timestep
+
+    for halo in db.get_timestep("dummy_sim_1/step.1").halos.all() + db.get_timestep("dummy_sim_1/step.2").halos.all():
+        assert halo['dummy_batch_property'] == halo['dummy_property']
+
+def test_batch_calculation_not_used_in_server_mode(fresh_database):
+    parallel_tasks.use('multiprocessing-3')
+    res = run_writer_with_args("dummy_batch_property", "--load-mode=server", parallel=True)
+    assert "Errored: 15" in res
+
+class DummyPynbodyBatchMass(properties.pynbody.PynbodyPropertyCalculation):
+    names = "dummy_batch_mass",
+
+    def calculate(self, particle_data, entry):
+        return float(particle_data['mass'].sum()),
+
+    def calculate_batch(self, timestep_data, halo_entries):
+        import numpy as np
+        labels = self.get_group_labels(timestep_data, halo_entries)
+        masses = np.bincount(labels[labels >= 0], weights=timestep_data['mass'][labels >= 0],
+                             minlength=len(halo_entries))
+        return [(float(m),) for m in masses]
+
+def test_pynbody_batch_calculation(db_with_trackers):
+    run_writer_with_args("dummy_batch_mass", "--type", "halo")
+    halo = db.get_halo("test_tipsy/tiny.000640/halo_1")
+    npt.assert_allclose(halo['dummy_batch_mass'], float(halo.load()['mass'].sum()))
+
+class _ShiftedCatalogue:
+    def __init__(self, catalogue):
+        self._catalogue = catalogue
+
+    def get_group_array(self):
+        import numpy as np
+        group_array = np.asarray(self._catalogue.get_group_array())
+        return np.where(group_array >= 0, group_array + 100, group_array)
+
+def test_pynbody_batch_calculation_groups(db_with_trackers, monkeypatch):
+    """Batch labels must come from the catalogue for the objects' own type, not the halo catalogue"""
+    from tangos.input_handlers import pynbody
+
+    # the test simulation has no group finder output, so present its halo catalogue as the groups, but with
+    # the groups numbered differently from the halos
+    get_halo_catalogue = pynbody.ChangaInputHandler.get_catalogue
+    def get_catalogue(self, ts_extension, object_typetag):
+        if object_typetag == 'group':
+            catalogue = get_halo_catalogue(self, ts_extension, 'halo')
+            return _ShiftedCatalogue(catalogue)
+        return get_halo_catalogue(self, ts_extension, object_typetag)
+    monkeypatch.setattr(pynbody.ChangaInputHandler, 'get_catalogue', get_catalogue)
+
+    ts = db.get_timestep("test_tipsy/tiny.000640")
+    session = db.get_default_session()
+    for halo in ts.halos[:3]:
+        session.add(tangos.core.halo.Group(ts, halo.halo_number, halo.finder_id + 100, halo.finder_offset,
+                                           halo.NDM, halo.NStar, halo.NGas))
+    session.commit()
+
+    run_writer_with_args("dummy_batch_mass", "--type", "group")
+    halo = db.get_halo("test_tipsy/tiny.000640/halo_1")
+    group = db.get_halo("test_tipsy/tiny.000640/group_1")
+    npt.assert_allclose(group['dummy_batch_mass'], float(halo.load()['mass'].sum()))
+
+def test_pynbody_batch_calculation_falls_back(db_with_trackers):
+    """Trackers have no catalogue, so the batch calculation is replaced by per-object calculation"""
+    run_writer_with_args("dummy_batch_mass", "--type", "tracker")
+    tracker = db.get_halo("test_tipsy/tiny.000640/tracker_2")
+    npt.assert_allclose(tracker['dummy_batch_mass'], float(tracker.load()['mass'].sum()))
+    assert tracker['dummy_batch_mass'] > 0
+
+class DummyPropertySharingScratch(properties.PropertyCalculation):
+    names = "dummy_scratch_property",
+    requires_particle_data = True
+    num_generated = 0
+
+    def calculate(self, data, entry):
+        return self.get_scratch_value("dummy_scratch", lambda: self._generate(data)),
+
+    @classmethod
+    def _generate(cls, data):
+        cls.num_generated += 1
+        return data.time*data.halo
+
+class DummyPropertySharingScratch2(DummyPropertySharingScratch):
+    names = "dummy_scratch_property_2",
+
+def test_scratch_shared_between_calculators(fresh_database):
+    DummyPropertySharingScratch.num_generated = 0
+    run_writer_with_args("dummy_scratch_property", "dummy_scratch_property_2")
+    assert DummyPropertySharingScratch.num_generated == 15 # once per halo, not once per calculation
+
+    for halo in db.get_timestep("dummy_sim_1/step.1").halos.all() + db.get_timestep("dummy_sim_1/step.2").halos.all():
+        assert halo['dummy_scratch_property'] == halo['dummy_scratch_property_2'] == halo.timestep.time_gyr*halo.halo_number
+
+def test_recentring_uses_scratch():
+    import numpy as np
+    import pynbody
+
+    from tangos.properties.pynbody import centring
+
+    f = pynbody.new(dm=100)
+    f['pos'] = np.random.uniform(-0.5, 0.5, (100, 3))
+    f.properties['boxsize'] = 1.0
+    original_pos = np.array(f['pos'])
+    centre = np.array([0.4, 0.4, 0.4])
+
+    calculator = DummyPropertySharingScratch(None)
+    calculator.scratch = {}
+    with centring._recenter(f, centre, calculator):
+        recentred_pos = np.array(f['pos'])
+    npt.assert_equal(f['pos'], original_pos)
+    assert len(calculator.scratch) == 1
+    # only the recentred positions are kept, not a second copy of the originals
+    stored_pos, = calculator.scratch.values()
+    npt.assert_equal(stored_pos, recentred_pos)
+
+    with centring._recenter(f, centre, calculator):
+        npt.assert_equal(f['pos'], recentred_pos)
+    npt.assert_equal(f['pos'], original_pos)
+
+    with centring._recenter(f, centre):
+        npt.assert_equal(f['pos'], recentred_pos)
+    npt.assert_equal(f['pos'], original_pos)
+
+def test_centred_sorted_radii():
+    import numpy as np
+    import pynbody
+
+    from tangos.properties.pynbody import centring
+
+    f = pynbody.new(dm=100, star=50)
+    f['pos'] = np.random.uniform(-0.5, 0.5, (150, 3))
+    f['mass'] = np.random.uniform(1.0, 2.0, 150)
+    f.properties['boxsize'] = 1.0
+    centre = np.array([0.1, 0.1, 0.1])
+
+    calculator = DummyPropertySharingScratch(None)
+    calculator.scratch = {}
+    with centring._recenter(f, centre, calculator):
+        radii, enclosed_mass = centring.centred_sorted_radii(calculator, f, centre)
+        npt.assert_allclose(radii, np.sort(f['r']))
+        for r in (0.1, 0.3, 1.0):
+            npt.assert_allclose(enclosed_mass[np.searchsorted(radii, r)], f['mass'][f['r'] < r].sum())
+
+        star_radii, star_enclosed_mass = centring.centred_sorted_radii(calculator, f, centre, pynbody.family.star)
+        npt.assert_allclose(star_radii, np.sort(f.st['r']))
+        npt.assert_allclose(star_enclosed_mass[-1], f.st['mass'].sum())
+
+        assert centring.centred_sorted_radii(calculator, f, centre)[0] is radii
+    assert len(calculator.scratch) == 3
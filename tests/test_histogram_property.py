@@ -96,8 +96,9 @@ def test_reconstruction_optimized():
     # current algorithm constructs 2 temp tables for merger tree probe, plus one for final gathering of properties
     assert track.count_statements_containing("create temporary table") <= 3
 
-    # joined load should prevent separate selects being emitted
-    assert "select haloproperties" not in track
+    # eager loading should prevent separate selects being emitted for each object
+    assert track.count_statements_containing("from haloproperties") == \
+           track.count_statements_containing("haloproperties.halo_id in (")
 
 
 def test_live_calculation_summed_reconstruction():
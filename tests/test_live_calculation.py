@@ -1,4 +1,5 @@
 import numpy as np
+import numpy.testing as npt
 from pytest import raises as assert_raises
 
 import tangos
@@ -115,6 +116,38 @@ def test_at_function():
     halo = tangos.get_halo("sim/ts1/1")
     assert np.allclose(halo.calculate("at(3.0,dummy_property_1)"), 30.0)
 
+def test_at_function_batch():
+    at = properties.live_profiles.AtPosition(None, 0, DummyProperty1(None))
+    profiles = np.arange(0, 100.0).reshape((4, 25))
+    positions = np.array([0.3, 1.05, -0.5, 2.5])
+    batch = at.live_calculate_batch("at", [None]*4, positions, profiles)
+    one_by_one = [at.live_calculate(None, p, ar) for p, ar in zip(positions, profiles)]
+    assert list(batch) == one_by_one
+    assert batch[3] is None # beyond the end of the profile
+
+    with assert_raises(NotImplementedError):
+        at.live_calculate_batch("at", [None] * 2, positions[:2], np.array([profiles[0], profiles[1, :5]], dtype=object))
+
+class DummyBatchProperty(properties.LivePropertyCalculation):
+    names = "dummy_batch_property"
+    num_batch_calls = 0
+
+    def live_calculate(self, halo_entry, value):
+        return value*2
+
+    def live_calculate_batch(self, name, halo_entries, values):
+        type(self).num_batch_calls+=1
+        return values*2
+
+def test_live_calculate_batch():
+    DummyBatchProperty.num_batch_calls = 0
+    bh_masses, doubled = tangos.get_timestep("sim/ts1").calculate_all("BH_mass", "dummy_batch_property(BH_mass)")
+    npt.assert_allclose(doubled, bh_masses*2)
+    assert DummyBatchProperty.num_batch_calls==1
+
+    doubled, = tangos.get_halo("sim/ts2/1").calculate_for_progenitors("dummy_batch_property(dummy_property_3)")
+    npt.assert_allclose(doubled, [-5.0])
+
 def test_custom_at_function():
     halo = tangos.get_halo("sim/ts1/1")
     assert np.allclose(halo.calculate("at(3.0,property_with_custom_interpolator())"), 3.0)
@@ -300,3 +333,43 @@ def test_faulty_multi_calculation():
 
     dbid1, mass, dbid2 = calc.values(halos)
     assert (dbid1 == dbid2).all()
+
+def test_parse_plan_cache():
+    first = tangos.live_calculation.parser.parse_property_name("later(1).dummy_property_3*2")
+    hits_before = tangos.live_calculation.parser._plan_for_property_name.cache_info().hits
+    second = tangos.live_calculation.parser.parse_property_name("later(1).dummy_property_3*2")
+    assert tangos.live_calculation.parser._plan_for_property_name.cache_info().hits == hits_before+1
+
+    # each parse must generate a separate calculation, since calculations cache database-dependent state
+    assert first is not second
+    assert first._inputs[0] is not second._inputs[0]
+    assert str(first) == str(second)
+
+class DummyCountingProperty(properties.LivePropertyCalculation):
+    names = "dummy_counting_property"
+    num_calls = 0
+
+    def live_calculate(self, halo_entry):
+        type(self).num_calls+=1
+        return 1.0
+
+def test_common_subexpression_elimination():
+    DummyCountingProperty.num_calls = 0
+    ts2_dbid = tangos.get_halo("sim/ts2/1").id
+    dbid1, counted1, dbid2, counted2 = tangos.get_timestep("sim/ts1").calculate_all(
+        "later(1).dbid()", "later(1).dummy_counting_property()", "later(1).dbid()", "later(1).dummy_counting_property()")
+    assert list(dbid1) == list(dbid2) == [ts2_dbid]
+    assert list(counted1) == list(counted2) == [1.0]
+    assert DummyCountingProperty.num_calls == 1
+
+def test_common_link_locators_combined():
+    calc = lc.MultiCalculation("later(1).dbid()", "dbid()", "later(1).dummy_counting_property()", "later(1).dbid()")
+    units, _ = calc._common_subexpressions_eliminated()
+    assert len(units) == 2 # the links following later(1) are combined, and the repeated later(1).dbid() removed
+
+    halos = tangos.get_timestep("sim/ts1").halos.all()
+    later_dbid, dbid, counted, later_dbid_again = calc.values(halos)
+    assert list(dbid) == [h.id for h in halos]
+    assert later_dbid[0] == tangos.get_halo("sim/ts2/1").id
+    assert list(later_dbid_again) == list(later_dbid)
+    assert counted[0] == 1.0
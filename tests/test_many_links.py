@@ -0,0 +1,72 @@
+import numpy as np
+import numpy.testing as npt
+
+import tangos
+import tangos.testing as testing
+import tangos.testing.simulation_generator as sg
+from tangos import core
+
+N_HALOS = 50
+N_PROPERTIES = 10
+N_LINKS_PER_HALO = 20
+
+property_names = ["p%d"%i for i in range(N_PROPERTIES)]
+
+def setup_module():
+    testing.init_blank_db_for_testing()
+
+    generator = sg.SimulationGeneratorForTests()
+    session = core.get_default_session()
+
+    for ts in range(2):
+        generator.add_timestep()
+        generator.add_objects_to_timestep(N_HALOS)
+        generator.add_properties_to_halos(**{name: (lambda i, k=k, ts=ts: float(1000*ts + 10*i + k))
+                                             for k, name in enumerate(property_names)})
+
+    # each halo in ts1 links to N_LINKS_PER_HALO halos in ts2, the last of which has the highest p0
+    neighbour = core.dictionary.get_or_create_dictionary_item(session, "neighbour")
+    ts1, ts2 = generator.sim.timesteps
+    targets = {h.halo_number: h for h in ts2.halos}
+    links = []
+    for h in ts1.halos:
+        for j in range(N_LINKS_PER_HALO):
+            target = targets[(h.halo_number + j - 1) % N_HALOS + 1]
+            links.append(core.halo_data.HaloLink(h, target, neighbour, 1.0))
+    session.add_all(links)
+    session.commit()
+
+def teardown_module():
+    tangos.core.close_db()
+
+def _calculate_with_links():
+    return tangos.get_timestep("sim/ts1").calculate_all(*property_names, "link(neighbour, p0, 'max').p1")
+
+def test_many_links_values():
+    results = _calculate_with_links()
+    halo_numbers = np.arange(1, N_HALOS+1)
+    for k, values in enumerate(results[:-1]):
+        npt.assert_allclose(values, 10*halo_numbers + k)
+
+    target_numbers = np.array([max((i + j - 1) % N_HALOS + 1 for j in range(N_LINKS_PER_HALO)) for i in halo_numbers])
+    npt.assert_allclose(results[-1], 1000 + 10*target_numbers + 1)
+
+def test_many_links_loaded_without_join_explosion():
+    # joining the properties and links of each halo in the same query would return
+    # N_PROPERTIES x N_LINKS_PER_HALO rows per halo
+    with testing.SqlExecutionTracker() as track:
+        _calculate_with_links()
+    assert "join halolink" not in track
+    assert "join haloproperties" not in track
+
+def manual_test():
+    # benchmark for loading the properties and links, e.g. run with N_LINKS_PER_HALO increased
+    import time
+    setup_module()
+    start = time.perf_counter()
+    _calculate_with_links()
+    print("Time taken = ", time.perf_counter() - start)
+    teardown_module()
+
+if __name__=="__main__":
+    manual_test()
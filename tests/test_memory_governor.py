@@ -0,0 +1,45 @@
+import tangos.config
+from tangos.util import memory
+from tangos.util.cache_dict import SizeBoundedCacheDict
+
+
+def _fake_memory_use(monkeypatch, caches, baseline):
+    monkeypatch.setattr(memory, 'get_resident_set_size', lambda: baseline + sum(c.total_size for c in caches))
+
+def test_governor_evicts_least_recently_used_across_caches(monkeypatch):
+    cache_a = SizeBoundedCacheDict(sizeof=len, memory_governed=True, name="a")
+    cache_b = SizeBoundedCacheDict(sizeof=len, memory_governed=True, name="b")
+    _fake_memory_use(monkeypatch, [cache_a, cache_b], 1000)
+    monkeypatch.setattr(tangos.config, 'memory_budget', 1030 / 1024**3)
+
+    cache_a['a1'] = 'x'*10
+    cache_b['b1'] = 'x'*10
+    cache_a['a2'] = 'x'*10
+    assert cache_a['a1'] # a1 is now more recently used than b1
+    assert memory.governor.cached_bytes()['a'] == 20
+
+    cache_b['b2'] = 'x'*10 # takes the process over budget by 10 bytes
+    assert 'b1' not in cache_b
+    assert 'a1' in cache_a and 'a2' in cache_a and 'b2' in cache_b
+
+    cache_b['b3'] = 'x'*25 # over budget by 25 bytes, so three entries must go
+    assert list(cache_a._contents.keys()) == []
+    assert list(cache_b._contents.keys()) == ['b3']
+
+def test_governor_inactive_without_budget(monkeypatch):
+    cache = SizeBoundedCacheDict(sizeof=len, memory_governed=True)
+    _fake_memory_use(monkeypatch, [cache], 1000)
+    monkeypatch.setattr(tangos.config, 'memory_budget', None)
+    for i in range(10):
+        cache[i] = 'x'*100
+    assert len(cache) == 10
+    assert cache.evictions == 0
+
+def test_max_entries():
+    cache = SizeBoundedCacheDict(max_entries=2)
+    cache[1] = 1
+    cache[2] = 2
+    cache[1]
+    cache[3] = 3
+    assert 2 not in cache and 1 in cache and 3 in cache
+    assert cache.evictions == 1
@@ -0,0 +1,62 @@
+"""Smoke test for the mpi4py backend, which runs this file under mpirun with three processes"""
+
+import os
+import re
+import shutil
+import subprocess
+import sys
+import time
+
+import numpy as np
+import pytest
+
+
+def _run_under_mpi():
+    from tangos import parallel_tasks as pt
+
+    def _worker():
+        rank = pt.backend.rank()
+
+        for i in pt.distributed(range(10)):
+            print(f"rank {rank} task {i}", flush=True)
+
+        # a view must arrive as it was when sent, even if it is changed straight afterwards
+        large = np.arange(100000, dtype=np.float64)
+        if rank == 1:
+            view = large[:50000]
+            pt.backend.send_numpy_array(view, 2)
+            view[:] = -1
+            assert (pt.backend.receive_numpy_array(2) == 2*np.arange(50000)).all()
+        else:
+            time.sleep(0.5) # so that the send is still in progress when the view is changed
+            received = pt.backend.receive_numpy_array(1)
+            assert (received == np.arange(50000)).all()
+            pt.backend.send_numpy_array(2*received, 1)
+
+        pt.barrier()
+        print(f"rank {rank} done", flush=True)
+
+    pt.use("mpi4py")
+    pt.launch(_worker)
+
+
+def test_mpi4py_backend():
+    pytest.importorskip("mpi4py")
+    mpirun = shutil.which("mpirun")
+    if mpirun is None:
+        pytest.skip("mpirun is not available")
+
+    env = dict(os.environ, OMPI_ALLOW_RUN_AS_ROOT="1", OMPI_ALLOW_RUN_AS_ROOT_CONFIRM="1",
+               OMPI_MCA_rmaps_base_oversubscribe="1")
+    result = subprocess.run([mpirun, "-np", "3", sys.executable, __file__], env=env, capture_output=True,
+                            text=True, timeout=120)
+    assert result.returncode == 0, result.stdout + result.stderr
+
+    # output from the two workers can be interleaved within lines
+    tasks = sorted(int(i) for i in re.findall(r"rank \d task (\d+)", result.stdout))
+    assert tasks == list(range(10))
+    assert sorted(re.findall(r"rank \d done", result.stdout)) == ["rank 1 done", "rank 2 done"]
+
+
+if __name__ == "__main__":
+    _run_under_mpi()
@@ -1,6 +1,8 @@
 import os
+import pickle
 import time
 
+import numpy as np
 import pytest
 
 import tangos
@@ -581,6 +583,34 @@ def test_server_shared_lock_prohibition():
     assert client_acquired, f"Client should have acquired shared lock. Log: {log}"
 
 
+class MessageTestDeferredServerLock(pt.message.MessageWithResponse):
+    def process(self):
+        pt_testing.log("Server received deferred operation")
+        pt.lock.run_on_server_with_lock(self.contents, lambda: pt_testing.log("Server ran deferred operation"))
+        self.respond(None)
+
+def _test_deferred_server_lock():
+    with pt.lock.SharedLock('deferred_server_lock_test', 0):
+        # the response shows that the server queued the operation and carried on processing messages
+        MessageTestDeferredServerLock('deferred_server_lock_test').send_and_get_response(0)
+        time.sleep(0.1)
+        pt_testing.log("Client releasing shared lock")
+
+    with pt.ExclusiveLock('deferred_server_lock_test', 0):
+        pt_testing.log("Client acquired exclusive lock")
+
+def test_deferred_server_lock():
+    """Test that the server can queue for a lock without blocking its message loop"""
+    pt.use("multiprocessing-2")
+    pt_testing.initialise_log()
+    pt.launch(_test_deferred_server_lock)
+    log = pt_testing.get_log(remove_process_ids=True)
+    assert log == ["Server received deferred operation",
+                   "Client releasing shared lock",
+                   "Server ran deferred operation",
+                   "Client acquired exclusive lock"]
+
+
 def test_iteration_state_closes_tasks():
     from tangos.parallel_tasks.jobs import IterationState
 
@@ -623,3 +653,317 @@ def test_iteration_state_from_string():
     assert iteration_state2.next_job(0) == 1
     assert iteration_state2.next_job(0) == 3
     assert iteration_state2.next_job(0) == 4
+
+
+def test_iteration_state_batches_shrink():
+    from tangos.parallel_tasks.jobs import IterationState
+
+    iteration_state = IterationState.from_context(20, backend_size=3)
+    assert iteration_state.next_jobs(1, 4) == [0, 1, 2, 3]
+    assert iteration_state.next_jobs(2, 4) == [4, 5, 6, 7]
+    assert iteration_state.count_complete() == 0
+    assert iteration_state.next_jobs(1, 4) == [8, 9, 10] # 12 remaining over 2 workers -> guided size 3
+    assert iteration_state.count_complete() == 4
+    assert iteration_state.next_jobs(1, 4) == [11, 12, 13]
+    assert iteration_state.next_jobs(1, 4) == [14, 15]
+    assert iteration_state.next_jobs(1, 4) == [16]
+    assert iteration_state.next_jobs(1, 4) == [17]
+    assert iteration_state.next_jobs(1, 4) == [18]
+    assert iteration_state.next_jobs(2, 4) == [19]
+    assert iteration_state.next_jobs(1, 4) == []
+    assert iteration_state.next_jobs(2, 4) == []
+    assert iteration_state.count_complete() == 20
+    assert iteration_state.finished()
+
+
+def _test_batched_loop():
+    for i in pt.distributed(list(range(30)), max_batch_size=5):
+        pt_testing.log(f"Doing task {i}")
+
+def test_batched_loop():
+    pt.use("multiprocessing-4")
+    pt_testing.initialise_log()
+    pt.launch(_test_batched_loop)
+    log = pt_testing.get_log(remove_process_ids=True)
+    assert sorted(log) == sorted([f"Doing task {i}" for i in range(30)])
+
+
+def test_resume_journal(tmp_path):
+    from tangos.parallel_tasks.jobs import ResumeJournal
+
+    path = tmp_path / "test.journal"
+    journal = ResumeJournal(path)
+    jobs_complete_a = [False]*5
+    jobs_complete_b = [False]*3
+
+    for job in (0, 3):
+        jobs_complete_a[job] = True
+        journal.record_completion("a", jobs_complete_a, [job])
+    jobs_complete_b[1] = True
+    journal.record_completion("b", jobs_complete_b, [1])
+
+    expected = {"a": [True, False, False, True, False], "b": [False, True, False]}
+    assert ResumeJournal.replay(path) == expected
+
+    # a truncated final record must not prevent the rest of the journal being read
+    with open(path, "ab") as f:
+        f.write(b"\x80\x04\x95")
+    assert ResumeJournal.replay(path) == expected
+
+    journal.compact()
+    assert ResumeJournal.replay(path) == expected
+    assert not (tmp_path / "test.journal.tmp").exists()
+
+
+def _test_server_groups():
+    for ts in pt.distributed_to_groups(list(range(4))):
+        pt.group_barrier()
+        for i in pt.distributed(list(range(5)), within_group=True):
+            pt_testing.log(f"Group {pt.groups.group_of_rank(pt.backend.rank())} step {ts} task {i}")
+
+def test_server_groups():
+    pt.use("multiprocessing-7")
+    pt.groups.use_server_groups(2)
+    pt_testing.initialise_log()
+    pt.launch(_test_server_groups)
+    assert not pt.groups.server_groups_active()
+
+    log = pt_testing.get_log()
+
+    # ranks 1 and 4 serve their groups, so should do no work
+    assert {int(line[1:line.index("]")]) for line in log} <= {2, 3, 5, 6}
+
+    log = pt_testing.get_log(remove_process_ids=True)
+    assert len(log) == 20
+    for ts in range(4):
+        groups_for_step = {line.split()[1] for line in log if f"step {ts} " in line}
+        assert len(groups_for_step) == 1
+        group = groups_for_step.pop()
+        for i in range(5):
+            assert log.count(f"Group {group} step {ts} task {i}") == 1
+
+
+def _test_numpy_transfer():
+    large = np.arange(100000, dtype=np.float64).reshape((-1, 2))
+    small = np.arange(10, dtype=np.int32)
+    if pt.backend.rank()==1:
+        pt.backend.send_numpy_array(large, 2)
+        pt.backend.send_numpy_array(small, 2)
+    else:
+        received_large = pt.backend.receive_numpy_array(1)
+        received_small = pt.backend.receive_numpy_array(1)
+        assert received_large.dtype == large.dtype and received_small.dtype == small.dtype
+        assert (received_large == large).all() and (received_small == small).all()
+        pt_testing.log("Received arrays")
+
+def test_numpy_transfer():
+    pt.use("multiprocessing-3")
+    pt_testing.initialise_log()
+    pt.launch(_test_numpy_transfer)
+    assert pt_testing.get_log() == ["[2] Received arrays"]
+
+
+def _test_numpy_transfer_both_directions():
+    large = np.arange(100000, dtype=np.float64)
+    assert large.nbytes > 65536 # i.e. sent through shared memory
+    if pt.backend.rank()==1:
+        pt.backend.send_numpy_array(large, 2)
+        assert (pt.backend.receive_numpy_array(2) == 2*large).all()
+    else:
+        received = pt.backend.receive_numpy_array(1)
+        assert (received == large).all()
+        pt.backend.send_numpy_array(2*received, 1)
+    pt_testing.log("Received array")
+
+def _shared_memory_blocks():
+    if not os.path.isdir("/dev/shm"):
+        pytest.skip("No /dev/shm to inspect on this platform")
+    return set(os.listdir("/dev/shm"))
+
+def test_numpy_transfer_leaves_no_shared_memory():
+    before = _shared_memory_blocks()
+    pt.use("multiprocessing-3")
+    pt_testing.initialise_log()
+    pt.launch(_test_numpy_transfer_both_directions)
+    assert sorted(pt_testing.get_log()) == ["[1] Received array", "[2] Received array"]
+    assert _shared_memory_blocks() - before == set()
+
+
+def test_resume_journal_repeated_context(tmp_path):
+    from tangos.parallel_tasks.jobs import ResumeJournal
+
+    path = tmp_path / "test.journal"
+    journal = ResumeJournal(path)
+
+    first_attempt = [False]*3
+    first_attempt[0] = True
+    journal.record_completion("a", first_attempt, [0])
+
+    # a new attempt at the same loop (e.g. the same halo loop on the next timestep) starts afresh...
+    second_attempt = [False]*3
+    second_attempt[1] = True
+    journal.record_completion("a", second_attempt, [1])
+
+    journal.record_completion("b", [True, False], [0])
+
+    # ...and later records for it must not be confused with those of the first attempt
+    second_attempt[2] = True
+    journal.record_completion("a", second_attempt, [2])
+
+    assert ResumeJournal.replay(path) == {"a": [False, True, True], "b": [True, False]}
+
+def test_damaged_journal_ignored(tmp_path, monkeypatch):
+    from tangos.parallel_tasks.jobs import IterationState
+
+    monkeypatch.setattr(IterationState, "_resume_state_folder_path", classmethod(lambda cls: tmp_path))
+
+    # a delta record for an iteration whose full record is missing
+    with open(tmp_path / "tangos_resume_state_000000.journal", "wb") as f:
+        pickle.dump(((0, "missing"), [1]), f)
+
+    assert IterationState._get_stored_completion_maps() == {}
+
+
+def _fake_insert_list_unlocked(property_list, timestep_id):
+    if property_list == "fail":
+        raise RuntimeError("Insert failed")
+    return len(property_list)
+
+def _test_failed_commit_on_server():
+    from tangos import cached_writer
+    with pytest.raises(RuntimeError, match="Insert failed"):
+        cached_writer.insert_list("fail", None, True, wait=True)
+
+    # the server must still be processing commits
+    assert cached_writer.insert_list([1, 2], None, True, wait=True) == 2
+    pt_testing.log("Commits continued")
+
+def test_failed_commit_on_server(monkeypatch):
+    from tangos import cached_writer
+    monkeypatch.setattr(cached_writer, "_insert_list_unlocked", _fake_insert_list_unlocked)
+    pt.use("multiprocessing-2")
+    pt_testing.initialise_log()
+    pt.launch(_test_failed_commit_on_server)
+    assert pt_testing.get_log(remove_process_ids=True) == ["Commits continued"]
+
+
+def _test_generated_task_list_with_server_groups():
+    for i in pt.jobs.generate_task_list_and_parallel_iterate(lambda: list(range(6))):
+        pt_testing.log(f"Doing task {i}")
+
+def test_generated_task_list_with_server_groups():
+    pt.use("multiprocessing-5")
+    pt.groups.use_server_groups(2)
+    pt_testing.initialise_log()
+    pt.launch(_test_generated_task_list_with_server_groups)
+
+    log = pt_testing.get_log()
+    assert sorted(line[line.index("]")+2:] for line in log) == [f"Doing task {i}" for i in range(6)]
+    # ranks 1 and 3 are the group servers
+    assert {int(line[1:line.index("]")]) for line in log} <= {2, 4}
+
+
+class MessageTestSlowOnMainThread(pt.message.Message):
+    dispatch_lane = pt.dispatch.MAIN_THREAD
+
+    def process(self):
+        time.sleep(self.contents)
+        # written straight to the log, so that its position shows when this message was processed
+        log_message = pt_testing.ServerLogMessage("Slow request finished")
+        log_message.source = self.source
+        with pt.dispatch.lane_lock(pt.dispatch.COORDINATION):
+            log_message.process()
+
+class MessageTestFollowUp(pt.message.Message):
+    pass
+
+class MessageTestWithFollowUp(pt.message.Message):
+    @classmethod
+    def deserialize(cls, source, message):
+        obj = cls(MessageTestFollowUp.receive(source).contents)
+        obj.source = source
+        return obj
+
+    def process(self):
+        log_message = pt_testing.ServerLogMessage(f"Follow-up {self.contents}")
+        log_message.source = self.source
+        log_message.process()
+
+def _test_concurrent_dispatch_order():
+    for i in range(20):
+        pt_testing.log(f"Message {i}")
+        if i==5:
+            MessageTestWithFollowUp().send(0)
+            time.sleep(0.01)
+            MessageTestFollowUp(pt.backend.rank()).send(0)
+        if i==10:
+            MessageTestSlowOnMainThread(0.05).send(0)
+
+def test_concurrent_dispatch_order(monkeypatch):
+    monkeypatch.setattr(tangos.config, "server_concurrent_dispatch", True)
+    pt.use("multiprocessing-4")
+    pt_testing.initialise_log()
+    pt.launch(_test_concurrent_dispatch_order)
+    log = pt_testing.get_log()
+
+    for rank in (1, 2, 3):
+        expected = [f"Message {i}" for i in range(6)] + [f"Follow-up {rank}"] + \
+                   [f"Message {i}" for i in range(6, 11)] + ["Slow request finished"] + \
+                   [f"Message {i}" for i in range(11, 20)]
+        assert [line[4:] for line in log if line.startswith(f"[{rank}]")] == expected
+
+def _test_concurrent_dispatch_slow_client():
+    pt.barrier()
+    if pt.backend.rank()==1:
+        MessageTestSlowOnMainThread(1.0).send(0)
+    else:
+        time.sleep(0.2)
+        with pt.ExclusiveLock("concurrent_dispatch_test", 0):
+            pt_testing.log("Client acquired lock")
+
+@pytest.mark.parametrize("concurrent", [False, True])
+def test_concurrent_dispatch_slow_client(concurrent, monkeypatch):
+    monkeypatch.setattr(tangos.config, "server_concurrent_dispatch", concurrent)
+    pt.use("multiprocessing-3")
+    pt_testing.initialise_log()
+    pt.launch(_test_concurrent_dispatch_slow_client)
+    log = pt_testing.get_log()
+    if concurrent:
+        assert log == ["[2] Client acquired lock", "[1] Slow request finished"]
+    else:
+        assert log == ["[1] Slow request finished", "[2] Client acquired lock"]
+
+@pytest.mark.parametrize("lock_test", [test_add_property, test_shared_locks, test_shared_locks_in_queue,
+                                       lambda: test_server_exclusive_lock(True),
+                                       lambda: test_server_exclusive_lock(False),
+                                       test_deferred_server_lock, test_synchronize_db_creator],
+                         ids=["add_property", "shared_locks", "shared_locks_in_queue", "server_lock_first",
+                              "server_lock_second", "deferred_server_lock", "synchronize_db_creator"])
+def test_locks_with_concurrent_dispatch(lock_test, monkeypatch):
+    monkeypatch.setattr(tangos.config, "server_concurrent_dispatch", True)
+    lock_test()
+
+def test_lock_handover_delay():
+    assert pt.ExclusiveLock("insert_list")._delay == 0.0
+    assert pt.ExclusiveLock("other_lock")._delay == tangos.config.DEFAULT_SLEEP_BEFORE_ALLOWING_NEXT_LOCK
+    assert pt.ExclusiveLock("other_lock", 0.5)._delay == 0.5
+
+def _test_lock_statistics():
+    with pt.ExclusiveLock("statistics_test", 0):
+        time.sleep(0.2)
+
+def test_lock_statistics():
+    pt.use("multiprocessing-3")
+    log = pt.launch(_test_lock_statistics, backend_kwargs={'capture_log': True})
+    assert "LOCK WAIT AND HOLD TIMES" in log
+    # each of the two clients held the lock for 0.2s; one of them waited about that long for it
+    wait_counts, hold_counts = ([int(n) for n in line.split()[-7:]] for line in log.splitlines()
+                                if "statistics_test" in line)
+    assert sum(wait_counts) == 2 and sum(wait_counts[3:]) == 1
+    assert hold_counts == [0, 0, 0, 2, 0, 0, 0]
+
+def test_lock_statistics_histogram():
+    statistics = pt.lock.LockStatistics()
+    for duration in (0.0, 0.005, 0.5, 500.0):
+        statistics._add_to_histogram(statistics.wait_histograms, "lock", duration)
+    assert list(statistics.wait_histograms["lock"]) == [1, 1, 0, 1, 0, 0, 1]
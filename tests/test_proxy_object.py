@@ -64,3 +64,26 @@ def test_unresolvable_proxy_object():
 
     cache = toc.TimestepObjectCache(tangos.get_timestep('sim/ts1'))
     assert incomplete.relative_to_timestep_cache(cache).resolve(tangos.get_default_session()) is None
+
+def test_resolve_all():
+    ts1 = tangos.get_timestep('sim/ts1')
+    ts1_halo1 = tangos.get_object('sim/ts1/halo_1')
+    ts1_bh1 = tangos.get_object('sim/ts1/BH_1')
+    ts1_bh2 = tangos.get_object('sim/ts1/BH_2')
+    ts2_halo1 = tangos.get_object('sim/ts2/halo_1')
+
+    proxies = [po.IncompleteProxyObjectFromFinderId(1, 'halo'),
+               po.IncompleteProxyObjectFromFinderId(2, 'BH'),
+               po.IncompleteProxyObjectFromFinderId(1, 'BH'),
+               po.IncompleteProxyObjectFromFinderId(99, 'halo'),
+               po.ProxyObjectFromDatabaseId(ts2_halo1.id),
+               po.ProxyObjectFromDatabaseId(ts1_halo1.id),
+               "not a proxy"]
+
+    with tangos.testing.SqlExecutionTracker() as ctr:
+        resolved = po.resolve_all(proxies, tangos.get_default_session(), ts1.id)
+
+    assert resolved == [ts1_halo1, ts1_bh2, ts1_bh1, None, ts2_halo1, ts1_halo1, "not a proxy"]
+
+    # one query for the database IDs, plus one for each object type referred to by finder ID
+    assert ctr.count_statements_containing("SELECT halos")==3
@@ -1,4 +1,5 @@
 import os
+import re
 import sys
 
 import numpy as np
@@ -118,6 +119,30 @@ def test_simsnap_arrays():
     assert (f['x'] == f_local['x']).all()
     assert (f.gas['iord'] == f_local.gas['iord']).all()
 
+@pytest.mark.parametrize('shared_mem', [True, False])
+@using_parallel_tasks
+def test_preload_arrays(shared_mem):
+    conn = ps.RemoteSnapshotConnection(handler, "tiny.000640", shared_mem=shared_mem)
+    f_local = pynbody.load(tangos.config.base+"test_simulations/test_tipsy/tiny.000640")
+    f_local.physical_units()
+    if shared_mem:
+        f = conn.shared_mem_view
+    else:
+        test_filter = pynbody.filt.Sphere('5000 kpc')
+        f = conn.get_view(test_filter)
+        f_local = f_local[test_filter]
+
+    f.preload_arrays(['pos', 'mass', 'iord', 'nonexistent'])
+    assert 'pos' in f.keys()
+    assert 'mass' in f.keys()
+    assert 'iord' in f.keys()
+
+    assert (f['pos'] == f_local['pos']).all()
+    assert (f['mass'] == f_local['mass']).all()
+    assert (f.gas['iord'] == f_local.gas['iord']).all()
+    with npt.assert_raises(KeyError):
+        f['nonexistent']
+
 @using_parallel_tasks
 def test_nonexistent_array():
     test_filter = pynbody.filt.Sphere('5000 kpc')
@@ -461,3 +486,101 @@ def test_region_cache():
     # now check that a different filter gives a different object
     f3 = handler.load_region("tiny.000640", pynbody.filt.Sphere("4 Mpc"), mode='server-shared-mem')
     assert f3 is not f1
+
+
+@using_parallel_tasks(2)
+def test_prefetch():
+    conn = ps.RemoteSnapshotConnection(handler, "tiny.000640")
+    handler.prefetch_timestep("tiny.000832", mode='server')
+    conn.disconnect()
+
+    conn = ps.RemoteSnapshotConnection(handler, "tiny.000832")
+    test_filter = pynbody.filt.Sphere('5000 kpc')
+    f = conn.get_view(test_filter)
+    f_local = pynbody.load(tangos.config.base + "test_simulations/test_tipsy/tiny.000832")[test_filter]
+    f_local.physical_units()
+    assert (f['x'] == f_local['x']).all()
+    conn.disconnect()
+
+@using_parallel_tasks(2)
+def test_cancel_prefetch():
+    conn = ps.RemoteSnapshotConnection(handler, "tiny.000640")
+    handler.prefetch_timestep("tiny.000832", mode='server')
+    handler.cancel_prefetch_timestep("tiny.000832", mode='server')
+    conn.disconnect()
+
+def test_cancelled_prefetch_is_discarded():
+    log = test_cancel_prefetch()
+    assert "Pynbody server: discarding prefetched 'tiny.000832' which is not needed" in log
+
+def test_prefetched_snapshot_is_used():
+    log = test_prefetch()
+    assert "Pynbody server: prefetching 'tiny.000832' in the background" in log
+    assert "Pynbody server: using prefetched 'tiny.000832'" in log
+
+class _FailedPrefetch:
+    shared_mem = False
+    def result(self):
+        raise ValueError("Prefetch failed")
+
+def test_failed_prefetch_falls_back_to_load(monkeypatch):
+    queue = ps.snapshot_queue.PynbodySnapshotQueue()
+    queue.prefetched["tiny.000640"] = _FailedPrefetch()
+    notified = []
+    monkeypatch.setattr(queue, "_notify_available", notified.append)
+
+    queue.add(1, handler, "tiny.000640")
+
+    assert notified == [1]
+    assert len(queue.current_snapshot) == len(handler.load_timestep("tiny.000640"))
+
+@using_parallel_tasks(2)
+def test_subsnap_cache():
+    conn = ps.RemoteSnapshotConnection(handler, "tiny.000640")
+    for radius in ("3 Mpc", "4 Mpc", "3 Mpc"):
+        f = conn.get_view(pynbody.filt.Sphere(radius))
+        f['x']
+    conn.disconnect()
+
+@pytest.mark.parametrize('cache_limit', [None, 1e-9])
+def test_subsnap_cache_stats(cache_limit, monkeypatch):
+    monkeypatch.setattr(tangos.config, 'pynbody_server_subsnap_cache_limit', cache_limit)
+    log = test_subsnap_cache()
+    hits, misses, evictions = map(int, re.search(r"Subsnap cache: (\d+) hits, (\d+) misses, (\d+) evictions", log).groups())
+    assert hits > 0
+    if cache_limit is None:
+        assert misses == 2
+        assert evictions == 0
+    else:
+        # every new region evicts the last, so the repeated query for the first region must miss
+        assert misses == 3
+        assert evictions == 2
+
+def test_subsnap_cache_memory_budget(monkeypatch):
+    # with a tiny memory budget, the governor has to discard everything cached
+    monkeypatch.setattr(tangos.config, 'memory_budget', 1e-9)
+    log = test_subsnap_cache()
+    hits, misses, evictions = map(int, re.search(r"Subsnap cache: (\d+) hits, (\d+) misses, (\d+) evictions", log).groups())
+    assert hits == 0
+    assert evictions == misses
+
+@using_parallel_tasks(2)
+@pytest.mark.parametrize('expected_number_of_queries', [1, 100000])
+def test_prefetch_regions(expected_number_of_queries):
+    regions = [pynbody.filt.Sphere("3 Mpc"), pynbody.filt.Sphere("2 Mpc"), pynbody.filt.Sphere("1 kpc")]
+    handler.prefetch_regions("tiny.000640", regions, mode='server-shared-mem',
+                             expected_number_of_queries=expected_number_of_queries)
+    timestep = handler.load_timestep("tiny.000640", mode='server-shared-mem')
+    assert len(timestep._tangos_prefetched_region_indices) == 3
+
+    for region in regions:
+        f_remote = handler.load_region("tiny.000640", region, mode='server-shared-mem')
+        f_local = handler.load_region("tiny.000640", region, mode=None)
+        assert len(f_remote) == len(f_local)
+        assert (f_remote.dm['pos'] == f_local.dm['pos']).all()
+        assert (f_remote.st['pos'] == f_local.st['pos']).all()
+
+    # each index list is used once, after which the region is in the region cache
+    assert len(timestep._tangos_prefetched_region_indices) == 0
+    handler.prefetch_regions("tiny.000640", regions[:1], mode='server-shared-mem')
+    assert len(timestep._tangos_prefetched_region_indices) == 0
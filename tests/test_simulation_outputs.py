@@ -210,6 +210,21 @@ def test_load_region_uses_cache():
     assert id(region1a) == id(region1b)
     assert id(region1a) != id(region2)
 
+def test_load_region_cache_is_bounded(monkeypatch):
+    add_test_simulation_to_db()
+    monkeypatch.setattr(tangos.config, 'pynbody_region_cache_size', 2)
+    timestep = db.get_timestep("test_tipsy/tiny.000640")
+    if hasattr(timestep.load(), '_tangos_cached_regions'):
+        del timestep.load()._tangos_cached_regions # created by an earlier test, with the default size
+    filters = [pynbody.filt.Sphere(2000,[1000+i,1000,1000]) for i in range(3)]
+
+    region0 = timestep.load_region(filters[0])
+    region1 = timestep.load_region(filters[1])
+    assert timestep.load_region(filters[0]) is region0 # filters[1] is now least recently used
+    timestep.load_region(filters[2])
+    assert timestep.load_region(filters[0]) is region0
+    assert timestep.load_region(filters[1]) is not region1
+
 
 class DummyHaloClass(pynbody.halo.number_array.HaloNumberCatalogue):
     def __init__(self, sim):
@@ -0,0 +1,30 @@
+import numpy as np
+import numpy.testing as npt
+
+from tangos.util import spatial_ordering
+
+
+def test_morton_keys_interleave_bits():
+    # positions at the corners of the bounding box map onto the corners of the key space
+    keys = spatial_ordering.morton_keys([[0., 0., 0.], [1., 0., 0.], [0., 1., 0.], [0., 0., 1.], [1., 1., 1.]])
+    max_key = np.uint64(2**63-1)
+    assert keys[0] == 0
+    assert keys[1] == max_key // np.uint64(7)
+    assert keys[2] == keys[1] << np.uint64(1)
+    assert keys[3] == keys[1] << np.uint64(2)
+    assert keys[4] == max_key
+
+def test_morton_order_keeps_neighbours_together():
+    np.random.seed(1)
+    clumps = np.array([[0., 0., 0.], [10., 10., 10.], [0., 10., 0.], [10., 0., 10.]])
+    positions = np.concatenate([c + np.random.uniform(0, 1, (20, 3)) for c in clumps])
+    shuffle = np.random.permutation(len(positions))
+
+    order = spatial_ordering.morton_order(positions[shuffle])
+    clump_sequence = shuffle[order] // 20
+    # each clump should be visited in one contiguous run
+    assert (np.diff(clump_sequence) != 0).sum() == 3
+
+def test_morton_order_degenerate():
+    npt.assert_equal(spatial_ordering.morton_order(np.zeros((0, 3))), [])
+    npt.assert_equal(spatial_ordering.morton_order([[1., 1., 1.], [1., 1., 1.]]), [0, 1])